@@ -16,7 +16,8 @@ else:
 builtins._ASTROPY_SETUP_ = True
 
 from astropy_helpers.setup_helpers import (
-    register_commands, adjust_compiler, get_debug_option, get_package_info)
+    register_commands, adjust_compiler, get_debug_option, get_package_info,
+    add_command_option)
 from astropy_helpers.git_helpers import get_git_devstr
 from astropy_helpers.version_helpers import generate_version_py
 
@@ -60,6 +61,11 @@ cmdclassd = register_commands(PACKAGENAME, VERSION, RELEASE)
 # broken one.
 adjust_compiler(PACKAGENAME)
 
+# Building the montecarlo extension with OpenMP is optional
+for command in ['build', 'install', 'develop']:
+    add_command_option(command, 'with-openmp',
+                       'compile TARDIS with OpenMP support', is_bool=True)
+
 # Freeze build information in version.py
 generate_version_py(PACKAGENAME, VERSION, RELEASE,
                     get_debug_option(PACKAGENAME))
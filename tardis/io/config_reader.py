@@ -1016,10 +1016,26 @@ class Configuration(ConfigurationNameSpace):
             montecarlo_section['last_no_of_packets'] = \
                 montecarlo_section['no_of_packets']
 
+        if montecarlo_section['formal_integral'] and \
+                plasma_section['line_interaction_type'] != 'scatter':
+            raise ConfigurationError('formal_integral needs the line_interaction_type '
+                                     'scatter (supplied %s)' %
+                                     plasma_section['line_interaction_type'])
+
+        if montecarlo_section['line_tau_threshold'] > 0 and \
+                plasma_section['line_interaction_type'] != 'scatter':
+            raise ConfigurationError('line_tau_threshold needs the line_interaction_type '
+                                     'scatter (supplied %s)' %
+                                     plasma_section['line_interaction_type'])
+
         default_convergence_section = {'type': 'damped',
                                       'lock_t_inner_cycles': 1,
                                       't_inner_update_exponent': -0.5,
-                                      'damping_constant': 0.5}
+                                      'damping_constant': 0.5,
+                                      'initial_no_of_packets': -1,
+                                      'packet_growth_factor': 2.0,
+                                      'packet_growth_threshold': 1.0,
+                                      'no_of_packet_batches': 10}
 
 
 
@@ -115,6 +115,58 @@ class TestParsePaper1Config:
     def test_number_of_packets(self):
         assert_almost_equal(self.config['montecarlo']['no_of_packets'], 200000)
 
+    def test_nthreads(self):
+        assert self.config['montecarlo']['nthreads'] == 1
+
+    def test_backend(self):
+        assert self.config['montecarlo']['backend'] == 'threads'
+        assert self.config['montecarlo']['no_of_processes'] == 0
+        assert self.config['montecarlo']['workers'] == []
+
+    def test_j_estimator_noise_target(self):
+        assert self.config['montecarlo']['j_estimator_noise_target'] == 0.0
+        assert self.config['montecarlo']['packet_chunk_size'] == 100000
+
+    def test_transport_kernel(self):
+        assert self.config['montecarlo']['transport_kernel'] == 'packet'
+
+    def test_cumulative_line_tau(self):
+        assert self.config['montecarlo']['cumulative_line_tau'] is False
+
+    def test_virtual_packet_roulette(self):
+        assert_almost_equal(self.config['montecarlo']['virtual_packet_roulette_tau'], 0.0)
+        assert_almost_equal(self.config['montecarlo']['virtual_packet_roulette_survival'], 0.1)
+
+    def test_line_tau_threshold(self):
+        assert_almost_equal(self.config['montecarlo']['line_tau_threshold'], 0.0)
+
+    def test_single_precision_storage(self):
+        assert self.config['montecarlo']['single_precision_storage'] is False
+
+    def test_count_events(self):
+        assert self.config['montecarlo']['count_events'] is False
+
+    def test_formal_integral(self):
+        assert self.config['montecarlo']['formal_integral'] is False
+        assert self.config['montecarlo']['formal_integral_impact_parameters'] == 100
+
+    def test_packet_sampling(self):
+        assert self.config['montecarlo']['packet_sampling'] == 'random'
+
+    def test_generate_packets_in_kernel(self):
+        assert self.config['montecarlo']['generate_packets_in_kernel'] is False
+
+    def test_packet_trace(self):
+        assert self.config['montecarlo']['packet_trace_file'] == ''
+        assert self.config['montecarlo']['packet_trace_stride'] == 1000
+        assert self.config['montecarlo']['packet_trace_size'] == 1000000
+
+    def test_packet_scheduling(self):
+        convergence_section = self.config['montecarlo']['convergence_strategy']
+        assert convergence_section['initial_no_of_packets'] == -1
+        assert_almost_equal(convergence_section['packet_growth_factor'], 2.0)
+        assert convergence_section['no_of_packet_batches'] == 10
+
     def test_spectrum_section(self):
         assert_almost_equal(self.config['spectrum']['start'].value,
                             parse_quantity(self.yaml_data['spectrum']['start']).value)
@@ -138,6 +190,14 @@ def test_last_no_of_packets():
     assert (config.montecarlo.last_no_of_packets ==
             config.montecarlo.no_of_packets)
 
+
+def test_line_tau_threshold_needs_scatter():
+    yaml_data = yaml.load(open(data_path('paper1_tardis_configv1.yml')))
+    yaml_data['montecarlo']['line_tau_threshold'] = 1e-3
+    yaml_data['plasma']['line_interaction_type'] = 'macroatom'
+    with pytest.raises(config_reader.ConfigurationError):
+        config_reader.Configuration.from_config_dict(yaml_data, test_parser=True)
+
 class TestParseConfigV1ASCIIDensity:
 
     def setup(self):
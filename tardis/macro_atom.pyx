@@ -71,3 +71,24 @@ def normalize_transition_probabilities(double [:, :] p_transition,
                     continue
 
                 p_transition[j,k] /= norm_factor[k]
+
+def calculate_cumulative_transition_probabilities(double [:, :] p_transition,
+                                                  int_type_t [:] reference_levels):
+    """
+    Cumulative sums of the transition probabilities within every block of
+    transitions, summed in the same order as the montecarlo kernel did when it
+    accumulated them on the fly, so that the kernel can pick a transition by
+    binary search.
+    """
+    cdef int i, j, k
+    cdef np.ndarray[double, ndim=2] cumulative = np.zeros((p_transition.shape[0], p_transition.shape[1]),
+                                                          order='F')
+    cdef double p
+
+    for i in range(len(reference_levels) - 1):
+        for k in range(0, p_transition.shape[1]):
+            p = 0.0
+            for j in range(reference_levels[i], reference_levels[i + 1]):
+                p += p_transition[j, k]
+                cumulative[j, k] = p
+    return cumulative
@@ -10,7 +10,7 @@ from astropy import constants, units as u
 import scipy.special
 
 from tardis import packet_source, plasma_array
-from tardis.montecarlo import montecarlo
+from tardis.montecarlo import montecarlo, formal_integral
 from util import intensity_black_body
 
 
@@ -27,6 +27,45 @@ t_rad_estimator_constant = (np.pi**4 / (15 * 24 * scipy.special.zeta(5, 1))) * h
 
 
 
+def next_no_of_packets(current_no_of_packets, max_no_of_packets, convergence_section, convergence_t_rads,
+                       convergence_ws, j_estimator_relative_noise, nubar_estimator_relative_noise):
+    """
+    Grow the number of packets geometrically (up to `max_no_of_packets`) once the change of the radiation field
+    between iterations is no longer large compared to the Monte Carlo noise of the estimators.
+
+    Parameters
+    ----------
+
+    current_no_of_packets : int
+    max_no_of_packets : int
+    convergence_section : the montecarlo.convergence_strategy section of the configuration
+    convergence_t_rads : ~np.ndarray (float)
+        relative change of the radiation temperatures in the last iteration
+    convergence_ws : ~np.ndarray (float)
+        relative change of the dilution factors in the last iteration
+    j_estimator_relative_noise : ~np.ndarray (float)
+    nubar_estimator_relative_noise : ~np.ndarray (float)
+
+    Returns
+    -------
+
+    int : the number of packets of the next iteration
+    """
+    if current_no_of_packets >= max_no_of_packets:
+        return current_no_of_packets
+
+    # t_rad ~ nubar / j and w ~ j / t_rad ** 4
+    t_rad_noise = np.sqrt(j_estimator_relative_noise ** 2 + nubar_estimator_relative_noise ** 2)
+    w_noise = np.sqrt(j_estimator_relative_noise ** 2 + 16 * t_rad_noise ** 2)
+    noise_dominated = (
+        np.median(convergence_t_rads) < convergence_section.packet_growth_threshold * np.median(t_rad_noise) and
+        np.median(convergence_ws) < convergence_section.packet_growth_threshold * np.median(w_noise))
+
+    if not noise_dominated:
+        return current_no_of_packets
+    return min(int(current_no_of_packets * convergence_section.packet_growth_factor), max_no_of_packets)
+
+
 class Radial1DModel(object):
     """
         Class to hold the states of the individual shells (the state of the plasma (as a `~plasma.BasePlasma`-object or one of its subclasses),
@@ -94,11 +133,32 @@ class Radial1DModel(object):
             if not self.atom_data.has_zeta_data:
                 raise ValueError("Requiring Recombination coefficients Zeta for 'nebular' plasma ionization")
 
+        generate_packets_in_kernel = tardis_config.montecarlo.generate_packets_in_kernel
+        if generate_packets_in_kernel and tardis_config.montecarlo.backend != 'threads':
+            logger.warning('Only the threads backend generates the packets in the transport kernel, creating '
+                           'the packet arrays for the %s backend', tardis_config.montecarlo.backend)
+            generate_packets_in_kernel = False
         self.packet_src = packet_source.SimplePacketSource.from_wavelength(tardis_config.montecarlo.black_body_sampling.start,
                                                                            tardis_config.montecarlo.black_body_sampling.end,
                                                                            blackbody_sampling=tardis_config.montecarlo.black_body_sampling.samples,
-                                                                           seed=self.tardis_config.montecarlo.seed)
+                                                                           seed=self.tardis_config.montecarlo.seed,
+                                                                           sampling=tardis_config.montecarlo.packet_sampling,
+                                                                           generate_in_kernel=generate_packets_in_kernel)
         self.current_no_of_packets = tardis_config.montecarlo.no_of_packets
+        self.packet_scheduling_enabled = \
+            tardis_config.montecarlo.convergence_strategy.initial_no_of_packets > 0
+        if self.packet_scheduling_enabled:
+            self.current_no_of_packets = min(tardis_config.montecarlo.convergence_strategy.initial_no_of_packets,
+                                             self.current_no_of_packets)
+        # set by tardis.simulation.run_radial1d for the processes and the distributed transport backends
+        self.transport_pool = None
+        self.transport_coordinator = None
+        # transport input arrays reused across iterations, created by the first transport
+        self.transport_context = None
+        # per-shell transport event counters of the last iteration if montecarlo.count_events is set
+        self.event_counters = None
+        # ring buffer of the packet trace, set by tardis.simulation.run_radial1d if montecarlo.packet_trace_file is set
+        self.packet_trace = None
 
         self.t_inner = tardis_config.plasma.t_inner
         self.t_rads = tardis_config.plasma.t_rads
@@ -131,7 +191,9 @@ class Radial1DModel(object):
                                                          nlte_config=tardis_config.plasma.nlte,
                                                          delta_treatment=tardis_config.plasma.delta_treatment,
                                                          ionization_mode=tardis_config.plasma.ionization,
-                                                         excitation_mode=tardis_config.plasma.excitation)
+                                                         excitation_mode=tardis_config.plasma.excitation,
+                                                         single_precision_storage=
+                                                         tardis_config.montecarlo.single_precision_storage)
 
 
 
@@ -139,6 +201,7 @@ class Radial1DModel(object):
         self.spectrum = TARDISSpectrum(tardis_config.spectrum.frequency, tardis_config.supernova.distance)
         self.spectrum_virtual = TARDISSpectrum(tardis_config.spectrum.frequency, tardis_config.supernova.distance)
         self.spectrum_reabsorbed = TARDISSpectrum(tardis_config.spectrum.frequency, tardis_config.supernova.distance)
+        self.spectrum_integrated = TARDISSpectrum(tardis_config.spectrum.frequency, tardis_config.supernova.distance)
 
 
 
@@ -156,6 +219,7 @@ class Radial1DModel(object):
             self.atom_data.prepare_atom_data(self.tardis_config.number_densities.columns,
                                              line_interaction_type=self.line_interaction_type, max_ion_number=None,
                                              nlte_species=self.tardis_config.plasma.nlte.species)
+            self.transport_context = None
         else:
             raise ValueError('line_interaction_type can only be "scatter", "downbranch", or "macroatom"')
 
@@ -192,12 +256,15 @@ class Radial1DModel(object):
         elif radiative_rates_type == 'detailed':
             logger.info('Calculating J_blues for radiate_rates_type=detailed')
 
-            self.j_blues = pd.DataFrame(self.j_blue_estimators.transpose() * self.j_blues_norm_factor.value,
-                                        index=self.atom_data.lines.index, columns=np.arange(len(self.t_rads)))
-            for i in xrange(self.tardis_config.structure.no_of_shells):
-                zero_j_blues = self.j_blues[i] == 0.0
-                self.j_blues[i][zero_j_blues] = w_epsilon * intensity_black_body(
-                    self.atom_data.lines.nu.values[zero_j_blues], self.t_rads.value[i])
+            # only the lines in j_blue_estimator_lines are estimated, the others keep the dilute blackbody
+            # value, which nothing reads
+            j_blues = self.ws * intensity_black_body(nus[np.newaxis].T, self.t_rads.value)
+            estimated_j_blues = self.j_blue_estimators.transpose() * self.j_blues_norm_factor.value
+            zero_j_blues = estimated_j_blues == 0.0
+            estimated_j_blues[zero_j_blues] = w_epsilon * intensity_black_body(
+                nus[self.j_blue_estimator_lines][np.newaxis].T, self.t_rads.value)[zero_j_blues]
+            j_blues[self.j_blue_estimator_lines] = estimated_j_blues
+            self.j_blues = pd.DataFrame(j_blues, index=self.atom_data.lines.index, columns=np.arange(len(self.t_rads)))
 
         else:
             raise ValueError('radiative_rates_type type unknown - %s', radiative_rates_type)
@@ -205,6 +272,38 @@ class Radial1DModel(object):
 
 
 
+    def calculate_j_blue_estimator_lines(self, all_lines=False):
+        """
+        Select the lines whose j_blue estimators are accumulated by the montecarlo transport.
+
+        The estimators are only read for radiative_rates_type 'detailed', and then only for the lines of the
+        NLTE species and the lines of the macro atom up-transitions. For the other radiative rates types no
+        estimator is accumulated.
+
+        Parameters
+        ----------
+        all_lines : bool
+            select every line, the formal integral reads the source functions of all lines
+
+        Returns
+        -------
+        j_blue_estimator_lines : ~np.ndarray (int)
+            sorted line indices
+        """
+        if all_lines:
+            return np.arange(len(self.atom_data.lines), dtype=np.int64)
+        plasma_config = self.tardis_config.plasma
+        if plasma_config.radiative_rates_type != 'detailed':
+            return np.array([], dtype=np.int64)
+
+        line_ids = [np.array([], dtype=np.int64)]
+        if not plasma_config.nlte.get('coronal_approximation', False):
+            line_ids.append(np.where(self.atom_data.nlte_data.nlte_lines_mask)[0])
+        if plasma_config.line_interaction_type in ('downbranch', 'macroatom'):
+            macro_atom_data = self.atom_data.macro_atom_data
+            line_ids.append(macro_atom_data.lines_idx.values[(macro_atom_data.transition_type == 1).values])
+        return np.unique(np.hstack(line_ids)).astype(np.int64)
+
     def calculate_updated_radiationfield(self, nubar_estimator, j_estimator):
         """
         Calculate an updated radiation field from the :math:`\\bar{nu}_\\textrm{estimator}` and :math:`\\J_\\textrm{estimator}`
@@ -244,9 +343,15 @@ class Radial1DModel(object):
             self.transition_probabilities = self.plasma_array.calculate_transition_probabilities()
 
 
-    def update_radiationfield(self, log_sampling=5):
+    def update_radiationfield(self, log_sampling=5, schedule_packets=True):
         """
         Updating radiation field
+
+        Parameters
+        ----------
+
+        schedule_packets : bool
+            if False, the number of packets of the next iteration is kept even with packet scheduling enabled
         """
         convergence_section = self.tardis_config.montecarlo.convergence_strategy
         updated_t_rads, updated_ws = self.calculate_updated_radiationfield(self.nubar_estimators, self.j_estimators)
@@ -301,6 +406,9 @@ class Radial1DModel(object):
                     self.iterations_remaining = self.iterations_max_requested - self.iterations_executed
                     self.converged = False
 
+        if self.packet_scheduling_enabled and schedule_packets:
+            self.schedule_no_of_packets(convergence_t_rads, convergence_ws)
+
         self.temperature_logging = pd.DataFrame(
             {'t_rads': old_t_rads.value, 'updated_t_rads': updated_t_rads.value,
              'converged_t_rads': convergence_t_rads, 'new_trads': self.t_rads.value, 'ws': old_ws,
@@ -323,6 +431,28 @@ class Radial1DModel(object):
         return t_inner_new
 
 
+    def schedule_no_of_packets(self, convergence_t_rads, convergence_ws):
+        """
+        Grow the number of packets of the next iteration (see `next_no_of_packets`).
+
+        Parameters
+        ----------
+
+        convergence_t_rads : ~np.ndarray (float)
+            relative change of the radiation temperatures in the last iteration
+
+        convergence_ws : ~np.ndarray (float)
+            relative change of the dilution factors in the last iteration
+        """
+        no_of_packets = next_no_of_packets(self.current_no_of_packets, self.tardis_config.montecarlo.no_of_packets,
+                                           self.tardis_config.montecarlo.convergence_strategy,
+                                           convergence_t_rads, convergence_ws, self.j_estimator_relative_noise,
+                                           self.nubar_estimator_relative_noise)
+        if no_of_packets > self.current_no_of_packets:
+            logger.info('Radiation field changes are dominated by Monte Carlo noise - increasing the number of '
+                        'packets to %d', no_of_packets)
+        self.current_no_of_packets = no_of_packets
+
     def simulate(self, update_radiation_field=True, enable_virtual=False, initialize_j_blues=False,
                  initialize_nlte=False):
         """
@@ -330,7 +460,8 @@ class Radial1DModel(object):
         """
 
         if update_radiation_field:
-            t_inner_new = self.update_radiationfield()
+            # the last iteration (with virtual packets) uses montecarlo.last_no_of_packets as set by run_radial1d
+            t_inner_new = self.update_radiationfield(schedule_packets=not enable_virtual)
         else:
             t_inner_new = self.t_inner
 
@@ -350,18 +481,35 @@ class Radial1DModel(object):
             or np.any(np.isneginf(self.plasma_array.tau_sobolevs.values)):
             raise ValueError('Some tau_sobolevs are nan, inf, -inf in tau_sobolevs. Something went wrong!')
 
-        self.j_blue_estimators = np.zeros((len(self.t_rads), len(self.atom_data.lines)))
+        integrate_spectrum = enable_virtual and self.tardis_config.montecarlo.formal_integral
+        self.j_blue_estimator_lines = self.calculate_j_blue_estimator_lines(all_lines=integrate_spectrum)
+        self.j_blue_estimators = np.zeros((len(self.t_rads), len(self.j_blue_estimator_lines)),
+                                          dtype=self.plasma_array.storage_dtype)
         self.montecarlo_virtual_luminosity = np.zeros_like(self.spectrum.frequency.value)
+        if self.tardis_config.montecarlo.count_events:
+            self.event_counters = np.zeros((len(self.t_rads), len(montecarlo.EVENT_COUNTER_NAMES)), dtype=np.int64)
+        else:
+            self.event_counters = None
+
+        if self.tardis_config.montecarlo.j_estimator_noise_target > 0 or self.packet_scheduling_enabled:
+            transport_result = self.transport_in_chunks(no_of_virtual_packets)
+        else:
+            transport_result = montecarlo.montecarlo_radial1d(self, virtual_packet_flag=no_of_virtual_packets)
 
         montecarlo_nu, montecarlo_energies, self.j_estimators, self.nubar_estimators, \
         last_line_interaction_in_id, last_line_interaction_out_id, \
-        self.last_interaction_type, self.last_line_interaction_shell_id = \
-            montecarlo.montecarlo_radial1d(self,
-                                                     virtual_packet_flag=no_of_virtual_packets)
+        self.last_interaction_type, self.last_line_interaction_shell_id = transport_result
 
         if np.sum(montecarlo_energies < 0) == len(montecarlo_energies):
             logger.critical("No r-packet escaped through the outer boundary.")
 
+        if self.event_counters is not None:
+            event_totals = self.event_counters.sum(axis=0)
+            logger.info('Transport events: %s (%.1f line steps per packet)',
+                        ', '.join('%s = %d' % (name, total)
+                                  for name, total in zip(montecarlo.EVENT_COUNTER_NAMES, event_totals)),
+                        event_totals[-1] / float(len(montecarlo_nu)))
+
         self.montecarlo_nu = montecarlo_nu * u.Hz
         self.montecarlo_luminosity = montecarlo_energies *  1 * u.erg / self.time_of_simulation
 
@@ -387,6 +535,9 @@ class Radial1DModel(object):
                                                  * 1 * u.erg / self.time_of_simulation
             self.spectrum_virtual.update_luminosity(self.montecarlo_virtual_luminosity)
 
+        if integrate_spectrum:
+            self.spectrum_integrated.update_luminosity(formal_integral.calculate_formal_integral_luminosity(self))
+
 
 
         self.last_line_interaction_in_id = self.atom_data.lines_index.index.values[last_line_interaction_in_id]
@@ -406,6 +557,39 @@ class Radial1DModel(object):
 
 
 
+    def transport_in_chunks(self, virtual_packet_flag=0):
+        """
+        Transport the packets in chunks, which gives an estimate of the Monte Carlo noise of the j and
+        nubar estimators (stored as j_estimator_relative_noise and nubar_estimator_relative_noise).
+
+        If montecarlo.j_estimator_noise_target is set, the transport stops once the relative noise of the j
+        estimator is below the target in every shell. If it stops after M of the N packets, the energies of the
+        transported packets and all estimators are multiplied by N / M.
+
+        Returns
+        -------
+        The same arrays as `tardis.montecarlo.montecarlo.montecarlo_radial1d`
+        """
+        montecarlo_config = self.tardis_config.montecarlo
+        no_of_packets = self.packet_src.no_of_packets
+        chunk_size = montecarlo_config.packet_chunk_size
+        if self.packet_scheduling_enabled:
+            no_of_batches = montecarlo_config.convergence_strategy.no_of_packet_batches
+            chunk_size = min(chunk_size, int(np.ceil(no_of_packets / float(no_of_batches))))
+        partial_result = montecarlo.stop_at_noise_target(
+            montecarlo.montecarlo_radial1d_chunks(self, chunk_size, virtual_packet_flag=virtual_packet_flag),
+            montecarlo_config.j_estimator_noise_target)
+
+        self.j_estimator_relative_noise = partial_result['j_estimator_relative_noise']
+        self.nubar_estimator_relative_noise = partial_result['nubar_estimator_relative_noise']
+        energy_scale, transport_result = montecarlo.scale_partial_result(partial_result, no_of_packets)
+        if partial_result['packets_done'] < no_of_packets:
+            logger.info('Reached the j estimator noise target of %g after %d of %d packets',
+                        montecarlo_config.j_estimator_noise_target, partial_result['packets_done'], no_of_packets)
+            self.j_blue_estimators *= energy_scale
+            self.montecarlo_virtual_luminosity *= energy_scale
+        return transport_result
+
     def save_spectra(self, fname):
         self.spectrum.to_ascii(fname)
         self.spectrum_virtual.to_ascii('virtual_' + fname)
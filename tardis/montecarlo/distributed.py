@@ -0,0 +1,208 @@
+"""
+Distributed packet transport.
+
+A `TransportCoordinator` connects to transport workers (``tardis_worker``
+processes, possibly on other machines) through `multiprocessing.connection`.
+In every iteration the plasma state is shipped once to every worker with
+`TransportCoordinator.send_plasma`, then every transport sends each worker
+one batch of whole chunks of packets. The workers return the output of their
+packets and the estimators of every chunk, which the coordinator adds in chunk
+order, so the result is the same as with the threads backend.
+
+`LocalTransportCluster` starts the workers as local processes, which makes it
+possible to run and test the distributed transport on a single machine.
+"""
+
+import logging
+import multiprocessing
+import os
+from multiprocessing.connection import Listener, Client
+
+from tardis.montecarlo.process_pool import (add_chunk_results, get_batch_boundaries, get_estimator_targets,
+                                            transport_chunks)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    """
+    Convert a worker address of the form ``host:port`` to a (host, port) tuple.
+    """
+    if isinstance(address, basestring):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return tuple(address)
+
+
+def serve_transport_requests(listener, nthreads=1):
+    """
+    Serve the transport requests of coordinators connecting to a listener.
+
+    Connections are served one after another until a coordinator sends a
+    shutdown request.
+
+    Parameters
+    ----------
+    listener : `multiprocessing.connection.Listener`
+    nthreads : int
+        number of OpenMP threads used to transport a batch of packets
+    """
+    keep_serving = True
+    while keep_serving:
+        connection = listener.accept()
+        logger.info('Accepted coordinator connection')
+        try:
+            keep_serving = _serve_connection(connection, nthreads)
+        finally:
+            connection.close()
+    listener.close()
+
+
+def _serve_connection(connection, nthreads):
+    arrays = None
+    parameters = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return True
+        command = message[0]
+        if command == 'plasma':
+            arrays, parameters = message[1:]
+        elif command == 'transport':
+            packet_nus, packet_mus, packet_energies, first_packet_id, virtual_packet_flag = message[1:]
+            try:
+                result = transport_chunks(arrays, parameters, packet_nus, packet_mus, packet_energies,
+                                          first_packet_id=first_packet_id, virtual_packet_flag=virtual_packet_flag,
+                                          nthreads=nthreads)
+            except Exception as e:
+                logger.exception('Transport of packets %d to %d failed', first_packet_id,
+                                 first_packet_id + len(packet_nus))
+                connection.send(('error', repr(e)))
+            else:
+                connection.send(('result', result))
+        elif command == 'close':
+            return True
+        elif command == 'shutdown':
+            return False
+        else:
+            connection.send(('error', 'Unknown command %r' % command))
+
+
+class LocalTransportCluster(object):
+    """
+    Transport workers running as processes on the local machine.
+
+    Parameters
+    ----------
+    no_of_workers : int
+    nthreads : int
+        number of OpenMP threads of every worker
+    """
+
+    def __init__(self, no_of_workers, nthreads=1):
+        self.authkey = os.urandom(20)
+        self.addresses = []
+        self.processes = []
+        for i in xrange(no_of_workers):
+            listener = Listener(('localhost', 0), authkey=self.authkey)
+            process = multiprocessing.Process(target=serve_transport_requests, args=(listener, nthreads))
+            process.daemon = True
+            process.start()
+            self.addresses.append(listener.address)
+            listener.close()
+            self.processes.append(process)
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+
+class TransportCoordinator(object):
+    """
+    Distribute the packets of an iteration over transport workers.
+
+    Parameters
+    ----------
+    addresses : list
+        worker addresses, either ``host:port`` strings or (host, port) tuples
+    authkey : str
+        shared secret of coordinator and workers
+    local_cluster : `LocalTransportCluster`, optional
+        the workers are shut down on `close` if they belong to a local cluster
+    """
+
+    def __init__(self, addresses, authkey, local_cluster=None):
+        self.local_cluster = local_cluster
+        self.connections = [Client(parse_address(address), authkey=authkey) for address in addresses]
+        self.arrays = None
+        self.parameters = None
+        logger.info('Connected to %d transport workers', len(self.connections))
+
+    @classmethod
+    def from_config(cls, montecarlo_config):
+        """
+        Connect to the workers given in the montecarlo section of the configuration or start a local cluster of
+        no_of_processes workers if none are given.
+        """
+        if montecarlo_config.workers:
+            if not montecarlo_config.worker_authkey:
+                raise ValueError('The distributed backend needs a worker_authkey to connect to remote workers')
+            return cls(montecarlo_config.workers, montecarlo_config.worker_authkey)
+
+        no_of_workers = montecarlo_config.no_of_processes
+        if no_of_workers < 1:
+            no_of_workers = multiprocessing.cpu_count()
+        local_cluster = LocalTransportCluster(no_of_workers, nthreads=montecarlo_config.nthreads)
+        return cls(local_cluster.addresses, local_cluster.authkey, local_cluster=local_cluster)
+
+    def send_plasma(self, arrays, parameters):
+        """
+        Send the transport inputs of an iteration to every worker.
+
+        Parameters are the same as for `tardis.montecarlo.process_pool.TransportPool.send_plasma`.
+        """
+        for connection in self.connections:
+            connection.send(('plasma', arrays, parameters))
+        self.arrays = arrays
+        self.parameters = parameters
+
+    def transport(self, packet_nus, packet_mus, packet_energies, first_packet_id=0, virtual_packet_flag=0,
+                  j_blues=None, spectrum_virt_nu=None, event_counters=None):
+        """
+        Transport packets on the workers with the inputs of the last `send_plasma`.
+
+        Every worker gets one batch of whole chunks of packets. Parameters and return values are the same as for
+        `tardis.montecarlo.process_pool.TransportPool.transport`.
+        """
+        if self.parameters is None:
+            raise ValueError('The transport inputs have to be sent with send_plasma first')
+        j_blues, spectrum_virt_nu, event_counters = get_estimator_targets(self.arrays, self.parameters, j_blues,
+                                                                          spectrum_virt_nu, event_counters)
+
+        batch_boundaries = get_batch_boundaries(len(packet_nus), len(self.connections))
+        connections = self.connections[:len(batch_boundaries) - 1]
+        for connection, batch_start, batch_end in zip(connections, batch_boundaries[:-1], batch_boundaries[1:]):
+            packets = slice(batch_start, batch_end)
+            connection.send(('transport', packet_nus[packets], packet_mus[packets], packet_energies[packets],
+                             first_packet_id + int(batch_start), virtual_packet_flag))
+
+        # receive every reply before raising, so the connections stay in sync
+        replies = [connection.recv() for connection in connections]
+        for status, result in replies:
+            if status == 'error':
+                raise RuntimeError('Transport worker failed: %s' % result)
+        return add_chunk_results([chunk_result for status, chunk_results in replies for chunk_result in chunk_results],
+                                 j_blues, spectrum_virt_nu, event_counters)
+
+    def close(self):
+        """
+        Close the connections to the workers and shut down the workers of a local cluster.
+        """
+        command = 'close' if self.local_cluster is None else 'shutdown'
+        for connection in self.connections:
+            connection.send((command,))
+            connection.close()
+        self.connections = []
+        if self.local_cluster is not None:
+            self.local_cluster.join()
@@ -0,0 +1,128 @@
+"""
+Synthesize the spectrum with the formal integral of the emergent intensity.
+
+Instead of binning escaping or virtual packets, the luminosity density is
+integrated from the plasma state (Lucy 1999, A&A 345, 211). Every line a ray
+comes into resonance with attenuates the intensity by exp(-tau_sobolev) and
+adds (1 - exp(-tau_sobolev)) S, with the line source function S estimated by
+the Monte Carlo transport. For a resonance scattering line with escape
+probability beta, the mean intensity in the line is
+(1 - beta) S + beta J_blue = S, so S is the j_blue estimator of the line.
+This only holds for line_interaction_type scatter; with downbranch or
+macroatom the emission of a line is not its absorbed intensity.
+The result has no Monte Carlo noise beyond the one of the source functions.
+"""
+
+import numpy as np
+from astropy import units as u
+
+from tardis.montecarlo import montecarlo
+from tardis.util import intensity_black_body
+
+
+def get_impact_parameters(r_photosphere, r_max, no_of_impact_parameters):
+    """
+    Midpoints and widths of equally spaced impact parameter cells, half of them covering the photosphere.
+
+    The edge of the photosphere, where the intensity jumps, is a cell boundary.
+
+    Returns
+    -------
+    impact_parameters, widths : `numpy.ndarray`
+    """
+    no_of_core_impact_parameters = max(no_of_impact_parameters // 2, 1)
+    no_of_envelope_impact_parameters = max(no_of_impact_parameters - no_of_core_impact_parameters, 1)
+    edges = np.hstack((np.linspace(0.0, r_photosphere, no_of_core_impact_parameters + 1),
+                       np.linspace(r_photosphere, r_max, no_of_envelope_impact_parameters + 1)[1:]))
+    return 0.5 * (edges[1:] + edges[:-1]), np.diff(edges)
+
+
+def integrate_luminosity_density(nus, r_inner, r_outer, time_explosion, line_list_nu, tau_sobolevs,
+                                 source_functions, inner_intensities, no_of_impact_parameters=100, nthreads=1):
+    """
+    Integrate the emergent luminosity density, L_nu = 8 pi^2 int I(p) p dp.
+
+    Parameters
+    ----------
+    nus : `numpy.ndarray`
+        observer frame frequencies
+    r_inner, r_outer : `numpy.ndarray`
+        inner and outer radii of the shells in cm
+    time_explosion : float
+        time since the explosion in s
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from blue to red
+    tau_sobolevs, source_functions : `numpy.ndarray`
+        tau_sobolevs and line source functions (shells x lines)
+    inner_intensities : `numpy.ndarray`
+        intensity of the photosphere at every frequency
+    no_of_impact_parameters : int
+        number of rays per frequency
+    nthreads : int
+        number of OpenMP threads
+
+    Returns
+    -------
+    luminosity_density : `numpy.ndarray`
+        luminosity density in erg / (s Hz)
+    """
+    impact_parameters, widths = get_impact_parameters(r_inner[0], r_outer[-1], no_of_impact_parameters)
+    exp_tau_sobolevs = np.exp(-np.asarray(tau_sobolevs, dtype=np.float64))
+    attenuated_source_functions = (1.0 - exp_tau_sobolevs) * source_functions
+    intensities = montecarlo.formal_integral(np.ascontiguousarray(nus, dtype=np.float64), impact_parameters,
+                                             np.ascontiguousarray(r_inner, dtype=np.float64),
+                                             np.ascontiguousarray(r_outer, dtype=np.float64), time_explosion,
+                                             np.ascontiguousarray(line_list_nu, dtype=np.float64),
+                                             np.ascontiguousarray(exp_tau_sobolevs),
+                                             np.ascontiguousarray(attenuated_source_functions, dtype=np.float64),
+                                             np.ascontiguousarray(inner_intensities, dtype=np.float64),
+                                             nthreads=nthreads)
+    return 8 * np.pi ** 2 * intensities.dot(impact_parameters * widths)
+
+
+def calculate_line_source_functions(model):
+    """
+    Line source functions from the j_blue estimators of the last transport (shells x lines).
+
+    Lines without an estimator get the dilute blackbody source function W B(T_rad) of the shell.
+
+    Raises
+    ------
+    ValueError
+        if the lines do not scatter resonantly, so that the j_blue estimators are not the source functions
+    """
+    line_interaction_type = model.tardis_config.plasma.line_interaction_type
+    if line_interaction_type != 'scatter':
+        raise ValueError('The formal integral needs line_interaction_type scatter, the source functions of '
+                         'line_interaction_type %s are not estimated' % line_interaction_type)
+    source_functions = model.ws[:, np.newaxis] * intensity_black_body(model.atom_data.lines.nu.values,
+                                                                      model.t_rads.value[:, np.newaxis])
+    source_functions[:, model.j_blue_estimator_lines] = (model.j_blue_estimators *
+                                                         model.j_blues_norm_factor.value[:, np.newaxis])
+    return source_functions
+
+
+def calculate_formal_integral_luminosity(model):
+    """
+    Luminosity of every bin of the spectrum of a model, integrated at the bin centres.
+
+    Parameters
+    ----------
+    model : `tardis.model.Radial1DModel`
+
+    Returns
+    -------
+    luminosity : `astropy.units.Quantity`
+        luminosity in erg / s per bin, as `tardis.model.TARDISSpectrum.update_luminosity` expects it
+    """
+    frequency = model.tardis_config.spectrum.frequency.value
+    nus = 0.5 * (frequency[1:] + frequency[:-1])
+    luminosity_density = integrate_luminosity_density(
+        nus, model.tardis_config.structure.r_inner.to('cm').value,
+        model.tardis_config.structure.r_outer.to('cm').value,
+        model.tardis_config.supernova.time_explosion.to('s').value, model.atom_data.lines.nu.values,
+        model.plasma_array.tau_sobolevs.values.T, calculate_line_source_functions(model),
+        intensity_black_body(nus, model.t_inner.value),
+        no_of_impact_parameters=model.tardis_config.montecarlo.formal_integral_impact_parameters,
+        nthreads=model.tardis_config.montecarlo.nthreads)
+    return luminosity_density * (frequency[1] - frequency[0]) * u.erg / u.s
@@ -6,6 +6,7 @@
 
 import logging
 import time
+from collections import namedtuple
 
 import numpy as np
 cimport numpy as np
@@ -13,14 +14,29 @@ from astropy import constants
 
 np.import_array()
 
+logger = logging.getLogger(__name__)
+
 ctypedef np.int64_t int_type_t
 
 cdef extern from "src/cmontecarlo.h":
+    int TARDIS_WITH_OPENMP
+    int TARDIS_PACKET_CHUNK_SIZE
+
+    ctypedef enum tardis_error_t:
+        TARDIS_ERROR_OK = 0
+        TARDIS_ERROR_BOUNDS_ERROR = 1
+        TARDIS_ERROR_COMOV_NU_LESS_THAN_NU_LINE = 2
+        TARDIS_ERROR_ALLOCATION_FAILED = 3
+
     ctypedef enum rpacket_status_t:
         TARDIS_PACKET_STATUS_IN_PROCESS = 0
         TARDIS_PACKET_STATUS_EMITTED = 1
         TARDIS_PACKET_STATUS_REABSORBED = 2
 
+    ctypedef enum transport_kernel_t:
+        TARDIS_TRANSPORT_KERNEL_PACKET = 0
+        TARDIS_TRANSPORT_KERNEL_EVENT = 1
+
     ctypedef struct rpacket_t:
         double nu
         double mu
@@ -40,10 +56,36 @@ cdef extern from "src/cmontecarlo.h":
         double d_boundary
         rpacket_status_t next_shell_id
 
+    ctypedef struct philox_state_t:
+        pass
+
+    ctypedef struct line_index_t:
+        double log_nu_max
+        double inverse_bucket_width
+        int_type_t no_of_buckets
+        int_type_t *bucket_starts
+
+    ctypedef struct packet_trace_record_t:
+        int_type_t packet_id
+        int_type_t iteration
+        int_type_t event_type
+        int_type_t shell_id
+        double r
+        double mu
+        double nu
+        int_type_t line_id
+
+    ctypedef struct estimator_log_t:
+        pass
+
     ctypedef struct storage_model_t:
         double *packet_nus
         double *packet_mus
         double *packet_energies
+        double *packet_source_cdf
+        double *packet_source_nus
+        int_type_t packet_source_size
+        double packet_energy
         double *output_nus
         double *output_energies
         int_type_t *last_line_interaction_in_id
@@ -61,12 +103,21 @@ cdef extern from "src/cmontecarlo.h":
         double *inverse_electron_densities
         double *line_list_nu
         double *line_lists_tau_sobolevs
+        float *line_lists_tau_sobolevs_single
+        double *cumulative_line_tau_sobolevs
+        int_type_t *next_active_line_ids
+        int_type_t cumulative_tau_real_packets
         int_type_t line_lists_tau_sobolevs_nd
         double *line_lists_j_blues
+        float *line_lists_j_blues_single
         int_type_t line_lists_j_blues_nd
+        int_type_t *j_blue_line_ids
+        int_type_t *j_blue_lines
         int_type_t no_of_lines
+        line_index_t line_index
         int_type_t line_interaction_id
-        double *transition_probabilities
+        double *cumulative_transition_probabilities
+        float *cumulative_transition_probabilities_single
         int_type_t transition_probabilities_nd
         int_type_t *line2macro_level_upper
         int_type_t *macro_block_references
@@ -79,117 +130,639 @@ cdef extern from "src/cmontecarlo.h":
         double spectrum_delta_nu
         double spectrum_end_nu
         double *spectrum_virt_nu
+        int_type_t spectrum_virt_nu_size
         double sigma_thomson
         double inverse_sigma_thomson
         double inner_boundary_albedo
+        double virtual_packet_roulette_tau
+        double virtual_packet_roulette_survival
         int_type_t reflective_inner_boundary
+        int_type_t *event_counters
+        packet_trace_record_t *packet_trace
+        int_type_t packet_trace_size
+        int_type_t packet_trace_stride
+        int_type_t *packet_trace_position
+        int_type_t packet_trace_iteration
+        estimator_log_t *j_blue_log
+        estimator_log_t *spectrum_virt_nu_log
         int_type_t current_packet_id
+        int_type_t first_packet_id
+        transport_kernel_t transport_kernel
 
-    int_type_t montecarlo_one_packet(storage_model_t *storage, rpacket_t *packet, int_type_t virtual_mode)
-    int rpacket_init(rpacket_t *packet, storage_model_t *storage, int packet_index, int virtual_packet_flag)
+    ctypedef void (*montecarlo_progress_callback_t)(int_type_t packets_done, double packets_per_second,
+                                                    void *data) with gil
+
+    void line_index_init(line_index_t *index, double *nu, int_type_t number_of_lines, int_type_t no_of_buckets,
+                         int_type_t *bucket_starts, bint fill_buckets)
+    tardis_error_t line_search(double *nu, double nu_insert, int_type_t number_of_lines, line_index_t *index,
+                               int_type_t *result)
+    int rpacket_init(rpacket_t *packet, storage_model_t *storage, int_type_t packet_index, int virtual_packet_flag,
+                     philox_state_t *rng_state)
     double rpacket_get_nu(rpacket_t *packet)
     double rpacket_get_energy(rpacket_t *packet)
-    void initialize_random_kit(unsigned long seed)
+    tardis_error_t montecarlo_main_loop(storage_model_t *storage, int_type_t virtual_packet_flag, int nthreads,
+                                        unsigned long seed, int_type_t iteration,
+                                        montecarlo_progress_callback_t progress_callback, double progress_interval,
+                                        void *progress_data) nogil
 
+cdef extern from "src/formal_integral.h":
+    void c_formal_integral "formal_integral"(double *nus, int_type_t no_of_nus, double *impact_parameters,
+                                             int_type_t no_of_impact_parameters, double *r_inner, double *r_outer,
+                                             int_type_t no_of_shells, double time_explosion, double *line_list_nu,
+                                             int_type_t no_of_lines, double *exp_tau_sobolevs,
+                                             double *attenuated_source_functions, double *inner_intensities,
+                                             double *intensities, int nthreads) nogil
 
+cdef extern from "src/randomkit/randomkit.h":
+    ctypedef struct rk_state:
+        pass
+    ctypedef struct rk_sobol_state:
+        pass
+    ctypedef enum rk_sobol_error:
+        RK_SOBOL_OK
+    char *rk_sobol_strerror[]
+    unsigned long *rk_sobol_Ldirections
+    void rk_seed(unsigned long seed, rk_state *state)
+    rk_sobol_error rk_sobol_init(size_t dimension, rk_sobol_state *s, rk_state *rs_dir,
+                                 unsigned long *directions, unsigned long *polynomials)
+    void rk_sobol_randomshift(rk_sobol_state *s, rk_state *rs_num)
+    rk_sobol_error rk_sobol_double(rk_sobol_state *s, double *x) nogil
+    void rk_sobol_free(rk_sobol_state *s)
 
-def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
+
+TransportResult = namedtuple('TransportResult', ['output_nus', 'output_energies', 'js', 'nubars', 'j_blues',
+                                                 'spectrum_virt_nu', 'last_line_interaction_in_id',
+                                                 'last_line_interaction_out_id', 'last_interaction_type',
+                                                 'last_line_interaction_shell_id', 'event_counters'])
+# namedtuple can not find the module of a Cython caller, which pickling the results of the workers needs
+TransportResult.__module__ = __name__
+
+# Scalar parameters of `transport` that have a default (the defaults of the montecarlo configuration)
+DEFAULT_TRANSPORT_OPTIONS = dict(line_interaction_type='scatter',
+                                 sigma_thomson=6.652486e-25,
+                                 reflective_inner_boundary=False,
+                                 inner_boundary_albedo=0.0,
+                                 virtual_packet_roulette_tau=0.0,
+                                 virtual_packet_roulette_survival=0.1,
+                                 seed=23111963,
+                                 iteration=0,
+                                 transport_kernel='packet',
+                                 cumulative_line_tau=False,
+                                 count_events=False)
+
+# Columns of the event counters (shells x counters), in the order of event_counter_t
+EVENT_COUNTER_NAMES = ['line_interactions', 'electron_scatters', 'boundary_crossings', 'macro_atom_jumps',
+                       'virtual_packets', 'line_steps']
+
+# Number of packets whose estimators `transport_packets` adds to the given ones at a time
+PACKET_CHUNK_SIZE = TARDIS_PACKET_CHUNK_SIZE
+
+
+cdef void call_progress_callback(int_type_t packets_done, double packets_per_second, void *data) with gil:
+    (<object> data)(packets_done, packets_per_second)
+
+
+
+def get_transport_arrays(model, virtual_packet_flag=0):
     """
+    Collect the read-only arrays that the packet transport needs from the model.
+
+    The arrays are kept in the `TransportContext` of the model (``model.transport_context``, created by the first
+    call), so the arrays of the previous call are overwritten.
+
     Parameters
     ----------
-    model : `tardis.model_radial_oned.ModelRadial1D`
-        complete model
-    param photon_packets : PacketSource object
-        photon packets
+    model : `tardis.model.Radial1DModel`
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction by the transport the arrays are for; the cumulative
+        tau_sobolevs are only tabulated if virtual packets are spawned or the real packets use them
 
     Returns
     -------
-    output_nus : `numpy.ndarray`
-    output_energies : `numpy.ndarray`
+    arrays : dict
+        arrays keyed by the name of the corresponding `storage_model_t` field. The
+        macro atom arrays are only present for the downbranch and macroatom line
+        interaction types.
+    """
+    if model.transport_context is None:
+        model.transport_context = TransportContext(model)
+    return model.transport_context.update(model, virtual_packet_flag=virtual_packet_flag)
+
+
+class TransportContext(object):
+    """
+    Transport input arrays of a model that are reused across iterations.
+
+    The geometry, the line list and the macro atom tables do not change between iterations and are collected
+    once. `update` copies the plasma arrays that change every iteration into buffers that are allocated by the
+    first call and reused afterwards.
+
+    Parameters
+    ----------
+    model : `tardis.model.Radial1DModel`
+    """
+
+    def __init__(self, model):
+        structure = model.tardis_config.structure
+        self.static_arrays = {}
+        self.static_arrays['r_inner'] = structure.r_inner.to('cm').value
+        self.static_arrays['r_outer'] = structure.r_outer.to('cm').value
+        self.static_arrays['v_inner'] = structure.v_inner.to('cm/s').value
+        self.static_arrays['line_list_nu'] = model.atom_data.lines.nu.values
+        self.static_arrays['line_bucket_starts'] = get_line_bucket_starts(self.static_arrays['line_list_nu'])
+        if get_line_interaction_id(model.tardis_config.plasma.line_interaction_type) >= 1:
+            self.static_arrays['line2macro_level_upper'] = model.atom_data.lines_upper2macro_reference_idx
+            self.static_arrays['macro_block_references'] = get_macro_block_references(
+                model.atom_data.macro_atom_references['block_references'].values,
+                len(model.atom_data.macro_atom_data))
+            self.static_arrays['transition_type'] = model.atom_data.macro_atom_data['transition_type'].values
+            # Destination level is not needed and/or generated for downbranch
+            self.static_arrays['destination_level_id'] = \
+                model.atom_data.macro_atom_data['destination_level_idx'].values
+            self.static_arrays['transition_line_id'] = model.atom_data.macro_atom_data['lines_idx'].values
+        self.buffers = {}
+
+    def get_buffer(self, name, shape, dtype=np.float64):
+        """
+        C contiguous buffer of the given name, (re)allocated if its shape or dtype does not match.
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def copy_to_buffer(self, name, array):
+        """
+        Copy an array into the buffer of the given name.
+        """
+        buffer = self.get_buffer(name, array.shape, array.dtype)
+        buffer[...] = array
+        return buffer
+
+    def update(self, model, virtual_packet_flag=0):
+        """
+        Copy the current plasma arrays of the model into the buffers.
+
+        Parameters
+        ----------
+        model : `tardis.model.Radial1DModel`
+        virtual_packet_flag : int
+            number of virtual packets spawned per interaction
+
+        Returns
+        -------
+        arrays : dict
+            as returned by `get_transport_arrays`
+        """
+        montecarlo_config = model.tardis_config.montecarlo
+        arrays = dict(self.static_arrays)
+        arrays['electron_densities'] = self.copy_to_buffer('electron_densities',
+                                                           model.plasma_array.electron_densities.values)
+        arrays['inverse_electron_densities'] = np.divide(
+            1.0, arrays['electron_densities'],
+            out=self.get_buffer('inverse_electron_densities', arrays['electron_densities'].shape))
+        arrays['line_lists_tau_sobolevs'] = self.copy_to_buffer('line_lists_tau_sobolevs',
+                                                                model.plasma_array.tau_sobolevs.values.transpose())
+        line_tau_threshold = montecarlo_config.line_tau_threshold
+        if line_tau_threshold > 0:
+            if get_line_interaction_id(model.tardis_config.plasma.line_interaction_type) != 0:
+                raise ValueError('Pruning thin lines needs the line_interaction_type scatter')
+            merged_tau_sobolevs, next_active_line_ids, model.pruned_line_tau_sobolevs = \
+                prune_thin_lines(arrays['line_lists_tau_sobolevs'], line_tau_threshold,
+                                 kept_lines=model.j_blue_estimator_lines)
+            arrays['line_lists_tau_sobolevs'] = self.copy_to_buffer('line_lists_tau_sobolevs', merged_tau_sobolevs)
+            arrays['next_active_line_ids'] = self.copy_to_buffer('next_active_line_ids', next_active_line_ids)
+            no_of_lines = next_active_line_ids.shape[1] - 1
+            logger.info('Pruned lines with tau_sobolev < %g: %.1f%% of the lines remain active, '
+                        'pruned tau_sobolev per shell <= %.2g', line_tau_threshold,
+                        100. * (next_active_line_ids[:, :-1] == np.arange(no_of_lines)).mean(),
+                        model.pruned_line_tau_sobolevs.max())
+        # virtual packets always integrate their line optical depths with the cumulative tables
+        if montecarlo_config.cumulative_line_tau or virtual_packet_flag > 0:
+            no_of_shells, no_of_lines = arrays['line_lists_tau_sobolevs'].shape
+            arrays['cumulative_line_tau_sobolevs'] = get_cumulative_line_tau_sobolevs(
+                arrays['line_lists_tau_sobolevs'],
+                out=self.get_buffer('cumulative_line_tau_sobolevs', (no_of_shells, no_of_lines + 1)))
+        arrays['j_blue_line_ids'] = get_j_blue_line_ids(model.j_blue_estimator_lines, arrays['line_list_nu'].size)
+        if get_line_interaction_id(model.tardis_config.plasma.line_interaction_type) >= 1:
+            arrays['cumulative_transition_probabilities'] = self.copy_to_buffer(
+                'cumulative_transition_probabilities',
+                model.plasma_array.cumulative_transition_probabilities.transpose())
+        if model.packet_src.generate_in_kernel:
+            arrays['packet_source_cdf'], arrays['packet_source_nus'] = model.packet_src.packet_source_table
+        return arrays
+
+
+def get_line_bucket_starts(np.ndarray[double, ndim=1] line_list_nu):
+    """
+    Build the log-frequency bucket index of a line list (one bucket per line).
+
+    Parameters
+    ----------
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from blue to red
+
+    Returns
+    -------
+    bucket_starts : `numpy.ndarray`
+        index of the first line of every bucket, followed by the number of lines
+    """
+    cdef line_index_t line_index
+    cdef np.ndarray[int_type_t, ndim=1] bucket_starts = np.zeros(max(line_list_nu.size, 1) + 1, dtype=np.int64)
+    line_index_init(&line_index, <double*> line_list_nu.data, line_list_nu.size, bucket_starts.size - 1,
+                    <int_type_t*> bucket_starts.data, True)
+    return bucket_starts
+
+
+def find_next_line_ids(np.ndarray[double, ndim=1] line_list_nu, np.ndarray[double, ndim=1] nus,
+                       np.ndarray[int_type_t, ndim=1] line_bucket_starts=None):
+    """
+    Find the next line to the red of every frequency with the bucket index of the line list.
+
+    Parameters
+    ----------
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from blue to red
+    nus : `numpy.ndarray`
+        (comoving) frequencies to look up
+    line_bucket_starts : `numpy.ndarray`, optional
+        bucket index as returned by `get_line_bucket_starts`, built if not given
+
+    Returns
+    -------
+    next_line_ids : `numpy.ndarray`
+        index of the first line with a frequency below each of nus, the number of
+        lines if there is none
+    """
+    cdef line_index_t line_index
+    cdef np.ndarray[int_type_t, ndim=1] next_line_ids = np.empty(nus.size, dtype=np.int64)
+    cdef int_type_t i
+    if line_bucket_starts is None:
+        line_bucket_starts = get_line_bucket_starts(line_list_nu)
+    line_index_init(&line_index, <double*> line_list_nu.data, line_list_nu.size, line_bucket_starts.size - 1,
+                    <int_type_t*> line_bucket_starts.data, False)
+    for i in range(nus.size):
+        line_search(<double*> line_list_nu.data, nus[i], line_list_nu.size, &line_index,
+                    <int_type_t*> next_line_ids.data + i)
+    return next_line_ids
+
+
+def prune_thin_lines(line_lists_tau_sobolevs, line_tau_threshold, kept_lines=None):
+    """
+    Remove the optically thin lines of every shell from the lines the packets step through.
+
+    The optical depth of the thin lines is merged into the next active (tau_sobolev >=
+    line_tau_threshold) line to the red in the same shell, so the total line optical depth
+    between two active lines is kept; thin lines redward of the last active line are dropped.
+    An interaction with a thin line therefore happens at the next active line instead, with
+    the frequency and the interaction of that line. This is a known bias: for resonance
+    scattering the packet is re-emitted at the frequency of the active line, shifted by at most
+    the spacing to that line; for downbranch and macroatom the emission would also come from the
+    wrong upper level, so pruning is only used with line_interaction_type scatter.
+
+    Parameters
+    ----------
+    line_lists_tau_sobolevs : `numpy.ndarray`
+        tau_sobolevs (shells x lines)
+    line_tau_threshold : float
+    kept_lines : `numpy.ndarray`, optional
+        indices of lines that stay active in every shell, e.g. the lines with j_blue estimators
+
+    Returns
+    -------
+    merged_tau_sobolevs : `numpy.ndarray`
+        tau_sobolevs (shells x lines) of the active lines including the merged thin lines, 0 for
+        the thin lines
+    next_active_line_ids : `numpy.ndarray`
+        (shells x (lines + 1)), element [i, j] is the first active line of shell i at or
+        after line j, or the number of lines if there is none
+    pruned_tau_sobolevs : `numpy.ndarray`
+        total tau_sobolev of the thin lines of every shell. 1 - exp(-pruned_tau_sobolevs) bounds
+        the probability that an interaction of a packet crossing the shell is moved to another
+        line or lost.
+    """
+    no_of_shells, no_of_lines = line_lists_tau_sobolevs.shape
+    line_ids = np.arange(no_of_lines)
+    shell_ids = np.arange(no_of_shells)[np.newaxis].T
+    active = line_lists_tau_sobolevs >= line_tau_threshold
+    if kept_lines is not None:
+        active[:, kept_lines] = True
+    thin_tau_sobolevs = np.where(active, 0.0, line_lists_tau_sobolevs)
+    cumulative_thin_tau_sobolevs = np.hstack((np.zeros((no_of_shells, 1)), np.cumsum(thin_tau_sobolevs, axis=1)))
+
+    # the thin lines merged into an active line start after the previous active line
+    previous_active_line_ids = np.maximum.accumulate(np.where(active, line_ids, -1), axis=1)
+    merge_start_ids = np.hstack((np.zeros((no_of_shells, 1), dtype=np.int64),
+                                 previous_active_line_ids[:, :-1] + 1))
+    merged_tau_sobolevs = np.where(active, line_lists_tau_sobolevs + cumulative_thin_tau_sobolevs[:, :-1] -
+                                   cumulative_thin_tau_sobolevs[shell_ids, merge_start_ids], 0.0)
+
+    next_active_line_ids = np.minimum.accumulate(np.where(active, line_ids, no_of_lines)[:, ::-1], axis=1)[:, ::-1]
+    next_active_line_ids = np.hstack((next_active_line_ids, np.full((no_of_shells, 1), no_of_lines, dtype=np.int64)))
+    return (np.ascontiguousarray(merged_tau_sobolevs, dtype=line_lists_tau_sobolevs.dtype),
+            np.ascontiguousarray(next_active_line_ids, dtype=np.int64),
+            thin_tau_sobolevs.sum(axis=1))
+
+
+def get_cumulative_line_tau_sobolevs(line_lists_tau_sobolevs, out=None):
+    """
+    Cumulative sums of the tau_sobolevs of every shell along the line list.
+
+    Parameters
+    ----------
+    line_lists_tau_sobolevs : `numpy.ndarray`
+        tau_sobolevs (shells x lines)
+    out : `numpy.ndarray`, optional
+        C contiguous float64 array (shells x (lines + 1)) to store the result in
 
-    TODO
-                    np.ndarray[double, ndim=1] line_list_nu,
-                    np.ndarray[double, ndim=2] tau_lines,
-                    np.ndarray[double, ndim=1] ne,
-                    double packet_energy,
-                    np.ndarray[double, ndim=2] p_transition,
-                    np.ndarray[int_type_t, ndim=1] type_transition,
-                    np.ndarray[int_type_t, ndim=1] target_level_id,
-                    np.ndarray[int_type_t, ndim=1] target_line_id,
-                    np.ndarray[int_type_t, ndim=1] unroll_reference,
-                    np.ndarray[int_type_t, ndim=1] line2level,
-                    int_type_t log_packets,
-                    int_type_t do_scatter
+    Returns
+    -------
+    cumulative_line_tau_sobolevs : `numpy.ndarray`
+        (shells x (lines + 1)), element [i, j] is the sum of the first j
+        tau_sobolevs of shell i
+    """
+    no_of_shells, no_of_lines = line_lists_tau_sobolevs.shape
+    if out is None:
+        out = np.empty((no_of_shells, no_of_lines + 1))
+    out[:, 0] = 0.0
+    # summed in double precision also for single precision tau_sobolevs
+    np.cumsum(line_lists_tau_sobolevs, axis=1, dtype=np.float64, out=out[:, 1:])
+    return out
+
+
+def get_j_blue_line_ids(j_blue_estimator_lines, no_of_lines):
+    """
+    Map the lines to the columns of a j_blue estimator array that only holds the given lines.
+
+    Parameters
+    ----------
+    j_blue_estimator_lines : `numpy.ndarray`
+        sorted indices of the lines whose j_blue estimators are accumulated
+    no_of_lines : int
+
+    Returns
+    -------
+    j_blue_line_ids : `numpy.ndarray`
+        column of the j_blue estimator of every line, -1 for the other lines
+    """
+    j_blue_line_ids = -1 * np.ones(no_of_lines, dtype=np.int64)
+    j_blue_line_ids[j_blue_estimator_lines] = np.arange(len(j_blue_estimator_lines))
+    return j_blue_line_ids
+
+
+def is_single_precision(array):
+    """
+    True for a float32 array, False for a float64 array.
+
+    The tau_sobolevs, the j_blue estimators and the cumulative transition probabilities can be stored in either
+    precision.
+    """
+    if array.dtype == np.float32:
+        return True
+    elif array.dtype == np.float64:
+        return False
+    else:
+        raise ValueError('Storage arrays have to be float32 or float64, not %s' % array.dtype)
+
+
+def get_transport_parameters(model):
+    """
+    Collect the scalar parameters of the packet transport from the model.
+
+    Parameters
+    ----------
+    model : `tardis.model.Radial1DModel`
+
+    Returns
+    -------
+    parameters : dict
+    """
+    frequency = model.tardis_config.spectrum.frequency.value
+    return dict(time_explosion=model.tardis_config.supernova.time_explosion.to('s').value,
+                line_interaction_id=get_line_interaction_id(model.tardis_config.plasma.line_interaction_type),
+                spectrum_start_nu=frequency.min(),
+                spectrum_end_nu=frequency.max(),
+                spectrum_delta_nu=frequency[1] - frequency[0],
+                spectrum_virt_nu_size=model.montecarlo_virtual_luminosity.size,
+                sigma_thomson=model.tardis_config.montecarlo.sigma_thomson.to('1/cm^2').value,
+                reflective_inner_boundary=model.tardis_config.montecarlo.enable_reflective_inner_boundary,
+                inner_boundary_albedo=model.tardis_config.montecarlo.inner_boundary_albedo,
+                virtual_packet_roulette_tau=model.tardis_config.montecarlo.virtual_packet_roulette_tau,
+                virtual_packet_roulette_survival=model.tardis_config.montecarlo.virtual_packet_roulette_survival,
+                seed=model.tardis_config.montecarlo.seed,
+                transport_kernel=model.tardis_config.montecarlo.transport_kernel,
+                cumulative_line_tau=model.tardis_config.montecarlo.cumulative_line_tau,
+                count_events=model.tardis_config.montecarlo.count_events,
+                packet_energy=model.packet_src.packet_energy,
+                iteration=model.iterations_executed)
+
+
+def get_line_interaction_id(line_interaction_type):
+    if line_interaction_type == 'scatter':
+        return 0
+    elif line_interaction_type == 'downbranch':
+        return 1
+    elif line_interaction_type == 'macroatom':
+        return 2
+    else:
+        return -99
+
+
+def get_transport_kernel_id(transport_kernel):
+    if transport_kernel == 'packet':
+        return TARDIS_TRANSPORT_KERNEL_PACKET
+    elif transport_kernel == 'event':
+        return TARDIS_TRANSPORT_KERNEL_EVENT
+    else:
+        raise ValueError('Unknown transport kernel %r' % transport_kernel)
+
+
+def transport_packets(arrays, parameters, np.ndarray[double, ndim=1] packet_nus,
+                      np.ndarray[double, ndim=1] packet_mus, np.ndarray[double, ndim=1] packet_energies,
+                      int_type_t first_packet_id=0, int_type_t virtual_packet_flag=0, int nthreads=1,
+                      int_type_t no_of_packets=-1, np.ndarray j_blues=None, np.ndarray[double, ndim=1] spectrum_virt_nu=None,
+                      np.ndarray[int_type_t, ndim=2] event_counters=None, packet_trace=None, progress_callback=None, double progress_interval=10.0):
+    """
+    Transport a set of packets through the ejecta.
+
+    The packets are transported in chunks of `PACKET_CHUNK_SIZE`, counted from the first packet of the call.
+    The estimators of every chunk are summed separately and then added to the given estimators in chunk
+    order, so the result does not depend on nthreads and equals transporting every chunk into zeroed
+    estimators and adding those to the given ones one after the other.
+
+    Parameters
+    ----------
+    arrays : dict
+        input arrays as returned by `get_transport_arrays`
+    parameters : dict
+        scalar parameters as returned by `get_transport_parameters`
+    packet_nus, packet_mus, packet_energies : `numpy.ndarray` or None
+        properties of the packets. If they are None, the kernel generates `no_of_packets` packets from the first
+        two numbers of their random streams: the frequencies from the cumulative distribution
+        ``arrays['packet_source_cdf']`` (from 0 to 1) tabulated at ``arrays['packet_source_nus']``, mu as the
+        square root of a uniform number and all with the energy ``parameters['packet_energy']``.
+    first_packet_id : int
+        index of the first packet within the iteration, selects the random number
+        streams of the packets
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction
+    nthreads : int
+        number of OpenMP threads
+    no_of_packets : int
+        number of packets to generate if packet_nus is None
+    j_blues : `numpy.ndarray`, optional
+        j_blue estimators (shells x lines) to add to, allocated with the precision of the tau_sobolevs if not
+        given. If ``arrays['j_blue_line_ids']`` is given, only the lines with a column there are estimated and
+        j_blues has one column per such line. The tau_sobolevs, the j_blues and the cumulative transition probabilities can each be float32 or
+        float64; the estimators of the packets are accumulated in float64 either way.
+    spectrum_virt_nu : `numpy.ndarray`, optional
+        virtual packet spectrum to add to, allocated if not given
+    event_counters : `numpy.ndarray`, optional
+        event counters (shells x `EVENT_COUNTER_NAMES`) to add to, allocated if not given. The events of the
+        real packets are only counted if ``parameters['count_events']`` is set.
+    packet_trace : `tardis.montecarlo.packet_trace.PacketTrace`, optional
+        ring buffer to write the events of every ``packet_trace.stride``-th real packet to
+    progress_callback : callable, optional
+        called as ``progress_callback(packets_done, packets_per_second)`` at most every
+        `progress_interval` seconds. The transport itself runs without the GIL, so other
+        Python threads keep running in the meantime.
+    progress_interval : float
+        minimum time between two calls of `progress_callback` in seconds
+
+    Returns
+    -------
+    result : `TransportResult`
+        output_nus, output_energies, js, nubars, j_blues, spectrum_virt_nu,
+        last_line_interaction_in_id, last_line_interaction_out_id, last_interaction_type,
+        last_line_interaction_shell_id, event_counters (None if the events are not counted)
     """
     cdef storage_model_t storage
-    cdef rpacket_t packet
-    initialize_random_kit(model.tardis_config.montecarlo.seed)
-    cdef np.ndarray[double, ndim=1] packet_nus = model.packet_src.packet_nus
-    storage.packet_nus = <double*> packet_nus.data
-    cdef np.ndarray[double, ndim=1] packet_mus = model.packet_src.packet_mus
-    storage.packet_mus = <double*> packet_mus.data
-    cdef np.ndarray[double, ndim=1] packet_energies = model.packet_src.packet_energies
-    storage.packet_energies = <double*> packet_energies.data
-    storage.no_of_packets = packet_nus.size
+    cdef np.ndarray[double, ndim=1] packet_source_cdf = arrays.get('packet_source_cdf')
+    cdef np.ndarray[double, ndim=1] packet_source_nus = arrays.get('packet_source_nus')
+    if packet_nus is None:
+        if packet_source_cdf is None or packet_source_nus is None or no_of_packets < 0:
+            raise ValueError('Generating the packets in the kernel needs the packet source table and no_of_packets')
+        if (packet_source_nus.size != packet_source_cdf.size or packet_source_cdf.size < 2 or
+                packet_source_cdf[0] != 0.0 or packet_source_cdf[packet_source_cdf.size - 1] != 1.0):
+            raise ValueError('The packet source table needs a cumulative distribution from 0 to 1 and one '
+                             'frequency per value')
+        storage.packet_nus = NULL
+        storage.packet_mus = NULL
+        storage.packet_energies = NULL
+        storage.packet_source_cdf = <double*> packet_source_cdf.data
+        storage.packet_source_nus = <double*> packet_source_nus.data
+        storage.packet_source_size = packet_source_cdf.size
+        storage.packet_energy = parameters['packet_energy']
+        storage.no_of_packets = no_of_packets
+    else:
+        storage.packet_nus = <double*> packet_nus.data
+        storage.packet_mus = <double*> packet_mus.data
+        storage.packet_energies = <double*> packet_energies.data
+        storage.packet_source_cdf = NULL
+        storage.packet_source_nus = NULL
+        storage.packet_source_size = 0
+        storage.no_of_packets = packet_nus.size
+    storage.first_packet_id = first_packet_id
     # Setup of structure
-    structure = model.tardis_config.structure
-    storage.no_of_shells = structure.no_of_shells
-    cdef np.ndarray[double, ndim=1] r_inner = structure.r_inner.to('cm').value
+    cdef np.ndarray[double, ndim=1] r_inner = arrays['r_inner']
+    storage.no_of_shells = r_inner.size
     storage.r_inner = <double*> r_inner.data
-    cdef np.ndarray[double, ndim=1] r_outer = structure.r_outer.to('cm').value
+    cdef np.ndarray[double, ndim=1] r_outer = arrays['r_outer']
     storage.r_outer = <double*> r_outer.data
-    cdef np.ndarray[double, ndim=1] v_inner = structure.v_inner.to('cm/s').value
+    cdef np.ndarray[double, ndim=1] v_inner = arrays['v_inner']
     storage.v_inner = <double*> v_inner.data
     # Setup the rest
     # times
-    storage.time_explosion = model.tardis_config.supernova.time_explosion.to('s').value
+    storage.time_explosion = parameters['time_explosion']
     storage.inverse_time_explosion = 1.0 / storage.time_explosion
     #electron density
-    cdef np.ndarray[double, ndim=1] electron_densities = model.plasma_array.electron_densities.values
+    cdef np.ndarray[double, ndim=1] electron_densities = arrays['electron_densities']
     storage.electron_densities = <double*> electron_densities.data
-    cdef np.ndarray[double, ndim=1] inverse_electron_densities = 1.0 / electron_densities
+    cdef np.ndarray[double, ndim=1] inverse_electron_densities = arrays.get('inverse_electron_densities')
+    if inverse_electron_densities is None:
+        inverse_electron_densities = 1.0 / electron_densities
     storage.inverse_electron_densities = <double*> inverse_electron_densities.data
     # Line lists
-    cdef np.ndarray[double, ndim=1] line_list_nu = model.atom_data.lines.nu.values
+    cdef np.ndarray[double, ndim=1] line_list_nu = arrays['line_list_nu']
     storage.line_list_nu = <double*> line_list_nu.data
     storage.no_of_lines = line_list_nu.size
-    cdef np.ndarray[double, ndim=2] line_lists_tau_sobolevs = model.plasma_array.tau_sobolevs.values.transpose()
-    storage.line_lists_tau_sobolevs = <double*> line_lists_tau_sobolevs.data
+    cdef np.ndarray[int_type_t, ndim=1] line_bucket_starts = arrays.get('line_bucket_starts')
+    if line_bucket_starts is None:
+        line_bucket_starts = get_line_bucket_starts(line_list_nu)
+    line_index_init(&storage.line_index, storage.line_list_nu, storage.no_of_lines, line_bucket_starts.size - 1,
+                    <int_type_t*> line_bucket_starts.data, False)
+    cdef np.ndarray line_lists_tau_sobolevs = np.ascontiguousarray(arrays['line_lists_tau_sobolevs'])
+    storage.line_lists_tau_sobolevs = NULL
+    storage.line_lists_tau_sobolevs_single = NULL
+    if is_single_precision(line_lists_tau_sobolevs):
+        storage.line_lists_tau_sobolevs_single = <float*> line_lists_tau_sobolevs.data
+    else:
+        storage.line_lists_tau_sobolevs = <double*> line_lists_tau_sobolevs.data
     storage.line_lists_tau_sobolevs_nd = line_lists_tau_sobolevs.shape[1]
-    cdef np.ndarray[double, ndim=2] line_lists_j_blues = model.j_blue_estimators
-    storage.line_lists_j_blues = <double*> line_lists_j_blues.data
-    storage.line_lists_j_blues_nd = line_lists_j_blues.shape[1]
-    line_interaction_type = model.tardis_config.plasma.line_interaction_type
-    if line_interaction_type == 'scatter':
-        storage.line_interaction_id = 0
-    elif line_interaction_type == 'downbranch':
-        storage.line_interaction_id = 1
-    elif line_interaction_type == 'macroatom':
-        storage.line_interaction_id = 2
+    cdef np.ndarray[int_type_t, ndim=2] next_active_line_ids = arrays.get('next_active_line_ids')
+    storage.next_active_line_ids = NULL
+    if next_active_line_ids is not None:
+        storage.next_active_line_ids = <int_type_t*> next_active_line_ids.data
+    cdef np.ndarray[double, ndim=2] cumulative_line_tau_sobolevs = arrays.get('cumulative_line_tau_sobolevs')
+    storage.cumulative_tau_real_packets = parameters['cumulative_line_tau']
+    if cumulative_line_tau_sobolevs is None and storage.cumulative_tau_real_packets:
+        cumulative_line_tau_sobolevs = get_cumulative_line_tau_sobolevs(line_lists_tau_sobolevs)
+    storage.cumulative_line_tau_sobolevs = NULL
+    if cumulative_line_tau_sobolevs is not None:
+        if cumulative_line_tau_sobolevs.shape[1] != storage.no_of_lines + 1:
+            raise ValueError('cumulative_line_tau_sobolevs needs no_of_lines + 1 columns')
+        storage.cumulative_line_tau_sobolevs = <double*> cumulative_line_tau_sobolevs.data
+    cdef np.ndarray[int_type_t, ndim=1] j_blue_line_ids = arrays.get('j_blue_line_ids')
+    cdef np.ndarray[int_type_t, ndim=1] j_blue_lines = None
+    storage.j_blue_line_ids = NULL
+    storage.j_blue_lines = NULL
+    cdef int_type_t no_of_j_blue_lines = storage.no_of_lines
+    if j_blue_line_ids is not None:
+        storage.j_blue_line_ids = <int_type_t*> j_blue_line_ids.data
+        j_blue_lines = np.flatnonzero(j_blue_line_ids >= 0).astype(np.int64)
+        storage.j_blue_lines = <int_type_t*> j_blue_lines.data
+        no_of_j_blue_lines = j_blue_lines.size
+    if j_blues is None:
+        j_blues = np.zeros((storage.no_of_shells, no_of_j_blue_lines), dtype=line_lists_tau_sobolevs.dtype)
+    if not j_blues.flags.c_contiguous:
+        raise ValueError('j_blues has to be C contiguous')
+    if j_blues.shape[1] != no_of_j_blue_lines:
+        raise ValueError('j_blues needs one column per line with a j_blue estimator')
+    storage.line_lists_j_blues = NULL
+    storage.line_lists_j_blues_single = NULL
+    if is_single_precision(j_blues):
+        storage.line_lists_j_blues_single = <float*> j_blues.data
     else:
-        storage.line_interaction_id = -99
+        storage.line_lists_j_blues = <double*> j_blues.data
+    storage.line_lists_j_blues_nd = j_blues.shape[1]
+    storage.line_interaction_id = parameters['line_interaction_id']
     # macro atom & downbranch
-    cdef np.ndarray[double, ndim=2] transition_probabilities
+    cdef np.ndarray cumulative_transition_probabilities
     cdef np.ndarray[int_type_t, ndim=1] line2macro_level_upper
     cdef np.ndarray[int_type_t, ndim=1] macro_block_references
     cdef np.ndarray[int_type_t, ndim=1] transition_type
     cdef np.ndarray[int_type_t, ndim=1] destination_level_id
     cdef np.ndarray[int_type_t, ndim=1] transition_line_id
     if storage.line_interaction_id >= 1:
-        transition_probabilities = model.transition_probabilities.values.transpose()
-        storage.transition_probabilities = <double*> transition_probabilities.data
-        storage.transition_probabilities_nd = transition_probabilities.shape[1]
-        line2macro_level_upper = model.atom_data.lines_upper2macro_reference_idx
+        cumulative_transition_probabilities = np.ascontiguousarray(arrays['cumulative_transition_probabilities'])
+        storage.cumulative_transition_probabilities = NULL
+        storage.cumulative_transition_probabilities_single = NULL
+        if is_single_precision(cumulative_transition_probabilities):
+            storage.cumulative_transition_probabilities_single = <float*> cumulative_transition_probabilities.data
+        else:
+            storage.cumulative_transition_probabilities = <double*> cumulative_transition_probabilities.data
+        storage.transition_probabilities_nd = cumulative_transition_probabilities.shape[1]
+        line2macro_level_upper = arrays['line2macro_level_upper']
         storage.line2macro_level_upper = <int_type_t*> line2macro_level_upper.data
-        macro_block_references = model.atom_data.macro_atom_references['block_references'].values
+        macro_block_references = arrays['macro_block_references']
         storage.macro_block_references = <int_type_t*> macro_block_references.data
-        transition_type = model.atom_data.macro_atom_data['transition_type'].values
+        transition_type = arrays['transition_type']
         storage.transition_type = <int_type_t*> transition_type.data
-        # Destination level is not needed and/or generated for downbranch
-        destination_level_id = model.atom_data.macro_atom_data['destination_level_idx'].values
+        destination_level_id = arrays['destination_level_id']
         storage.destination_level_id = <int_type_t*> destination_level_id.data
-        transition_line_id = model.atom_data.macro_atom_data['lines_idx'].values
+        transition_line_id = arrays['transition_line_id']
         storage.transition_line_id = <int_type_t*> transition_line_id.data
+    ######## Setting up the output ########
     cdef np.ndarray[double, ndim=1] output_nus = np.zeros(storage.no_of_packets, dtype=np.float64)
     cdef np.ndarray[double, ndim=1] output_energies = np.zeros(storage.no_of_packets, dtype=np.float64)
     storage.output_nus = <double*> output_nus.data
@@ -206,29 +779,530 @@ def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
     cdef np.ndarray[double, ndim=1] nubars = np.zeros(storage.no_of_shells, dtype=np.float64)
     storage.js = <double*> js.data
     storage.nubars = <double*> nubars.data
-    storage.spectrum_start_nu = model.tardis_config.spectrum.frequency.value.min()
-    storage.spectrum_end_nu = model.tardis_config.spectrum.frequency.value.max()
-    storage.spectrum_delta_nu = model.tardis_config.spectrum.frequency.value[1] - model.tardis_config.spectrum.frequency.value[0]
-    cdef np.ndarray[double, ndim=1] spectrum_virt_nu = model.montecarlo_virtual_luminosity
+    storage.spectrum_start_nu = parameters['spectrum_start_nu']
+    storage.spectrum_end_nu = parameters['spectrum_end_nu']
+    storage.spectrum_delta_nu = parameters['spectrum_delta_nu']
+    if spectrum_virt_nu is None:
+        spectrum_virt_nu = np.zeros(parameters['spectrum_virt_nu_size'], dtype=np.float64)
     storage.spectrum_virt_nu = <double*> spectrum_virt_nu.data
-    storage.sigma_thomson = model.tardis_config.montecarlo.sigma_thomson.to('1/cm^2').value
+    storage.spectrum_virt_nu_size = spectrum_virt_nu.size
+    storage.sigma_thomson = parameters['sigma_thomson']
     storage.inverse_sigma_thomson = 1.0 / storage.sigma_thomson
-    storage.reflective_inner_boundary = model.tardis_config.montecarlo.enable_reflective_inner_boundary
-    storage.inner_boundary_albedo = model.tardis_config.montecarlo.inner_boundary_albedo
+    storage.reflective_inner_boundary = parameters['reflective_inner_boundary']
+    storage.inner_boundary_albedo = parameters['inner_boundary_albedo']
+    storage.virtual_packet_roulette_tau = parameters['virtual_packet_roulette_tau']
+    storage.virtual_packet_roulette_survival = parameters['virtual_packet_roulette_survival']
+    if storage.virtual_packet_roulette_tau > 0 and not 0 < storage.virtual_packet_roulette_survival <= 1:
+        raise ValueError('virtual_packet_roulette_survival has to be in (0, 1]')
+    storage.event_counters = NULL
+    if parameters['count_events']:
+        if event_counters is None:
+            event_counters = np.zeros((storage.no_of_shells, len(EVENT_COUNTER_NAMES)), dtype=np.int64)
+        if event_counters.shape[1] != len(EVENT_COUNTER_NAMES):
+            raise ValueError('event_counters needs one column per event in EVENT_COUNTER_NAMES')
+        storage.event_counters = <int_type_t*> event_counters.data
+    else:
+        event_counters = None
+    cdef np.ndarray packet_trace_records
+    cdef np.ndarray[int_type_t, ndim=1] packet_trace_header
+    storage.packet_trace = NULL
+    if packet_trace is not None:
+        packet_trace_records = packet_trace.records
+        if packet_trace_records.dtype.itemsize != sizeof(packet_trace_record_t):
+            raise ValueError('The packet trace records need %d bytes' % sizeof(packet_trace_record_t))
+        packet_trace_header = packet_trace.header
+        storage.packet_trace = <packet_trace_record_t*> packet_trace_records.data
+        storage.packet_trace_size = packet_trace_records.size
+        storage.packet_trace_stride = packet_trace.stride
+        storage.packet_trace_position = <int_type_t*> packet_trace_header.data
+        storage.packet_trace_iteration = parameters['iteration']
+    # the threads of montecarlo_main_loop log the j_blue and spectrum increments themselves
+    storage.j_blue_log = NULL
+    storage.spectrum_virt_nu_log = NULL
     storage.current_packet_id = -1
-    ######## Setting up the output ########
-    #cdef np.ndarray[double, ndim=1] output_nus = np.zeros(storage.no_of_packets, dtype=np.float64)
-    #cdef np.ndarray[double, ndim=1] output_energies = np.zeros(storage.no_of_packets, dtype=np.float64)
-    cdef int_type_t reabsorbed = 0
-    for packet_index in range(storage.no_of_packets):
-        storage.current_packet_id = packet_index
-        rpacket_init(&packet, &storage, packet_index, virtual_packet_flag)
-        if (virtual_packet_flag > 0):
-            #this is a run for which we want the virtual packet spectrum. So first thing we need to do is spawn virtual packets to track the input packet
-            reabsorbed = montecarlo_one_packet(&storage, &packet, -1)
-        #Now can do the propagation of the real packet
-        reabsorbed = montecarlo_one_packet(&storage, &packet, 0)
-        storage.output_nus[packet_index] = rpacket_get_nu(&packet)
-        storage.output_energies[packet_index] = -rpacket_get_energy(&packet) if reabsorbed == 1 else rpacket_get_energy(&packet)
-    return output_nus, output_energies, js, nubars, last_line_interaction_in_id, last_line_interaction_out_id, last_interaction_type, last_line_interaction_shell_id
+    storage.transport_kernel = get_transport_kernel_id(parameters['transport_kernel'])
+    cdef unsigned long seed = parameters['seed']
+    cdef int_type_t iteration = parameters['iteration']
+    cdef montecarlo_progress_callback_t c_progress_callback = NULL
+    if progress_callback is not None:
+        c_progress_callback = call_progress_callback
+    cdef void *progress_data = <void*> progress_callback
+    cdef tardis_error_t ret_val
+    with nogil:
+        ret_val = montecarlo_main_loop(&storage, virtual_packet_flag, nthreads, seed, iteration,
+                                       c_progress_callback, progress_interval, progress_data)
+    if ret_val == TARDIS_ERROR_ALLOCATION_FAILED:
+        raise MemoryError('Could not allocate the transport buffers for %d threads' % nthreads)
+    return TransportResult(output_nus, output_energies, js, nubars, j_blues, spectrum_virt_nu,
+                           last_line_interaction_in_id, last_line_interaction_out_id, last_interaction_type,
+                           last_line_interaction_shell_id, event_counters)
+
+
+def transport(packet_nus, packet_mus, packet_energies, r_inner, r_outer, time_explosion, electron_densities,
+              line_list_nu, line_lists_tau_sobolevs, macro_atom_tables=None, spectrum_frequency=None,
+              int_type_t virtual_packet_flag=0, int nthreads=1, **options):
+    """
+    Transport packets through homologously expanding shells given as plain arrays, without a model.
+
+    Parameters
+    ----------
+    packet_nus, packet_mus, packet_energies : `numpy.ndarray`
+        properties of the packets
+    r_inner, r_outer : `numpy.ndarray`
+        inner and outer radii of the shells in cm
+    time_explosion : float
+        time since the explosion in s
+    electron_densities : `numpy.ndarray`
+        electron density of every shell in 1/cm^3
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from blue to red
+    line_lists_tau_sobolevs : `numpy.ndarray`
+        tau_sobolevs (shells x lines)
+    macro_atom_tables : dict, optional
+        ``cumulative_transition_probabilities`` (shells x transitions), ``line2macro_level_upper``,
+        ``macro_block_references``, ``transition_type``, ``destination_level_id`` and ``transition_line_id``,
+        needed for the downbranch and macroatom line interaction types. ``macro_block_references`` holds the index
+        of the first transition of every level as in the atomic data; the total number of transitions, which the
+        kernel reads as the end of the last block, is appended if it is missing.
+    spectrum_frequency : `numpy.ndarray`, optional
+        equally spaced frequency bin edges of the virtual packet spectrum, needed for virtual packets
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction
+    nthreads : int
+        number of OpenMP threads
+    options :
+        the scalar parameters in `DEFAULT_TRANSPORT_OPTIONS`
+
+    Returns
+    -------
+    result : `TransportResult`
+    """
+    unknown_options = set(options) - set(DEFAULT_TRANSPORT_OPTIONS)
+    if unknown_options:
+        raise TypeError('Unknown transport options: %s' % ', '.join(sorted(unknown_options)))
+    parameters = dict(DEFAULT_TRANSPORT_OPTIONS, **options)
+    parameters['line_interaction_id'] = get_line_interaction_id(parameters.pop('line_interaction_type'))
+    if parameters['line_interaction_id'] < 0:
+        raise ValueError('line_interaction_type has to be scatter, downbranch or macroatom')
+    if parameters['line_interaction_id'] >= 1 and macro_atom_tables is None:
+        raise ValueError('The downbranch and macroatom line interaction types need macro_atom_tables')
+    if spectrum_frequency is None:
+        if virtual_packet_flag > 0:
+            raise ValueError('Virtual packets need spectrum_frequency')
+        # an empty frequency range with a single unused bin
+        parameters.update(spectrum_start_nu=0.0, spectrum_end_nu=0.0, spectrum_delta_nu=1.0,
+                          spectrum_virt_nu_size=1)
+    else:
+        parameters.update(spectrum_start_nu=spectrum_frequency.min(), spectrum_end_nu=spectrum_frequency.max(),
+                          spectrum_delta_nu=spectrum_frequency[1] - spectrum_frequency[0],
+                          spectrum_virt_nu_size=spectrum_frequency.size)
+    parameters['time_explosion'] = time_explosion
+
+    arrays = dict(r_inner=np.ascontiguousarray(r_inner, dtype=np.float64),
+                  r_outer=np.ascontiguousarray(r_outer, dtype=np.float64),
+                  electron_densities=np.ascontiguousarray(electron_densities, dtype=np.float64),
+                  line_list_nu=np.ascontiguousarray(line_list_nu, dtype=np.float64),
+                  line_lists_tau_sobolevs=line_lists_tau_sobolevs)
+    arrays['v_inner'] = arrays['r_inner'] / time_explosion
+    if macro_atom_tables is not None:
+        arrays.update(macro_atom_tables)
+        arrays['macro_block_references'] = get_macro_block_references(macro_atom_tables['macro_block_references'],
+                                                                      len(macro_atom_tables['transition_type']))
+    return transport_packets(arrays, parameters, np.ascontiguousarray(packet_nus, dtype=np.float64),
+                             np.ascontiguousarray(packet_mus, dtype=np.float64),
+                             np.ascontiguousarray(packet_energies, dtype=np.float64),
+                             virtual_packet_flag=virtual_packet_flag, nthreads=nthreads)
+
+
+def get_macro_block_references(block_references, no_of_transitions):
+    """
+    Block references of the macro atom levels terminated by the total number of transitions.
+
+    Parameters
+    ----------
+    block_references : `numpy.ndarray`
+        index of the first transition of every level, optionally already followed by `no_of_transitions`
+    no_of_transitions : int
+
+    Returns
+    -------
+    macro_block_references : `numpy.ndarray`
+        one entry more than the number of levels, as `storage_model_t.macro_block_references`
+    """
+    block_references = np.ascontiguousarray(block_references, dtype=np.int64)
+    if block_references.size == 0 or block_references[block_references.size - 1] > no_of_transitions:
+        raise ValueError('macro_block_references needs the first transition of every level, all below the '
+                         'number of transitions (%d)' % no_of_transitions)
+    if block_references[block_references.size - 1] == no_of_transitions:
+        return block_references
+    # the last level has at least one transition, so its block starts below no_of_transitions
+    return np.hstack((block_references, [no_of_transitions]))
+
+
+def formal_integral(np.ndarray[double, ndim=1, mode='c'] nus,
+                    np.ndarray[double, ndim=1, mode='c'] impact_parameters,
+                    np.ndarray[double, ndim=1, mode='c'] r_inner, np.ndarray[double, ndim=1, mode='c'] r_outer,
+                    double time_explosion, np.ndarray[double, ndim=1, mode='c'] line_list_nu,
+                    np.ndarray[double, ndim=2, mode='c'] exp_tau_sobolevs,
+                    np.ndarray[double, ndim=2, mode='c'] attenuated_source_functions,
+                    np.ndarray[double, ndim=1, mode='c'] inner_intensities, int nthreads=1):
+    """
+    Integrate the emergent intensity along rays parallel to the line of sight.
+
+    Parameters
+    ----------
+    nus : `numpy.ndarray`
+        observer frame frequencies
+    impact_parameters : `numpy.ndarray`
+        impact parameters of the rays in cm
+    r_inner, r_outer : `numpy.ndarray`
+        inner and outer radii of the shells in cm
+    time_explosion : float
+        time since the explosion in s
+    line_list_nu : `numpy.ndarray`
+        line frequencies sorted from blue to red
+    exp_tau_sobolevs : `numpy.ndarray`
+        exp(-tau_sobolev) (shells x lines)
+    attenuated_source_functions : `numpy.ndarray`
+        (1 - exp(-tau_sobolev)) times the line source functions (shells x lines)
+    inner_intensities : `numpy.ndarray`
+        intensity of the photosphere at every frequency
+    nthreads : int
+        number of OpenMP threads
+
+    Returns
+    -------
+    intensities : `numpy.ndarray`
+        emergent intensities (frequencies x impact parameters)
+    """
+    cdef int_type_t no_of_shells = r_inner.size
+    cdef int_type_t no_of_lines = line_list_nu.size
+    if r_outer.size != no_of_shells or inner_intensities.size != nus.size:
+        raise ValueError('r_outer needs one value per shell and inner_intensities one per frequency')
+    for table in (exp_tau_sobolevs, attenuated_source_functions):
+        if table.shape[0] != no_of_shells or table.shape[1] != no_of_lines:
+            raise ValueError('The line tables need one row per shell and one column per line')
+    cdef np.ndarray[double, ndim=2] intensities = np.zeros((nus.size, impact_parameters.size), dtype=np.float64)
+    with nogil:
+        c_formal_integral(<double*> nus.data, nus.shape[0], <double*> impact_parameters.data,
+                          impact_parameters.shape[0], <double*> r_inner.data, <double*> r_outer.data, no_of_shells,
+                          time_explosion, <double*> line_list_nu.data, no_of_lines, <double*> exp_tau_sobolevs.data,
+                          <double*> attenuated_source_functions.data, <double*> inner_intensities.data,
+                          <double*> intensities.data, nthreads)
+    return intensities
+
+
+def sobol_sequence(int_type_t no_of_points, int dimension, unsigned long seed):
+    """
+    Points of a randomly shifted Sobol sequence in the unit hypercube.
+
+    The sequence uses the direction numbers of Joe and Kuo as tabulated by Lemieux. The random digital shift
+    (seeded with `seed`) keeps the low discrepancy of the sequence while making the points of different seeds
+    independent estimates. Every prefix of the sequence is well distributed on its own.
+
+    Parameters
+    ----------
+    no_of_points : int
+    dimension : int
+    seed : int
+
+    Returns
+    -------
+    points : `numpy.ndarray`
+        points in [0, 1) (no_of_points x dimension)
+    """
+    cdef rk_state state
+    cdef rk_sobol_state sobol_state
+    cdef rk_sobol_error error
+    cdef int_type_t i
+    cdef np.ndarray[double, ndim=2] points = np.empty((no_of_points, dimension), dtype=np.float64)
+    cdef double *data = <double*> points.data
+    rk_seed(seed, &state)
+    error = rk_sobol_init(dimension, &sobol_state, &state, rk_sobol_Ldirections, NULL)
+    if error != RK_SOBOL_OK:
+        raise ValueError(rk_sobol_strerror[<int> error].decode('ascii'))
+    rk_sobol_randomshift(&sobol_state, &state)
+    with nogil:
+        for i in range(no_of_points):
+            rk_sobol_double(&sobol_state, data + i * dimension)
+    rk_sobol_free(&sobol_state)
+    return points
+
+
+def log_transport_progress(packets_done, packets_per_second):
+    logger.info('Transported %d packets (%.0f packets/s)', packets_done, packets_per_second)
+
+
+def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
+    """
+    Parameters
+    ----------
+    model : `tardis.model_radial_oned.ModelRadial1D`
+        complete model
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction
+
+    Returns
+    -------
+    output_nus : `numpy.ndarray`
+    output_energies : `numpy.ndarray`
+    js : `numpy.ndarray`
+    nubars : `numpy.ndarray`
+    last_line_interaction_in_id : `numpy.ndarray`
+    last_line_interaction_out_id : `numpy.ndarray`
+    last_interaction_type : `numpy.ndarray`
+    last_line_interaction_shell_id : `numpy.ndarray`
+
+    The j_blue estimators and the virtual packet spectrum are added to
+    ``model.j_blue_estimators`` and ``model.montecarlo_virtual_luminosity``.
+    """
+    arrays = get_transport_arrays(model, virtual_packet_flag=virtual_packet_flag)
+    parameters = get_transport_parameters(model)
+    send_plasma_to_workers(model, arrays, parameters)
+    return transport_model_packets(model, arrays, parameters,
+                                   model.packet_src.packet_nus, model.packet_src.packet_mus,
+                                   model.packet_src.packet_energies, virtual_packet_flag=virtual_packet_flag,
+                                   no_of_packets=model.packet_src.no_of_packets)
+
+
+def montecarlo_radial1d_chunks(model, int_type_t chunk_size, int_type_t virtual_packet_flag=0):
+    """
+    Transport the packets of the model in chunks and yield the cumulative result after every chunk.
+
+    Parameters
+    ----------
+    model : `tardis.model_radial_oned.ModelRadial1D`
+        complete model
+    chunk_size : int
+        number of packets per chunk
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction
+
+    Yields
+    ------
+    partial_result : dict
+        ``packets_done``: number of transported packets M,
+        ``output_nus``, ``output_energies``, ``last_line_interaction_in_id``, ``last_line_interaction_out_id``,
+        ``last_interaction_type``, ``last_line_interaction_shell_id``: output of the first M packets,
+        ``js``, ``nubars``: cumulative estimators,
+        ``j_estimator_relative_noise``, ``nubar_estimator_relative_noise``: relative standard error of ``js`` and
+        ``nubars`` per shell estimated from the scatter between the chunks (inf until two chunks are done),
+        ``emitted_spectrum``, ``reabsorbed_spectrum``, ``virtual_spectrum``: cumulative packet energies per
+        frequency bin of the spectrum.
+
+    The arrays are updated in place by the following chunks. The j_blue estimators and the virtual packet
+    spectrum are added to ``model.j_blue_estimators`` and ``model.montecarlo_virtual_luminosity``. All estimators
+    are sums over the first M packets; if the transport is stopped early they have to be multiplied by N / M to
+    represent all N packets of the iteration.
+    """
+    arrays = get_transport_arrays(model, virtual_packet_flag=virtual_packet_flag)
+    parameters = get_transport_parameters(model)
+    send_plasma_to_workers(model, arrays, parameters)
+    packet_nus = model.packet_src.packet_nus
+    packet_mus = model.packet_src.packet_mus
+    packet_energies = model.packet_src.packet_energies
+    no_of_packets = model.packet_src.no_of_packets
+
+    def transport_chunk(packets):
+        if packet_nus is None:
+            chunk_packet_arrays = None, None, None
+        else:
+            chunk_packet_arrays = packet_nus[packets], packet_mus[packets], packet_energies[packets]
+        return transport_model_packets(model, arrays, parameters, *chunk_packet_arrays,
+                                       first_packet_id=packets.start, virtual_packet_flag=virtual_packet_flag,
+                                       no_of_packets=packets.stop - packets.start)
+
+    for partial_result in accumulate_transport_chunks(transport_chunk, no_of_packets, chunk_size,
+                                                      len(arrays['r_inner']),
+                                                      model.tardis_config.spectrum.frequency.value):
+        partial_result['virtual_spectrum'] = model.montecarlo_virtual_luminosity
+        yield partial_result
+
+
+def accumulate_transport_chunks(transport_chunk, int_type_t no_of_packets, int_type_t chunk_size,
+                                int_type_t no_of_shells, frequency_bins):
+    """
+    Transport packets chunk by chunk and yield the cumulative result after every chunk.
+
+    Parameters
+    ----------
+    transport_chunk : callable
+        transports the packets of a slice and returns the arrays of `montecarlo_radial1d` for them
+    no_of_packets : int
+    chunk_size : int
+        number of packets per chunk
+    no_of_shells : int
+    frequency_bins : `numpy.ndarray`
+        edges of the frequency bins of the spectra
+
+    Yields
+    ------
+    partial_result : dict
+        as `montecarlo_radial1d_chunks`, without ``virtual_spectrum``
+    """
+    output_arrays = [np.zeros(no_of_packets, dtype=np.float64), np.zeros(no_of_packets, dtype=np.float64)]
+    output_arrays += [-1 * np.ones(no_of_packets, dtype=np.int64) for i in xrange(4)]
+    js = np.zeros(no_of_shells)
+    nubars = np.zeros_like(js)
+    js_squared_chunk_sum = np.zeros_like(js)
+    nubars_squared_chunk_sum = np.zeros_like(js)
+    emitted_spectrum = np.zeros(frequency_bins.size - 1)
+    reabsorbed_spectrum = np.zeros_like(emitted_spectrum)
+
+    no_of_chunks = 0
+    for first_packet_id in xrange(0, no_of_packets, chunk_size):
+        packets = slice(first_packet_id, min(first_packet_id + chunk_size, no_of_packets))
+        chunk_result = transport_chunk(packets)
+        chunk_output_nus, chunk_output_energies, chunk_js, chunk_nubars = chunk_result[:4]
+        for output_array, chunk_output_array in zip(output_arrays, chunk_result[:2] + chunk_result[4:]):
+            output_array[packets] = chunk_output_array
+        js += chunk_js
+        nubars += chunk_nubars
+        js_squared_chunk_sum += chunk_js ** 2
+        nubars_squared_chunk_sum += chunk_nubars ** 2
+        no_of_chunks += 1
+        emitted = chunk_output_energies >= 0
+        emitted_spectrum += np.histogram(chunk_output_nus[emitted], weights=chunk_output_energies[emitted],
+                                         bins=frequency_bins)[0]
+        reabsorbed_spectrum -= np.histogram(chunk_output_nus[~emitted], weights=chunk_output_energies[~emitted],
+                                            bins=frequency_bins)[0]
+
+        packets_done = packets.stop
+        yield dict(packets_done=packets_done,
+                   output_nus=output_arrays[0][:packets_done],
+                   output_energies=output_arrays[1][:packets_done],
+                   last_line_interaction_in_id=output_arrays[2][:packets_done],
+                   last_line_interaction_out_id=output_arrays[3][:packets_done],
+                   last_interaction_type=output_arrays[4][:packets_done],
+                   last_line_interaction_shell_id=output_arrays[5][:packets_done],
+                   js=js, nubars=nubars,
+                   j_estimator_relative_noise=batch_means_relative_noise(js, js_squared_chunk_sum, no_of_chunks),
+                   nubar_estimator_relative_noise=batch_means_relative_noise(nubars, nubars_squared_chunk_sum,
+                                                                             no_of_chunks),
+                   emitted_spectrum=emitted_spectrum, reabsorbed_spectrum=reabsorbed_spectrum)
+
+
+def stop_at_noise_target(partial_results, double noise_target):
+    """
+    Consume partial results of `montecarlo_radial1d_chunks` until the relative noise of the j estimator is below
+    noise_target in every shell.
+
+    Returns
+    -------
+    partial_result : dict
+        the first partial result below the target, or the last one
+    """
+    for partial_result in partial_results:
+        if np.all(partial_result['j_estimator_relative_noise'] < noise_target):
+            break
+    return partial_result
 
+
+def scale_partial_result(partial_result, int_type_t no_of_packets):
+    """
+    Scale the partial result of the first M packets of `montecarlo_radial1d_chunks` to all N packets.
+
+    Returns
+    -------
+    energy_scale : float
+        N / M, by which the packet energies, js and nubars are multiplied
+    transport_result : tuple
+        the same arrays as `montecarlo_radial1d`
+    """
+    energy_scale = no_of_packets / float(partial_result['packets_done'])
+    return energy_scale, (partial_result['output_nus'], partial_result['output_energies'] * energy_scale,
+                          partial_result['js'] * energy_scale, partial_result['nubars'] * energy_scale,
+                          partial_result['last_line_interaction_in_id'],
+                          partial_result['last_line_interaction_out_id'], partial_result['last_interaction_type'],
+                          partial_result['last_line_interaction_shell_id'])
+
+
+def batch_means_relative_noise(total, squared_batch_sum, no_of_batches):
+    """
+    Relative standard error of a sum of independent batches, estimated from the scatter between the batches.
+
+    Parameters
+    ----------
+    total : `numpy.ndarray`
+        sum over the batches
+    squared_batch_sum : `numpy.ndarray`
+        sum of the squares of the batches
+    no_of_batches : int
+
+    Returns
+    -------
+    relative_noise : `numpy.ndarray`
+        inf where the total is zero or fewer than two batches are available
+    """
+    relative_noise = np.inf * np.ones_like(total)
+    if no_of_batches > 1:
+        batch_mean = total / no_of_batches
+        batch_variance = (squared_batch_sum - no_of_batches * batch_mean ** 2) / (no_of_batches - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            noise = np.sqrt(np.maximum(batch_variance, 0.0) * no_of_batches) / total
+        relative_noise[total > 0] = noise[total > 0]
+    return relative_noise
+
+
+def get_transport_workers(model):
+    """
+    The `tardis.montecarlo.process_pool.TransportPool` of the processes backend or the
+    `tardis.montecarlo.distributed.TransportCoordinator` of the distributed backend.
+    """
+    backend = model.tardis_config.montecarlo.backend
+    if backend == 'processes':
+        transport_workers = model.transport_pool
+    else:
+        transport_workers = model.transport_coordinator
+    if transport_workers is None:
+        raise ValueError('The %s backend needs transport workers, which are started by '
+                         'tardis.simulation.run_radial1d' % backend)
+    return transport_workers
+
+
+def send_plasma_to_workers(model, arrays, parameters):
+    """
+    Send the transport inputs of an iteration to the workers of the processes and the distributed backends once,
+    before the packets are transported with `transport_model_packets`.
+    """
+    if model.tardis_config.montecarlo.backend in ('processes', 'distributed'):
+        get_transport_workers(model).send_plasma(arrays, parameters)
+
+
+def transport_model_packets(model, arrays, parameters, packet_nus, packet_mus, packet_energies,
+                            int_type_t first_packet_id=0, int_type_t virtual_packet_flag=0,
+                            int_type_t no_of_packets=-1):
+    """
+    Transport packets with the backend selected in the montecarlo section of the model configuration.
+
+    If the packet arrays are None, the threads backend generates `no_of_packets` packets in the kernel (see
+    `transport_packets`); the other backends need the packet arrays. The processes and the distributed backends
+    transport with the inputs of the last `send_plasma_to_workers`.
+
+    The j_blue estimators, the virtual packet spectrum and the event counters are added to
+    ``model.j_blue_estimators``, ``model.montecarlo_virtual_luminosity`` and ``model.event_counters``, the other
+    results are returned as by `montecarlo_radial1d`. The packets are traced into ``model.packet_trace`` by the
+    threads backend only.
+    """
+    montecarlo_config = model.tardis_config.montecarlo
+    if montecarlo_config.backend in ('processes', 'distributed'):
+        result = get_transport_workers(model).transport(packet_nus, packet_mus, packet_energies,
+                                                        first_packet_id=first_packet_id,
+                                                        virtual_packet_flag=virtual_packet_flag,
+                                                        j_blues=model.j_blue_estimators,
+                                                        spectrum_virt_nu=model.montecarlo_virtual_luminosity,
+                                                        event_counters=model.event_counters)
+    else:
+        nthreads = montecarlo_config.nthreads
+        if nthreads > 1 and not TARDIS_WITH_OPENMP and first_packet_id == 0:
+            logger.warning('TARDIS was compiled without OpenMP - transporting packets with a single thread '
+                           'instead of the requested %d', nthreads)
+        result = transport_packets(arrays, parameters, packet_nus, packet_mus, packet_energies,
+                                   first_packet_id=first_packet_id, virtual_packet_flag=virtual_packet_flag,
+                                   nthreads=nthreads, no_of_packets=no_of_packets, j_blues=model.j_blue_estimators,
+                                   spectrum_virt_nu=model.montecarlo_virtual_luminosity,
+                                   event_counters=model.event_counters, packet_trace=model.packet_trace,
+                                   progress_callback=log_transport_progress)
+    return (result.output_nus, result.output_energies, result.js, result.nubars,
+            result.last_line_interaction_in_id, result.last_line_interaction_out_id, result.last_interaction_type,
+            result.last_line_interaction_shell_id)
@@ -0,0 +1,108 @@
+"""
+Binary trace of the events of a sample of the real packets.
+
+The transport writes one fixed-size record per event (start, shell boundary
+crossing, electron scattering, line interaction, escape or reabsorption) of
+every packet whose id is a multiple of the stride. The records go into a ring
+buffer, which can be an in-memory array or a memory-mapped file. A trace file
+starts with a header of four int64 values (number of records written, size
+of the ring buffer, stride, record size) followed by the records.
+"""
+
+import numpy as np
+
+# Layout of packet_trace_record_t in cmontecarlo.h
+PACKET_TRACE_DTYPE = np.dtype([('packet_id', np.int64), ('iteration', np.int64), ('event_type', np.int64),
+                               ('shell_id', np.int64), ('r', np.float64), ('mu', np.float64), ('nu', np.float64),
+                               ('line_id', np.int64)])
+
+# Names of the event types, in the order of packet_event_t
+PACKET_EVENT_NAMES = ['start', 'boundary', 'electron', 'line', 'escaped', 'reabsorbed']
+
+HEADER_LENGTH = 4
+
+
+class PacketTrace(object):
+    """
+    Ring buffer of packet trace records.
+
+    Parameters
+    ----------
+    size : int
+        number of records kept, older records are overwritten
+    stride : int
+        only the packets whose id is a multiple of stride are traced
+    path : str, optional
+        file to map the ring buffer to, kept in memory if not given
+    """
+
+    def __init__(self, size, stride=1, path=None):
+        if size < 1:
+            raise ValueError('The packet trace needs room for at least one record')
+        if stride < 1:
+            raise ValueError('The packet trace stride has to be at least 1')
+        no_of_bytes = HEADER_LENGTH * 8 + size * PACKET_TRACE_DTYPE.itemsize
+        if path is None:
+            self.buffer = np.zeros(no_of_bytes, dtype=np.uint8)
+        else:
+            self.buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(no_of_bytes,))
+        self.path = path
+        self.header = self.buffer[:HEADER_LENGTH * 8].view(np.int64)
+        self.header[:] = [0, size, stride, PACKET_TRACE_DTYPE.itemsize]
+        self.records = self.buffer[HEADER_LENGTH * 8:].view(PACKET_TRACE_DTYPE)
+
+    @property
+    def size(self):
+        return self.header[1]
+
+    @property
+    def stride(self):
+        return self.header[2]
+
+    @property
+    def position(self):
+        """Number of records written so far, including the overwritten ones."""
+        return self.header[0]
+
+    def read(self):
+        """
+        Return the records in the ring buffer, oldest first.
+        """
+        return order_records(self.records, self.position)
+
+    def flush(self):
+        if self.path is not None:
+            self.buffer.flush()
+
+
+def order_records(records, position):
+    """
+    Unroll a ring buffer of records that has seen `position` writes, oldest record first.
+    """
+    records = np.asarray(records)
+    if position <= records.size:
+        return records[:position].copy()
+    return np.roll(records, -(position % records.size))
+
+
+def read_packet_trace(path):
+    """
+    Read the records of a packet trace file.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    records : `numpy.ndarray`
+        records with `PACKET_TRACE_DTYPE`, oldest first. The records of a packet are in the order of its events;
+        packets transported by different threads can be interleaved, sort them by packet_id with a stable sort to
+        group them.
+    """
+    header = np.fromfile(path, dtype=np.int64, count=HEADER_LENGTH)
+    position, size, stride, record_size = header
+    if record_size != PACKET_TRACE_DTYPE.itemsize:
+        raise ValueError('%s has records of %d bytes, expected %d' % (path, record_size, PACKET_TRACE_DTYPE.itemsize))
+    records = np.memmap(path, dtype=PACKET_TRACE_DTYPE, mode='r', offset=HEADER_LENGTH * 8, shape=(size,))
+    return order_records(records, position)
@@ -0,0 +1,375 @@
+"""
+Transport the packets of an iteration with a pool of worker processes.
+
+A `TransportPool` is kept for a whole run. The read-only inputs of the
+transport (line list, tau_sobolevs, macro atom tables, ...) and the packets
+are copied into blocks of shared memory, which the workers map without
+pickling. Every transport only sends the workers the ranges of packets to
+transport. The workers transport their packets chunk by chunk and return the
+estimators of every chunk, which are added in chunk order, so the result is
+the same as with the threads backend.
+"""
+
+import cPickle as pickle
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+from tardis.montecarlo import montecarlo
+
+logger = logging.getLogger(__name__)
+
+# Name of the shared memory block that holds the array layouts and the scalar parameters of the transport
+PLASMA_BLOCK = '_plasma'
+PACKET_ARRAY_NAMES = ['packet_nus', 'packet_mus', 'packet_energies']
+
+# Shared memory blocks of a worker process, set by _initialize_worker
+_worker_blocks = None
+# Inputs of the transport in a worker process, read from the shared memory blocks by _load_plasma
+_worker_plasma_id = None
+_worker_arrays = None
+_worker_parameters = None
+
+
+def to_shared_array(array):
+    """
+    Copy an array into a block of shared memory.
+
+    Parameters
+    ----------
+    array : `numpy.ndarray`
+
+    Returns
+    -------
+    shared_array : tuple
+        the shared memory block, the dtype and the shape of the array, which
+        can be passed to a worker process and mapped with `from_shared_array`
+    """
+    array = np.ascontiguousarray(array)
+    block = sharedctypes.RawArray(ctypes.c_char, max(array.nbytes, 1))
+    shared_array = (block, array.dtype.str, array.shape)
+    from_shared_array(shared_array)[...] = array
+    return shared_array
+
+
+def from_shared_array(shared_array):
+    """
+    Map an array created by `to_shared_array` without copying it.
+    """
+    block, dtype, shape = shared_array
+    dtype = np.dtype(dtype)
+    no_of_bytes = int(np.prod(shape)) * dtype.itemsize
+    return np.ctypeslib.as_array(block)[:no_of_bytes].view(dtype).reshape(shape)
+
+
+def get_batch_boundaries(no_of_packets, no_of_batches):
+    """
+    Split packets into at most no_of_batches contiguous batches of whole chunks.
+
+    The batch boundaries are multiples of `tardis.montecarlo.montecarlo.PACKET_CHUNK_SIZE`, so the chunks of the
+    batches are the chunks of a transport of all packets at once.
+
+    Returns
+    -------
+    batch_boundaries : `numpy.ndarray`
+        start of every batch followed by no_of_packets
+    """
+    chunk_size = montecarlo.PACKET_CHUNK_SIZE
+    no_of_chunks = (no_of_packets + chunk_size - 1) // chunk_size
+    no_of_batches = max(min(no_of_batches, no_of_chunks), 1)
+    chunk_boundaries = np.round(np.linspace(0, no_of_chunks, no_of_batches + 1)).astype(np.int64)
+    return np.minimum(chunk_boundaries * chunk_size, no_of_packets)
+
+
+def zero_estimators(arrays, parameters):
+    """
+    Zeroed double precision j_blues, virtual packet spectrum and event counters (None if the events are not
+    counted) for `tardis.montecarlo.montecarlo.transport_packets`.
+    """
+    no_of_shells = len(arrays['r_inner'])
+    j_blue_line_ids = arrays.get('j_blue_line_ids')
+    if j_blue_line_ids is None:
+        no_of_j_blue_lines = len(arrays['line_list_nu'])
+    else:
+        no_of_j_blue_lines = np.count_nonzero(j_blue_line_ids >= 0)
+    event_counters = None
+    if parameters['count_events']:
+        event_counters = np.zeros((no_of_shells, len(montecarlo.EVENT_COUNTER_NAMES)), dtype=np.int64)
+    return (np.zeros((no_of_shells, no_of_j_blue_lines)), np.zeros(parameters['spectrum_virt_nu_size']),
+            event_counters)
+
+
+def get_estimator_targets(arrays, parameters, j_blues=None, spectrum_virt_nu=None, event_counters=None):
+    """
+    Estimators for `add_chunk_results` to add to, the given ones or zeroed ones allocated as by
+    `tardis.montecarlo.montecarlo.transport_packets`.
+    """
+    default_j_blues, default_spectrum_virt_nu, default_event_counters = zero_estimators(arrays, parameters)
+    if j_blues is None:
+        j_blues = default_j_blues.astype(arrays['line_lists_tau_sobolevs'].dtype)
+    if spectrum_virt_nu is None:
+        spectrum_virt_nu = default_spectrum_virt_nu
+    if event_counters is None:
+        event_counters = default_event_counters
+    if not j_blues.flags.c_contiguous:
+        raise ValueError('j_blues has to be C contiguous')
+    return j_blues, spectrum_virt_nu, event_counters
+
+
+def transport_chunks(arrays, parameters, packet_nus, packet_mus, packet_energies, first_packet_id=0,
+                     virtual_packet_flag=0, nthreads=1):
+    """
+    Transport packets chunk by chunk, every chunk into zeroed estimators.
+
+    Parameters are the same as for `tardis.montecarlo.montecarlo.transport_packets`.
+
+    Returns
+    -------
+    chunk_results : list
+        a `tardis.montecarlo.montecarlo.TransportResult` for every chunk of
+        `tardis.montecarlo.montecarlo.PACKET_CHUNK_SIZE` packets. The j_blues and spectrum_virt_nu are given as
+        the flat indices and the values of their nonzero entries, which are combined by `add_chunk_results`.
+    """
+    chunk_results = []
+    no_of_packets = len(packet_nus)
+    for chunk_start in xrange(0, max(no_of_packets, 1), montecarlo.PACKET_CHUNK_SIZE):
+        packets = slice(chunk_start, min(chunk_start + montecarlo.PACKET_CHUNK_SIZE, no_of_packets))
+        j_blues, spectrum_virt_nu, event_counters = zero_estimators(arrays, parameters)
+        result = montecarlo.transport_packets(arrays, parameters, packet_nus[packets], packet_mus[packets],
+                                              packet_energies[packets], first_packet_id=first_packet_id + chunk_start,
+                                              virtual_packet_flag=virtual_packet_flag, nthreads=nthreads,
+                                              j_blues=j_blues, spectrum_virt_nu=spectrum_virt_nu,
+                                              event_counters=event_counters)
+        j_blue_indices = np.flatnonzero(result.j_blues)
+        spectrum_indices = np.flatnonzero(result.spectrum_virt_nu)
+        chunk_results.append(result._replace(
+            j_blues=(j_blue_indices, result.j_blues.ravel()[j_blue_indices]),
+            spectrum_virt_nu=(spectrum_indices, result.spectrum_virt_nu[spectrum_indices])))
+    return chunk_results
+
+
+def add_chunk_results(chunk_results, j_blues, spectrum_virt_nu, event_counters):
+    """
+    Combine the results of `transport_chunks` for consecutive chunks of packets.
+
+    The per-packet arrays are concatenated. The js and nubars are summed and the j_blues, the virtual packet
+    spectrum and the event counters are added to the given arrays in chunk order. Single precision j_blues are
+    summed in double precision and rounded once. This is exactly what
+    `tardis.montecarlo.montecarlo.transport_packets` does for all packets at once.
+
+    Returns
+    -------
+    result : `tardis.montecarlo.montecarlo.TransportResult`
+    """
+    js = np.zeros_like(chunk_results[0].js)
+    nubars = np.zeros_like(js)
+    if j_blues.dtype == np.float64:
+        j_blue_sums = j_blues
+    else:
+        j_blue_sums = np.zeros(j_blues.shape)
+    for chunk_result in chunk_results:
+        js += chunk_result.js
+        nubars += chunk_result.nubars
+        j_blue_indices, j_blue_values = chunk_result.j_blues
+        j_blue_sums.ravel()[j_blue_indices] += j_blue_values
+        spectrum_indices, spectrum_values = chunk_result.spectrum_virt_nu
+        spectrum_virt_nu[spectrum_indices] += spectrum_values
+        if event_counters is not None:
+            event_counters += chunk_result.event_counters
+    if j_blue_sums is not j_blues:
+        j_blues[...] = j_blues + j_blue_sums
+
+    def concatenate(name):
+        return np.concatenate([getattr(chunk_result, name) for chunk_result in chunk_results])
+
+    return montecarlo.TransportResult(concatenate('output_nus'), concatenate('output_energies'), js, nubars,
+                                      j_blues, spectrum_virt_nu, concatenate('last_line_interaction_in_id'),
+                                      concatenate('last_line_interaction_out_id'),
+                                      concatenate('last_interaction_type'),
+                                      concatenate('last_line_interaction_shell_id'), event_counters)
+
+
+def _initialize_worker(shared_blocks):
+    global _worker_blocks
+    _worker_blocks = shared_blocks
+
+
+def _load_plasma(plasma_id):
+    global _worker_plasma_id, _worker_arrays, _worker_parameters
+    if plasma_id == _worker_plasma_id:
+        return
+    # the pickle ends before the unused rest of the block
+    array_layouts, _worker_parameters = pickle.loads(_worker_blocks[PLASMA_BLOCK].raw)
+    _worker_arrays = dict((name, from_shared_array((_worker_blocks[name],) + array_layout))
+                          for name, array_layout in array_layouts.items())
+    _worker_plasma_id = plasma_id
+
+
+def _transport_batch(task):
+    plasma_id, batch_start, batch_end, first_packet_id, virtual_packet_flag = task
+    _load_plasma(plasma_id)
+    packets = slice(batch_start, batch_end)
+    # the packets are at the start of their blocks
+    packet_nus, packet_mus, packet_energies = [
+        from_shared_array((_worker_blocks[name], np.float64, (batch_end,)))[packets] for name in PACKET_ARRAY_NAMES]
+    return transport_chunks(_worker_arrays, _worker_parameters, packet_nus, packet_mus, packet_energies,
+                            first_packet_id=first_packet_id + batch_start, virtual_packet_flag=virtual_packet_flag)
+
+
+class TransportPool(object):
+    """
+    Worker processes that transport packets, kept for a whole run.
+
+    `send_plasma` copies the inputs of an iteration into blocks of shared memory, `transport` copies its packets
+    there and sends the workers only the ranges of packets to transport. A block is only replaced, which restarts
+    the workers, if an array outgrows it.
+
+    Parameters
+    ----------
+    no_of_processes : int
+        number of worker processes, 0 uses one per CPU
+    """
+
+    def __init__(self, no_of_processes=0):
+        if no_of_processes < 1:
+            no_of_processes = multiprocessing.cpu_count()
+        self.no_of_processes = no_of_processes
+        self.shared_blocks = {}
+        self.pool = None
+        self.plasma_id = 0
+        self.arrays = None
+        self.parameters = None
+
+    def copy_to_shared_block(self, name, array):
+        """
+        Copy an array into the shared memory block of the given name.
+
+        Returns
+        -------
+        array_layout : tuple
+            dtype and shape of the array
+        """
+        array = np.ascontiguousarray(array)
+        block = self.shared_blocks.get(name)
+        if block is None or len(block) < array.nbytes:
+            # the workers can only map the blocks that exist when they start
+            self.stop_workers()
+            block = sharedctypes.RawArray(ctypes.c_char, max(array.nbytes, 1))
+            self.shared_blocks[name] = block
+        array_layout = (array.dtype.str, array.shape)
+        from_shared_array((block,) + array_layout)[...] = array
+        return array_layout
+
+    def send_plasma(self, arrays, parameters):
+        """
+        Copy the transport inputs of an iteration to the workers.
+
+        Parameters
+        ----------
+        arrays : dict
+            input arrays as returned by `tardis.montecarlo.montecarlo.get_transport_arrays`
+        parameters : dict
+            scalar parameters as returned by `tardis.montecarlo.montecarlo.get_transport_parameters`
+        """
+        array_layouts = dict((name, self.copy_to_shared_block(name, array)) for name, array in arrays.items())
+        plasma = pickle.dumps((array_layouts, parameters), pickle.HIGHEST_PROTOCOL)
+        self.copy_to_shared_block(PLASMA_BLOCK, np.frombuffer(plasma, dtype=np.uint8))
+        self.plasma_id += 1
+        self.arrays = arrays
+        self.parameters = parameters
+
+    def stop_workers(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def transport(self, packet_nus, packet_mus, packet_energies, first_packet_id=0, virtual_packet_flag=0,
+                  j_blues=None, spectrum_virt_nu=None, event_counters=None):
+        """
+        Transport packets with the inputs of the last `send_plasma`.
+
+        Parameters
+        ----------
+        packet_nus, packet_mus, packet_energies : `numpy.ndarray`
+            properties of the packets
+        first_packet_id : int
+            index of the first packet within the iteration
+        virtual_packet_flag : int
+            number of virtual packets spawned per interaction
+        j_blues, spectrum_virt_nu, event_counters : `numpy.ndarray`, optional
+            estimators to add to, allocated as by `tardis.montecarlo.montecarlo.transport_packets` if not given
+
+        Returns
+        -------
+        The same arrays as `tardis.montecarlo.montecarlo.transport_packets`, bitwise identical as every packet
+        has its own random number stream and the estimators are added in the same chunks and order.
+        """
+        if self.parameters is None:
+            raise ValueError('The transport inputs have to be sent with send_plasma first')
+        j_blues, spectrum_virt_nu, event_counters = get_estimator_targets(self.arrays, self.parameters, j_blues,
+                                                                          spectrum_virt_nu, event_counters)
+
+        for name, array in zip(PACKET_ARRAY_NAMES, [packet_nus, packet_mus, packet_energies]):
+            self.copy_to_shared_block(name, np.asarray(array, dtype=np.float64))
+        batch_boundaries = get_batch_boundaries(len(packet_nus), self.no_of_processes)
+        tasks = [(self.plasma_id, int(batch_start), int(batch_end), first_packet_id, virtual_packet_flag)
+                 for batch_start, batch_end in zip(batch_boundaries[:-1], batch_boundaries[1:])]
+        logger.debug('Transporting %d packets in %d batches with %d processes', len(packet_nus), len(tasks),
+                     self.no_of_processes)
+
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.no_of_processes, initializer=_initialize_worker,
+                                             initargs=(self.shared_blocks,))
+        try:
+            batch_results = self.pool.map(_transport_batch, tasks)
+        except:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            raise
+        return add_chunk_results([chunk_result for chunk_results in batch_results for chunk_result in chunk_results],
+                                 j_blues, spectrum_virt_nu, event_counters)
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        self.stop_workers()
+        self.shared_blocks = {}
+
+
+def transport_packets_in_pool(arrays, parameters, packet_nus, packet_mus, packet_energies, first_packet_id=0,
+                              virtual_packet_flag=0, no_of_processes=0):
+    """
+    Transport packets with a `TransportPool` that is shut down afterwards.
+
+    Parameters
+    ----------
+    arrays : dict
+        input arrays as returned by `tardis.montecarlo.montecarlo.get_transport_arrays`
+    parameters : dict
+        scalar parameters as returned by `tardis.montecarlo.montecarlo.get_transport_parameters`
+    packet_nus, packet_mus, packet_energies : `numpy.ndarray`
+        properties of the packets
+    first_packet_id : int
+        index of the first packet within the iteration
+    virtual_packet_flag : int
+        number of virtual packets spawned per interaction
+    no_of_processes : int
+        number of worker processes, 0 uses one per CPU
+
+    Returns
+    -------
+    The same arrays as `tardis.montecarlo.montecarlo.transport_packets`.
+    """
+    transport_pool = TransportPool(no_of_processes)
+    try:
+        transport_pool.send_plasma(arrays, parameters)
+        return transport_pool.transport(packet_nus, packet_mus, packet_energies, first_packet_id=first_packet_id,
+                                        virtual_packet_flag=virtual_packet_flag)
+    finally:
+        transport_pool.close()
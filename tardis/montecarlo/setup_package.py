@@ -2,6 +2,7 @@
 from setuptools import Extension
 import numpy as np
 import os
+from astropy_helpers.distutils_helpers import get_distutils_option
 
 from glob import glob
 
@@ -13,7 +14,19 @@ def get_extensions():
     sources += [os.path.relpath(fname) for fname in glob(
         os.path.join(os.path.dirname(__file__), 'src/randomkit', '*.c'))]
 
+    compile_args = []
+    link_args = []
+    define_macros = []
+    if get_distutils_option('with_openmp',
+                            ['build', 'install', 'develop']) is not None:
+        compile_args.append('-fopenmp')
+        link_args.append('-fopenmp')
+        define_macros.append(('WITHOPENMP', ''))
+
     return [Extension('tardis.montecarlo.montecarlo', sources,
                       include_dirs=['tardis/montecarlo/src',
                                     'tardis/montecarlo/src/randomkit',
-                                    np.get_include()])]
+                                    np.get_include()],
+                      extra_compile_args=compile_args,
+                      extra_link_args=link_args,
+                      define_macros=define_macros)]
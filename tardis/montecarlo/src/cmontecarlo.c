@@ -1,35 +1,91 @@
 #include "cmontecarlo.h"
 
-rk_state mt_state;
-
 void
-initialize_random_kit (unsigned long seed)
+line_index_init (line_index_t * index, double *nu, int64_t number_of_lines,
+		 int64_t no_of_buckets, int64_t * bucket_starts,
+		 bool fill_buckets)
 {
-  rk_seed (seed, &mt_state);
+  int64_t i;
+  int64_t bucket;
+  double log_nu_range = 0.0;
+  index->no_of_buckets = no_of_buckets > 0 ? no_of_buckets : 1;
+  index->bucket_starts = bucket_starts;
+  index->log_nu_max = 0.0;
+  if (number_of_lines > 0)
+    {
+      index->log_nu_max = log (nu[0]);
+      log_nu_range = index->log_nu_max - log (nu[number_of_lines - 1]);
+    }
+  index->inverse_bucket_width =
+    log_nu_range > 0.0 ? index->no_of_buckets / log_nu_range : 0.0;
+  if (fill_buckets)
+    {
+      // The lines are assigned with the same function as the lookups, so
+      // the index stays exact whatever the rounding of log.
+      i = 0;
+      for (bucket = 0; bucket <= index->no_of_buckets; bucket++)
+	{
+	  while (i < number_of_lines
+		 && line_index_bucket (index, nu[i]) < bucket)
+	    {
+	      i++;
+	    }
+	  bucket_starts[bucket] = i;
+	}
+    }
+}
+
+INLINE int64_t
+line_index_bucket (line_index_t * index, double nu)
+{
+  double bucket =
+    (index->log_nu_max - log (nu)) * index->inverse_bucket_width;
+  if (bucket < 1.0)
+    {
+      return 0;
+    }
+  else if (bucket >= index->no_of_buckets)
+    {
+      return index->no_of_buckets - 1;
+    }
+  return (int64_t) bucket;
 }
 
 INLINE tardis_error_t
 line_search (double *nu, double nu_insert, int64_t number_of_lines,
-	     int64_t * result)
+	     line_index_t * index, int64_t * result)
 {
-  tardis_error_t ret_val = TARDIS_ERROR_OK;
-  int64_t imin, imax;
-  imin = 0;
-  imax = number_of_lines - 1;
-  if (nu_insert > nu[imin])
+  int64_t imin, imax, imid, bucket;
+  if (number_of_lines == 0 || nu_insert > nu[0])
     {
-      *result = imin;
+      *result = 0;
     }
-  else if (nu_insert < nu[imax])
+  else if (nu_insert < nu[number_of_lines - 1])
     {
-      *result = imax + 1;
+      *result = number_of_lines;
     }
   else
     {
-      ret_val = reverse_binary_search (nu, nu_insert, imin, imax, result);
-      *result = *result + 1;
+      // All lines before the bucket of nu_insert are bluer and all lines
+      // after it are redder than nu_insert.
+      bucket = line_index_bucket (index, nu_insert);
+      imin = index->bucket_starts[bucket];
+      imax = index->bucket_starts[bucket + 1];
+      while (imin < imax)
+	{
+	  imid = imin + (imax - imin) / 2;
+	  if (nu[imid] >= nu_insert)
+	    {
+	      imin = imid + 1;
+	    }
+	  else
+	    {
+	      imax = imid;
+	    }
+	}
+      *result = imin;
     }
-  return ret_val;
+  return TARDIS_ERROR_OK;
 }
 
 inline tardis_error_t
@@ -48,7 +104,7 @@ reverse_binary_search (double *x, double x_insert,
     }
   else
     {
-      int imid = (imin + imax) / 2;
+      int64_t imid = (imin + imax) / 2;
       while (imax - imin > 2)
 	{
 	  if (x[imid] < x_insert)
@@ -81,7 +137,7 @@ binary_search (double *x, double x_insert, int64_t imin,
      Have in mind that *x points to a sorted array.
      Like [1,2,3,4,5,...]
    */
-  int imid;
+  int64_t imid;
   tardis_error_t ret_val = TARDIS_ERROR_OK;
   if (x_insert < x[imin] || x_insert > x[imax])
     {
@@ -222,7 +278,7 @@ compute_distance2line (rpacket_t * packet, storage_model_t * storage,
 	  fprintf (stderr, "mu = %f\n", mu);
 	  fprintf (stderr, "nu = %f\n", nu);
 	  fprintf (stderr, "doppler_factor = %f\n", doppler_factor);
-	  fprintf (stderr, "cur_zone_id = %d\n", cur_zone_id);
+	  fprintf (stderr, "cur_zone_id = %" PRId64 "\n", cur_zone_id);
 	  ret_val = TARDIS_ERROR_COMOV_NU_LESS_THAN_NU_LINE;
 	}
       else
@@ -233,6 +289,17 @@ compute_distance2line (rpacket_t * packet, storage_model_t * storage,
   return ret_val;
 }
 
+/** Distance to the Thomson scatter event of a real packet. */
+TARDIS_ALWAYS_INLINE double
+compute_distance2electron_real (rpacket_t * packet, storage_model_t * storage)
+{
+  double inverse_ne =
+    storage->
+    inverse_electron_densities[rpacket_get_current_shell_id (packet)] *
+    storage->inverse_sigma_thomson;
+  return rpacket_get_tau_event (packet) * inverse_ne;
+}
+
 INLINE double
 compute_distance2electron (rpacket_t * packet, storage_model_t * storage)
 {
@@ -240,42 +307,120 @@ compute_distance2electron (rpacket_t * packet, storage_model_t * storage)
     {
       return MISS_DISTANCE;
     }
-  double inverse_ne =
-    storage->
-    inverse_electron_densities[rpacket_get_current_shell_id (packet)] *
-    storage->inverse_sigma_thomson;
-  return rpacket_get_tau_event (packet) * inverse_ne;
+  return compute_distance2electron_real (packet, storage);
+}
+
+/** Add to the count of an event in a shell if the events are counted. */
+INLINE void
+count_event (storage_model_t * storage, int64_t shell_id,
+	     event_counter_t counter, int64_t count)
+{
+  if (storage->event_counters != NULL)
+    {
+      storage->event_counters[shell_id * TARDIS_NO_OF_COUNTERS + counter] +=
+	count;
+    }
+}
+
+/** Write a packet trace record if the current packet is traced.
+ *
+ * The records go into a ring buffer, the position is advanced atomically so
+ * several threads can trace at the same time.
+ */
+static void
+write_packet_trace_record (rpacket_t * packet, storage_model_t * storage,
+			   packet_event_t event_type, int64_t line_id)
+{
+  int64_t position;
+  packet_trace_record_t *record;
+#ifdef WITHOPENMP
+#pragma omp atomic capture
+#endif
+  position = (*storage->packet_trace_position)++;
+  record = &storage->packet_trace[position % storage->packet_trace_size];
+  record->packet_id = storage->first_packet_id + storage->current_packet_id;
+  record->iteration = storage->packet_trace_iteration;
+  record->event_type = event_type;
+  record->shell_id = rpacket_get_current_shell_id (packet);
+  record->r = rpacket_get_r (packet);
+  record->mu = rpacket_get_mu (packet);
+  record->nu = rpacket_get_nu (packet);
+  record->line_id = line_id;
+}
+
+/** Trace an event of a real packet if the packet trace is switched on. */
+static INLINE void
+trace_packet_event (rpacket_t * packet, storage_model_t * storage,
+		    packet_event_t event_type, int64_t line_id)
+{
+  if (storage->packet_trace != NULL &&
+      (storage->first_packet_id + storage->current_packet_id) %
+      storage->packet_trace_stride == 0)
+    {
+      write_packet_trace_record (packet, storage, event_type, line_id);
+    }
+}
+
+/** Cumulative transition probability of a transition in a shell, from the
+ * single or the double precision table. */
+INLINE double
+cumulative_transition_probability (storage_model_t * storage,
+				   int64_t shell_id, int64_t transition_id)
+{
+  int64_t idx = shell_id * storage->transition_probabilities_nd +
+    transition_id;
+  if (storage->cumulative_transition_probabilities_single != NULL)
+    {
+      return storage->cumulative_transition_probabilities_single[idx];
+    }
+  return storage->cumulative_transition_probabilities[idx];
 }
 
 INLINE int64_t
-macro_atom (rpacket_t * packet, storage_model_t * storage)
+macro_atom (rpacket_t * packet, storage_model_t * storage,
+	    philox_state_t * rng_state)
 {
-  int emit = 0, i = 0;
-  double p, event_random;
-  int activate_level =
+  int64_t emit = 0, i = 0;
+  int64_t imin, imax, imid;
+  double event_random;
+  int64_t shell_id = rpacket_get_current_shell_id (packet);
+  int64_t activate_level =
     storage->line2macro_level_upper[rpacket_get_next_line_id (packet) - 1];
   while (emit != -1)
     {
-      event_random = rk_double (&mt_state);
-      i = storage->macro_block_references[activate_level] - 1;
-      p = 0.0;
-      do
+      event_random = philox_double (rng_state);
+      // First transition of the block whose cumulative probability exceeds
+      // event_random, or the last one if rounding left the sum below it.
+      imin = storage->macro_block_references[activate_level];
+      imax = storage->macro_block_references[activate_level + 1] - 1;
+      while (imin < imax)
 	{
-	  p +=
-	    storage->
-	    transition_probabilities[rpacket_get_current_shell_id (packet) *
-				     storage->transition_probabilities_nd +
-				     (++i)];
+	  imid = imin + (imax - imin) / 2;
+	  if (cumulative_transition_probability (storage, shell_id, imid) >
+	      event_random)
+	    {
+	      imax = imid;
+	    }
+	  else
+	    {
+	      imin = imid + 1;
+	    }
 	}
-      while (p <= event_random);
+      i = imin;
       emit = storage->transition_type[i];
       activate_level = storage->destination_level_id[i];
+      if (emit != -1)
+	{
+	  count_event (storage, shell_id, TARDIS_COUNTER_MACRO_ATOM_JUMPS, 1);
+	}
     }
   return storage->transition_line_id[i];
 }
 
-INLINE double
-move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
+/** Move a packet, with a constant is_virtual in the specialized kernels. */
+TARDIS_ALWAYS_INLINE double
+move_packet_kernel (rpacket_t * packet, storage_model_t * storage,
+		    double distance, bool is_virtual)
 {
   double new_r, doppler_factor, comov_energy, comov_nu;
   doppler_factor = rpacket_doppler_factor (packet, storage);
@@ -288,7 +433,7 @@ move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
       rpacket_set_mu (packet,
 		      (rpacket_get_mu (packet) * r + distance) / new_r);
       rpacket_set_r (packet, new_r);
-      if (rpacket_get_virtual_packet (packet) <= 0)
+      if (!is_virtual)
 	{
 	  comov_energy = rpacket_get_energy (packet) * doppler_factor;
 	  comov_nu = rpacket_get_nu (packet) * doppler_factor;
@@ -301,12 +446,105 @@ move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
   return doppler_factor;
 }
 
+INLINE double
+move_packet (rpacket_t * packet, storage_model_t * storage, double distance)
+{
+  return move_packet_kernel (packet, storage, distance,
+			     rpacket_get_virtual_packet (packet) > 0);
+}
+
+/** Index of the j_blue estimator of a line in a shell, or -1 if the
+ * estimator of the line is not accumulated. */
+static INLINE int64_t
+line_j_blue_index (storage_model_t * storage, int64_t shell_id,
+		   int64_t line_id)
+{
+  int64_t j_blue_line_id = storage->j_blue_line_ids == NULL ? line_id :
+    storage->j_blue_line_ids[line_id];
+  if (j_blue_line_id < 0)
+    {
+      return -1;
+    }
+  return shell_id * storage->line_lists_j_blues_nd + j_blue_line_id;
+}
+
+/** Position of the first line at or after line_id in storage->j_blue_lines. */
+static INLINE int64_t
+first_j_blue_line (storage_model_t * storage, int64_t line_id)
+{
+  int64_t imin = 0, imax = storage->line_lists_j_blues_nd, imid;
+  while (imin < imax)
+    {
+      imid = imin + (imax - imin) / 2;
+      if (storage->j_blue_lines[imid] < line_id)
+	{
+	  imin = imid + 1;
+	}
+      else
+	{
+	  imax = imid;
+	}
+    }
+  return imin;
+}
+
+/** Append an increment to a log, doubling its capacity if it is full. */
+void
+estimator_log_append (estimator_log_t * log, int64_t index, double value)
+{
+  int64_t *indices;
+  double *values;
+  if (log->size == log->capacity)
+    {
+      indices = (int64_t *) realloc (log->indices,
+				     2 * log->capacity * sizeof (int64_t));
+      if (indices != NULL)
+	{
+	  log->indices = indices;
+	}
+      values = (double *) realloc (log->values,
+				   2 * log->capacity * sizeof (double));
+      if (values != NULL)
+	{
+	  log->values = values;
+	}
+      if (indices == NULL || values == NULL)
+	{
+	  log->allocation_failed = 1;
+	  return;
+	}
+      log->capacity *= 2;
+    }
+  log->indices[log->size] = index;
+  log->values[log->size] = value;
+  log->size++;
+}
+
+/** Add to an estimator array, or to its log if there is one. */
+INLINE void
+add_to_estimator (estimator_log_t * log, double *estimator, int64_t index,
+		  double value)
+{
+  if (log != NULL)
+    {
+      estimator_log_append (log, index, value);
+    }
+  else
+    {
+      estimator[index] += value;
+    }
+}
+
 INLINE void
 increment_j_blue_estimator (rpacket_t * packet, storage_model_t * storage,
 			    double d_line, int64_t j_blue_idx)
 {
   double comov_energy, r_interaction, mu_interaction, doppler_factor;
   double r = rpacket_get_r (packet);
+  if (j_blue_idx < 0)
+    {
+      return;
+    }
   r_interaction =
     sqrt (r * r + d_line * d_line +
 	  2.0 * r * d_line * rpacket_get_mu (packet));
@@ -314,13 +552,13 @@ increment_j_blue_estimator (rpacket_t * packet, storage_model_t * storage,
   doppler_factor = 1.0 - mu_interaction * r_interaction *
     storage->inverse_time_explosion * INVERSE_C;
   comov_energy = rpacket_get_energy (packet) * doppler_factor;
-  storage->line_lists_j_blues[j_blue_idx] +=
-    comov_energy / rpacket_get_nu (packet);
+  add_to_estimator (storage->j_blue_log, storage->line_lists_j_blues,
+		    j_blue_idx, comov_energy / rpacket_get_nu (packet));
 }
 
 int64_t
 montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
-		       int64_t virtual_mode)
+		       int64_t virtual_mode, philox_state_t * rng_state)
 {
   int64_t i;
   rpacket_t virt_packet;
@@ -332,10 +570,14 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
   int64_t reabsorbed;
   if (virtual_mode == 0)
     {
-      reabsorbed = montecarlo_one_packet_loop (storage, packet, 0);
+      reabsorbed =
+	montecarlo_one_packet_loop (storage, packet, 0, rng_state);
     }
   else
     {
+      count_event (storage, rpacket_get_current_shell_id (packet),
+		   TARDIS_COUNTER_VIRTUAL_PACKETS,
+		   rpacket_get_virtual_packet_flag (packet));
       for (i = 0; i < rpacket_get_virtual_packet_flag (packet); i++)
 	{
 	  memcpy ((void *) &virt_packet, (void *) packet, sizeof (rpacket_t));
@@ -351,7 +593,7 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
 	      mu_min = 0.0;
 	    }
 	  mu_bin = (1.0 - mu_min) / rpacket_get_virtual_packet_flag (packet);
-	  virt_packet.mu = mu_min + (i + rk_double (&mt_state)) * mu_bin;
+	  virt_packet.mu = mu_min + (i + philox_double (rng_state)) * mu_bin;
 	  switch (virtual_mode)
 	    {
 	    case -2:
@@ -376,7 +618,15 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
 	  virt_packet.energy =
 	    rpacket_get_energy (packet) * doppler_factor_ratio;
 	  virt_packet.nu = rpacket_get_nu (packet) * doppler_factor_ratio;
-	  reabsorbed = montecarlo_one_packet_loop (storage, &virt_packet, 1);
+	  // The frequency of a virtual packet does not change on its way out,
+	  // so a packet outside the spectrum does not need to be followed.
+	  if ((virt_packet.nu >= storage->spectrum_end_nu) ||
+	      (virt_packet.nu <= storage->spectrum_start_nu))
+	    {
+	      continue;
+	    }
+	  reabsorbed =
+	    montecarlo_one_packet_loop (storage, &virt_packet, 1, rng_state);
 	  if ((virt_packet.nu < storage->spectrum_end_nu) &&
 	      (virt_packet.nu > storage->spectrum_start_nu))
 	    {
@@ -384,21 +634,37 @@ montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
 		floor ((virt_packet.nu -
 			storage->spectrum_start_nu) /
 		       storage->spectrum_delta_nu);
-	      storage->spectrum_virt_nu[virt_id_nu] +=
-		virt_packet.energy * weight;
+	      add_to_estimator (storage->spectrum_virt_nu_log,
+				storage->spectrum_virt_nu, virt_id_nu,
+				virt_packet.energy * weight);
 	    }
 	}
     }
   return reabsorbed;
 }
 
-void
-move_packet_across_shell_boundary (rpacket_t * packet,
-				   storage_model_t * storage, double distance)
+/** Cross a shell boundary.
+ *
+ * The specialized kernels pass constant flags, so the compiler removes the
+ * branches on the packet type, the inner boundary and virtual packets.
+ */
+static TARDIS_ALWAYS_INLINE void
+move_packet_across_shell_boundary_kernel (rpacket_t * packet,
+					  storage_model_t * storage,
+					  double distance,
+					  philox_state_t * rng_state,
+					  bool is_virtual, bool reflective,
+					  bool spawn_virtual)
 {
   double comov_energy, doppler_factor, comov_nu, inverse_doppler_factor;
-  move_packet (packet, storage, distance);
-  if (rpacket_get_virtual_packet (packet) > 0)
+  move_packet_kernel (packet, storage, distance, is_virtual);
+  if (!is_virtual)
+    {
+      count_event (storage, rpacket_get_current_shell_id (packet),
+		   TARDIS_COUNTER_BOUNDARY_CROSSINGS, 1);
+      trace_packet_event (packet, storage, TARDIS_PACKET_EVENT_BOUNDARY, -1);
+    }
+  if (is_virtual)
     {
       double delta_tau_event = distance *
 	storage->electron_densities[rpacket_get_current_shell_id (packet)] *
@@ -409,7 +675,7 @@ move_packet_across_shell_boundary (rpacket_t * packet,
     }
   else
     {
-      rpacket_reset_tau_event (packet);
+      rpacket_reset_tau_event (packet, rng_state);
     }
   if ((rpacket_get_current_shell_id (packet) < storage->no_of_shells - 1
        && rpacket_get_next_shell_id (packet) == 1)
@@ -427,8 +693,8 @@ move_packet_across_shell_boundary (rpacket_t * packet,
     {
       rpacket_set_status (packet, TARDIS_PACKET_STATUS_EMITTED);
     }
-  else if ((storage->reflective_inner_boundary == 0) ||
-	   (rk_double (&mt_state) > storage->inner_boundary_albedo))
+  else if (!reflective ||
+	   (philox_double (rng_state) > storage->inner_boundary_albedo))
     {
       rpacket_set_status (packet, TARDIS_PACKET_STATUS_REABSORBED);
     }
@@ -437,42 +703,94 @@ move_packet_across_shell_boundary (rpacket_t * packet,
       doppler_factor = rpacket_doppler_factor (packet, storage);
       comov_nu = rpacket_get_nu (packet) * doppler_factor;
       comov_energy = rpacket_get_energy (packet) * doppler_factor;
-      rpacket_set_mu (packet, rk_double (&mt_state));
+      rpacket_set_mu (packet, philox_double (rng_state));
       inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
       rpacket_set_nu (packet, comov_nu * inverse_doppler_factor);
       rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
       rpacket_set_recently_crossed_boundary (packet, 1);
-      if (rpacket_get_virtual_packet_flag (packet) > 0)
+      if (spawn_virtual)
 	{
-	  montecarlo_one_packet (storage, packet, -2);
+	  montecarlo_one_packet (storage, packet, -2, rng_state);
 	}
     }
 }
 
 void
-montecarlo_thomson_scatter (rpacket_t * packet, storage_model_t * storage,
-			    double distance)
+move_packet_across_shell_boundary (rpacket_t * packet,
+				   storage_model_t * storage, double distance,
+				   philox_state_t * rng_state)
+{
+  move_packet_across_shell_boundary_kernel (packet, storage, distance,
+					    rng_state,
+					    rpacket_get_virtual_packet (packet)
+					    > 0,
+					    storage->reflective_inner_boundary
+					    != 0,
+					    rpacket_get_virtual_packet_flag
+					    (packet) > 0);
+}
+
+/** Thomson scatter of a real packet. */
+static TARDIS_ALWAYS_INLINE void
+montecarlo_thomson_scatter_kernel (rpacket_t * packet,
+				   storage_model_t * storage, double distance,
+				   philox_state_t * rng_state,
+				   bool spawn_virtual)
 {
   double comov_energy, doppler_factor, comov_nu, inverse_doppler_factor;
-  doppler_factor = move_packet (packet, storage, distance);
+  count_event (storage, rpacket_get_current_shell_id (packet),
+	       TARDIS_COUNTER_ELECTRON_SCATTERS, 1);
+  doppler_factor = move_packet_kernel (packet, storage, distance, false);
+  trace_packet_event (packet, storage, TARDIS_PACKET_EVENT_ELECTRON, -1);
   comov_nu = rpacket_get_nu (packet) * doppler_factor;
   comov_energy = rpacket_get_energy (packet) * doppler_factor;
-  rpacket_set_mu (packet, 2.0 * rk_double (&mt_state) - 1.0);
+  rpacket_set_mu (packet, 2.0 * philox_double (rng_state) - 1.0);
   inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
   rpacket_set_nu (packet, comov_nu * inverse_doppler_factor);
   rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
-  rpacket_reset_tau_event (packet);
+  rpacket_reset_tau_event (packet, rng_state);
   rpacket_set_recently_crossed_boundary (packet, 0);
   storage->last_interaction_type[storage->current_packet_id] = 1;
-  if (rpacket_get_virtual_packet_flag (packet) > 0)
+  if (spawn_virtual)
     {
-      montecarlo_one_packet (storage, packet, 1);
+      montecarlo_one_packet (storage, packet, 1, rng_state);
     }
 }
 
 void
-montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
-			 double distance)
+montecarlo_thomson_scatter (rpacket_t * packet, storage_model_t * storage,
+			    double distance, philox_state_t * rng_state)
+{
+  montecarlo_thomson_scatter_kernel (packet, storage, distance, rng_state,
+				     rpacket_get_virtual_packet_flag (packet)
+				     > 0);
+}
+
+/** tau_sobolev of a line in a shell, from the single or the double precision
+ * table. */
+static INLINE double
+line_tau_sobolev (storage_model_t * storage, int64_t shell_id,
+		  int64_t line_id)
+{
+  int64_t idx = shell_id * storage->line_lists_tau_sobolevs_nd + line_id;
+  if (storage->line_lists_tau_sobolevs_single != NULL)
+    {
+      return storage->line_lists_tau_sobolevs_single[idx];
+    }
+  return storage->line_lists_tau_sobolevs[idx];
+}
+
+/** Pass or interact with a line.
+ *
+ * line_interaction_id is 0 for scatter and 1 for the macro atom (downbranch
+ * and macroatom); the specialized kernels pass constant arguments.
+ */
+static TARDIS_ALWAYS_INLINE void
+montecarlo_line_scatter_kernel (rpacket_t * packet,
+				storage_model_t * storage, double distance,
+				philox_state_t * rng_state,
+				int64_t line_interaction_id, bool is_virtual,
+				bool spawn_virtual)
 {
   double comov_energy = 0.0;
   int64_t emission_line_id = 0;
@@ -483,17 +801,18 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
   double tau_combined = 0.0;
   bool virtual_close_line = false;
   int64_t j_blue_idx = -1;
-  if (rpacket_get_virtual_packet (packet) == 0)
+  if (!is_virtual)
     {
+      count_event (storage, rpacket_get_current_shell_id (packet),
+		   TARDIS_COUNTER_LINE_STEPS, 1);
       j_blue_idx =
-	rpacket_get_current_shell_id (packet) *
-	storage->line_lists_j_blues_nd + rpacket_get_next_line_id (packet);
+	line_j_blue_index (storage, rpacket_get_current_shell_id (packet),
+			   rpacket_get_next_line_id (packet));
       increment_j_blue_estimator (packet, storage, distance, j_blue_idx);
     }
-  tau_line =
-    storage->line_lists_tau_sobolevs[rpacket_get_current_shell_id (packet) *
-				     storage->line_lists_tau_sobolevs_nd +
-				     rpacket_get_next_line_id (packet)];
+  tau_line = line_tau_sobolev (storage,
+			       rpacket_get_current_shell_id (packet),
+			       rpacket_get_next_line_id (packet));
   tau_electron =
     storage->sigma_thomson *
     storage->electron_densities[rpacket_get_current_shell_id (packet)] *
@@ -504,15 +823,20 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
     {
       rpacket_set_last_line (packet, true);
     }
-  if (rpacket_get_virtual_packet (packet) > 0)
+  if (is_virtual)
     {
       rpacket_set_tau_event (packet,
 			     rpacket_get_tau_event (packet) + tau_line);
     }
   else if (rpacket_get_tau_event (packet) < tau_combined)
     {
-      old_doppler_factor = move_packet (packet, storage, distance);
-      rpacket_set_mu (packet, 2.0 * rk_double (&mt_state) - 1.0);
+      count_event (storage, rpacket_get_current_shell_id (packet),
+		   TARDIS_COUNTER_LINE_INTERACTIONS, 1);
+      old_doppler_factor = move_packet_kernel (packet, storage, distance,
+					       false);
+      trace_packet_event (packet, storage, TARDIS_PACKET_EVENT_LINE,
+			  rpacket_get_next_line_id (packet) - 1);
+      rpacket_set_mu (packet, 2.0 * philox_double (rng_state) - 1.0);
       inverse_doppler_factor = 1.0 / rpacket_doppler_factor (packet, storage);
       comov_energy = rpacket_get_energy (packet) * old_doppler_factor;
       rpacket_set_energy (packet, comov_energy * inverse_doppler_factor);
@@ -521,13 +845,13 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
       storage->last_line_interaction_shell_id[storage->current_packet_id] =
 	rpacket_get_current_shell_id (packet);
       storage->last_interaction_type[storage->current_packet_id] = 2;
-      if (storage->line_interaction_id == 0)
+      if (line_interaction_id == 0)
 	{
 	  emission_line_id = rpacket_get_next_line_id (packet) - 1;
 	}
-      else if (storage->line_interaction_id >= 1)
+      else if (line_interaction_id >= 1)
 	{
-	  emission_line_id = macro_atom (packet, storage);
+	  emission_line_id = macro_atom (packet, storage, rng_state);
 	}
       storage->last_line_interaction_out_id[storage->current_packet_id] =
 	emission_line_id;
@@ -536,9 +860,9 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
 		      inverse_doppler_factor);
       rpacket_set_nu_line (packet, storage->line_list_nu[emission_line_id]);
       rpacket_set_next_line_id (packet, emission_line_id + 1);
-      rpacket_reset_tau_event (packet);
+      rpacket_reset_tau_event (packet, rng_state);
       rpacket_set_recently_crossed_boundary (packet, 0);
-      if (rpacket_get_virtual_packet_flag (packet) > 0)
+      if (spawn_virtual)
 	{
 	  virtual_close_line = false;
 	  if (!rpacket_get_last_line (packet) &&
@@ -551,7 +875,7 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
 	  // QUESTIONABLE!!!
 	  bool old_close_line = rpacket_get_close_line (packet);
 	  rpacket_set_close_line (packet, virtual_close_line);
-	  montecarlo_one_packet (storage, packet, 1);
+	  montecarlo_one_packet (storage, packet, 1, rng_state);
 	  rpacket_set_close_line (packet, old_close_line);
 	  virtual_close_line = false;
 	}
@@ -570,6 +894,17 @@ montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
     }
 }
 
+void
+montecarlo_line_scatter (rpacket_t * packet, storage_model_t * storage,
+			 double distance, philox_state_t * rng_state)
+{
+  montecarlo_line_scatter_kernel (packet, storage, distance, rng_state,
+				  storage->line_interaction_id,
+				  rpacket_get_virtual_packet (packet) > 0,
+				  rpacket_get_virtual_packet_flag (packet) >
+				  0);
+}
+
 INLINE void
 montecarlo_compute_distances (rpacket_t * packet, storage_model_t * storage)
 {
@@ -621,10 +956,259 @@ get_event_handler (rpacket_t * packet, storage_model_t * storage,
   return handler;
 }
 
+/** Distance from the current position of a packet to a line. */
+static double
+compute_distance2line_id (rpacket_t * packet, storage_model_t * storage,
+			  int64_t line_id)
+{
+  double nu = rpacket_get_nu (packet);
+  double doppler_factor =
+    1.0 - rpacket_get_mu (packet) * rpacket_get_r (packet) *
+    storage->inverse_time_explosion * INVERSE_C;
+  double comov_nu = nu * doppler_factor;
+  return ((comov_nu - storage->line_list_nu[line_id]) / nu) * C *
+    storage->time_explosion;
+}
+
+/** Let a packet pass all lines before line_id without moving it. */
+static void
+rpacket_skip_to_line (rpacket_t * packet, storage_model_t * storage,
+		      int64_t line_id)
+{
+  rpacket_set_next_line_id (packet, line_id);
+  rpacket_set_last_line (packet, line_id == storage->no_of_lines);
+  if (!rpacket_get_last_line (packet))
+    {
+      rpacket_set_nu_line (packet, storage->line_list_nu[line_id]);
+    }
+}
+
+/** Move the next line of a packet to the next line that is not pruned in
+ * its shell. */
+static void
+montecarlo_skip_pruned_lines (rpacket_t * packet, storage_model_t * storage)
+{
+  int64_t next_line_id = rpacket_get_next_line_id (packet);
+  int64_t active_line_id =
+    storage->next_active_line_ids[rpacket_get_current_shell_id (packet) *
+				  (storage->no_of_lines + 1) + next_line_id];
+  if (active_line_id != next_line_id)
+    {
+      rpacket_skip_to_line (packet, storage, active_line_id);
+      // The line close to the last one was pruned.
+      rpacket_set_close_line (packet, false);
+    }
+}
+
+/** Index of the first line behind a distance, searched from the next line
+ * of the packet. */
+static int64_t
+find_reachable_line_end (rpacket_t * packet, storage_model_t * storage,
+			 double distance)
+{
+  int64_t imin = rpacket_get_next_line_id (packet);
+  int64_t imax = storage->no_of_lines;
+  int64_t imid;
+  while (imin < imax)
+    {
+      imid = imin + (imax - imin) / 2;
+      if (compute_distance2line_id (packet, storage, imid) <= distance)
+	{
+	  imin = imid + 1;
+	}
+      else
+	{
+	  imax = imid;
+	}
+    }
+  return imin;
+}
+
+/** Next event of a virtual packet with the cumulative line optical depths
+ * of its shell.
+ *
+ * The optical depth of all lines in front of the shell boundary is added
+ * at once. If there are no such lines, the packet crosses the boundary.
+ */
+static void
+montecarlo_cumulative_tau_virtual_event (rpacket_t * packet,
+					 storage_model_t * storage,
+					 philox_state_t * rng_state)
+{
+  int64_t first_line_id = rpacket_get_next_line_id (packet);
+  int64_t reachable_end;
+  double *cumulative_taus = storage->cumulative_line_tau_sobolevs +
+    rpacket_get_current_shell_id (packet) * (storage->no_of_lines + 1);
+  double d_boundary = compute_distance2boundary (packet, storage);
+  rpacket_set_d_boundary (packet, d_boundary);
+  reachable_end = find_reachable_line_end (packet, storage, d_boundary);
+  if (reachable_end > first_line_id)
+    {
+      rpacket_set_tau_event (packet, rpacket_get_tau_event (packet) +
+			     (cumulative_taus[reachable_end] -
+			      cumulative_taus[first_line_id]));
+      rpacket_skip_to_line (packet, storage, reachable_end);
+    }
+  else
+    {
+      move_packet_across_shell_boundary (packet, storage, d_boundary,
+					 rng_state);
+    }
+}
+
+/** Find and handle the next event of a packet with the cumulative line
+ * optical depths of its shell.
+ *
+ * Instead of stepping from line to line, a binary search finds the first
+ * line in front of the shell boundary at which the optical depth of the
+ * lines passed so far plus the electron optical depth up to the line
+ * exceeds tau_event. The packet then scatters on that line or on an electron
+ * before it; if there is no such line it scatters on an electron or crosses
+ * the boundary. The j_blue estimators of the lines passed are incremented as
+ * in montecarlo_line_scatter.
+ */
+static void
+montecarlo_cumulative_tau_event (rpacket_t * packet,
+				 storage_model_t * storage,
+				 philox_state_t * rng_state)
+{
+  int64_t shell_id = rpacket_get_current_shell_id (packet);
+  int64_t first_line_id = rpacket_get_next_line_id (packet);
+  int64_t reachable_end, event_line_id, line_id, imin, imax, imid, i;
+  double *cumulative_taus = storage->cumulative_line_tau_sobolevs +
+    shell_id * (storage->no_of_lines + 1);
+  double electron_tau_per_distance =
+    storage->sigma_thomson * storage->electron_densities[shell_id];
+  double tau_event = rpacket_get_tau_event (packet);
+  double d_boundary, d_electron, d_line;
+  d_boundary = compute_distance2boundary (packet, storage);
+  rpacket_set_d_boundary (packet, d_boundary);
+  reachable_end = find_reachable_line_end (packet, storage, d_boundary);
+  // Both the line and the electron optical depth up to a line grow along
+  // the line list, so the first line with an event can be bisected.
+  imin = first_line_id;
+  imax = reachable_end;
+  while (imin < imax)
+    {
+      imid = imin + (imax - imin) / 2;
+      if (tau_event < cumulative_taus[imid + 1] -
+	  cumulative_taus[first_line_id] +
+	  electron_tau_per_distance *
+	  compute_distance2line_id (packet, storage, imid))
+	{
+	  imax = imid;
+	}
+      else
+	{
+	  imin = imid + 1;
+	}
+    }
+  event_line_id = imin;
+  count_event (storage, shell_id, TARDIS_COUNTER_LINE_STEPS,
+	       event_line_id - first_line_id);
+  // Only the lines with an estimator are visited, not every line passed.
+  if (storage->j_blue_lines != NULL)
+    {
+      for (i = first_j_blue_line (storage, first_line_id);
+	   i < storage->line_lists_j_blues_nd &&
+	   storage->j_blue_lines[i] < event_line_id; i++)
+	{
+	  line_id = storage->j_blue_lines[i];
+	  increment_j_blue_estimator (packet, storage,
+				      compute_distance2line_id (packet,
+								storage,
+								line_id),
+				      line_j_blue_index (storage, shell_id,
+							 line_id));
+	}
+    }
+  else
+    {
+      for (line_id = first_line_id; line_id < event_line_id; line_id++)
+	{
+	  increment_j_blue_estimator (packet, storage,
+				      compute_distance2line_id (packet,
+								storage,
+								line_id),
+				      line_j_blue_index (storage, shell_id,
+							 line_id));
+	}
+    }
+  rpacket_set_tau_event (packet, tau_event -
+			 (cumulative_taus[event_line_id] -
+			  cumulative_taus[first_line_id]));
+  rpacket_skip_to_line (packet, storage, event_line_id);
+  d_electron = compute_distance2electron (packet, storage);
+  rpacket_set_d_electron (packet, d_electron);
+  if (event_line_id < reachable_end)
+    {
+      d_line = compute_distance2line_id (packet, storage, event_line_id);
+      rpacket_set_d_line (packet, d_line);
+      if (d_line <= d_electron)
+	{
+	  montecarlo_line_scatter (packet, storage, d_line, rng_state);
+	}
+      else
+	{
+	  montecarlo_thomson_scatter (packet, storage, d_electron, rng_state);
+	}
+    }
+  else if (d_boundary <= d_electron)
+    {
+      move_packet_across_shell_boundary (packet, storage, d_boundary,
+					 rng_state);
+    }
+  else
+    {
+      montecarlo_thomson_scatter (packet, storage, d_electron, rng_state);
+    }
+}
+
+/** Find and handle the next event of a packet. */
+static void
+montecarlo_packet_event (rpacket_t * packet, storage_model_t * storage,
+			 philox_state_t * rng_state)
+{
+  double distance;
+  // Skip the lines pruned in the current shell.
+  if (storage->next_active_line_ids != NULL)
+    {
+      montecarlo_skip_pruned_lines (packet, storage);
+    }
+  // Check if we are at the end of line list.
+  if (!rpacket_get_last_line (packet))
+    {
+      rpacket_set_nu_line (packet,
+			   storage->
+			   line_list_nu[rpacket_get_next_line_id (packet)]);
+    }
+  // A close line is handled by the stepping below, which puts it at
+  // distance 0.
+  if (storage->cumulative_line_tau_sobolevs != NULL &&
+      rpacket_get_virtual_packet (packet) > 0 &&
+      !rpacket_get_close_line (packet))
+    {
+      montecarlo_cumulative_tau_virtual_event (packet, storage, rng_state);
+    }
+  else if (storage->cumulative_line_tau_sobolevs != NULL &&
+	   storage->cumulative_tau_real_packets &&
+	   rpacket_get_virtual_packet (packet) == 0 &&
+	   !rpacket_get_close_line (packet))
+    {
+      montecarlo_cumulative_tau_event (packet, storage, rng_state);
+    }
+  else
+    {
+      get_event_handler (packet, storage, &distance) (packet, storage,
+						      distance, rng_state);
+    }
+}
+
 int64_t
 montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
-			    int64_t virtual_packet)
+			    int64_t virtual_packet, philox_state_t * rng_state)
 {
+  bool roulette_played = false;
   rpacket_set_tau_event (packet, 0.0);
   rpacket_set_nu_line (packet, 0.0);
   rpacket_set_virtual_packet (packet, virtual_packet);
@@ -632,27 +1216,37 @@ montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
   // Initializing tau_event if it's a real packet.
   if (virtual_packet == 0)
     {
-      rpacket_reset_tau_event (packet);
+      rpacket_reset_tau_event (packet, rng_state);
     }
   // For a virtual packet tau_event is the sum of all the tau's that the packet passes.
   while (rpacket_get_status (packet) == TARDIS_PACKET_STATUS_IN_PROCESS)
     {
-      // Check if we are at the end of line list.
-      if (!rpacket_get_last_line (packet))
-	{
-	  rpacket_set_nu_line (packet,
-			       storage->
-			       line_list_nu[rpacket_get_next_line_id
-					    (packet)]);
-	}
-      double distance;
-      get_event_handler (packet, storage, &distance) (packet, storage,
-						      distance);
+      montecarlo_packet_event (packet, storage, rng_state);
       if (virtual_packet > 0 && rpacket_get_tau_event (packet) > 10.0)
 	{
 	  rpacket_set_tau_event (packet, 100.0);
 	  rpacket_set_status (packet, TARDIS_PACKET_STATUS_EMITTED);
 	}
+      else if (virtual_packet > 0 && !roulette_played &&
+	       storage->virtual_packet_roulette_tau > 0.0 &&
+	       rpacket_get_tau_event (packet) >
+	       storage->virtual_packet_roulette_tau)
+	{
+	  // Russian roulette: a surviving packet carries the energy of the
+	  // killed ones, so the expected contribution stays the same.
+	  roulette_played = true;
+	  if (philox_double (rng_state) <
+	      storage->virtual_packet_roulette_survival)
+	    {
+	      rpacket_set_energy (packet, rpacket_get_energy (packet) /
+				  storage->virtual_packet_roulette_survival);
+	    }
+	  else
+	    {
+	      rpacket_set_energy (packet, 0.0);
+	      rpacket_set_status (packet, TARDIS_PACKET_STATUS_EMITTED);
+	    }
+	}
     }
   if (virtual_packet > 0)
     {
@@ -665,25 +1259,936 @@ montecarlo_one_packet_loop (storage_model_t * storage, rpacket_t * packet,
     TARDIS_PACKET_STATUS_REABSORBED ? 1 : 0;
 }
 
+/** Transport a real packet until it leaves the ejecta.
+ *
+ * Does the same as montecarlo_one_packet_loop for a real packet that steps
+ * through the line list, but with the line interaction type (0 scatter, 1
+ * macro atom), the spawning of virtual packets and the reflective inner
+ * boundary as constant arguments. The instances below are compiled without
+ * the branches on these settings and without the event handler pointers of
+ * get_event_handler.
+ */
+static TARDIS_ALWAYS_INLINE int64_t
+montecarlo_real_packet_loop_kernel (storage_model_t * storage,
+				    rpacket_t * packet,
+				    philox_state_t * rng_state,
+				    int64_t line_interaction_id,
+				    bool spawn_virtual, bool reflective)
+{
+  double d_boundary, d_electron, d_line;
+  rpacket_set_tau_event (packet, 0.0);
+  rpacket_set_nu_line (packet, 0.0);
+  rpacket_set_virtual_packet (packet, 0);
+  rpacket_set_status (packet, TARDIS_PACKET_STATUS_IN_PROCESS);
+  rpacket_reset_tau_event (packet, rng_state);
+  while (rpacket_get_status (packet) == TARDIS_PACKET_STATUS_IN_PROCESS)
+    {
+      if (storage->next_active_line_ids != NULL)
+	{
+	  montecarlo_skip_pruned_lines (packet, storage);
+	}
+      if (!rpacket_get_last_line (packet))
+	{
+	  rpacket_set_nu_line (packet,
+			       storage->
+			       line_list_nu[rpacket_get_next_line_id (packet)]);
+	}
+      if (rpacket_get_close_line (packet))
+	{
+	  rpacket_set_d_line (packet, 0.0);
+	  rpacket_set_close_line (packet, false);
+	}
+      else
+	{
+	  rpacket_set_d_boundary (packet,
+				  compute_distance2boundary (packet, storage));
+	  compute_distance2line (packet, storage, &d_line);
+	  rpacket_set_d_line (packet, d_line);
+	  rpacket_set_d_electron (packet,
+				  compute_distance2electron_real (packet,
+								  storage));
+	}
+      d_boundary = rpacket_get_d_boundary (packet);
+      d_electron = rpacket_get_d_electron (packet);
+      d_line = rpacket_get_d_line (packet);
+      if (d_line <= d_boundary && d_line <= d_electron)
+	{
+	  montecarlo_line_scatter_kernel (packet, storage, d_line, rng_state,
+					  line_interaction_id, false,
+					  spawn_virtual);
+	}
+      else if (d_boundary <= d_electron)
+	{
+	  move_packet_across_shell_boundary_kernel (packet, storage,
+						    d_boundary, rng_state,
+						    false, reflective,
+						    spawn_virtual);
+	}
+      else
+	{
+	  montecarlo_thomson_scatter_kernel (packet, storage, d_electron,
+					     rng_state, spawn_virtual);
+	}
+    }
+  return rpacket_get_status (packet) ==
+    TARDIS_PACKET_STATUS_REABSORBED ? 1 : 0;
+}
+
+typedef int64_t (*montecarlo_real_packet_loop_t) (storage_model_t * storage,
+						  rpacket_t * packet,
+						  philox_state_t *
+						  rng_state);
+
+#define TARDIS_DEFINE_REAL_PACKET_LOOP(name, line_interaction_id,	\
+				       spawn_virtual, reflective)	\
+  static int64_t							\
+  name (storage_model_t * storage, rpacket_t * packet,			\
+	philox_state_t * rng_state)					\
+  {									\
+    return montecarlo_real_packet_loop_kernel (storage, packet,		\
+					       rng_state,		\
+					       line_interaction_id,	\
+					       spawn_virtual, reflective); \
+  }
+
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_scatter, 0, false, false)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_scatter_reflective, 0, false,
+				true)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_scatter_virtual, 0, true,
+				false)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_scatter_virtual_reflective,
+				0, true, true)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_macro_atom, 1, false, false)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_macro_atom_reflective, 1,
+				false, true)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_macro_atom_virtual, 1, true,
+				false)
+TARDIS_DEFINE_REAL_PACKET_LOOP (real_packet_loop_macro_atom_virtual_reflective,
+				1, true, true)
+
+/** Specialized real packet loop for the settings of a transport.
+ *
+ * @return NULL if the real packets search their events in the cumulative
+ * line optical depths or the line interaction type is unknown; these
+ * packets are transported by montecarlo_one_packet_loop.
+ */
+static montecarlo_real_packet_loop_t
+get_real_packet_loop (storage_model_t * storage, int64_t virtual_packet_flag)
+{
+  static const montecarlo_real_packet_loop_t loops[2][2][2] = {
+    {{real_packet_loop_scatter, real_packet_loop_scatter_reflective},
+     {real_packet_loop_scatter_virtual,
+      real_packet_loop_scatter_virtual_reflective}},
+    {{real_packet_loop_macro_atom, real_packet_loop_macro_atom_reflective},
+     {real_packet_loop_macro_atom_virtual,
+      real_packet_loop_macro_atom_virtual_reflective}}
+  };
+  if ((storage->cumulative_line_tau_sobolevs != NULL &&
+       storage->cumulative_tau_real_packets) ||
+      storage->line_interaction_id < 0)
+    {
+      return NULL;
+    }
+  return loops[storage->line_interaction_id >= 1][virtual_packet_flag > 0]
+    [storage->reflective_inner_boundary != 0];
+}
+
+/** Allocate an empty log with room for TARDIS_PACKET_CHUNK_SIZE increments. */
+static estimator_log_t *
+estimator_log_alloc (void)
+{
+  estimator_log_t *log =
+    (estimator_log_t *) calloc (1, sizeof (estimator_log_t));
+  if (log == NULL)
+    {
+      return NULL;
+    }
+  log->capacity = TARDIS_PACKET_CHUNK_SIZE;
+  log->indices = (int64_t *) malloc (log->capacity * sizeof (int64_t));
+  log->values = (double *) malloc (log->capacity * sizeof (double));
+  if (log->indices == NULL || log->values == NULL)
+    {
+      log->allocation_failed = 1;
+    }
+  return log;
+}
+
+static void
+estimator_log_free (estimator_log_t * log)
+{
+  if (log != NULL)
+    {
+      free (log->indices);
+      free (log->values);
+      free (log);
+    }
+}
+
+/** Add the increments of a log to the estimator array and empty the log.
+ *
+ * The increments are first summed per entry in the order they were recorded
+ * into partial_sums (zero on entry and on return), then every touched entry
+ * of the estimator gets its partial sum added once. The estimator thus
+ * receives one sum per chunk, the same as when the chunk is transported
+ * into a zeroed array that is added to the estimator afterwards. An entry
+ * that occurs several times in the log only adds 0.0 after the first time.
+ */
+static void
+estimator_log_flush (estimator_log_t * log, double *estimator,
+		     double *partial_sums)
+{
+  int64_t i;
+  for (i = 0; i < log->size; i++)
+    {
+      partial_sums[log->indices[i]] += log->values[i];
+    }
+  for (i = 0; i < log->size; i++)
+    {
+      estimator[log->indices[i]] += partial_sums[log->indices[i]];
+      partial_sums[log->indices[i]] = 0.0;
+    }
+  log->size = 0;
+}
+
+/** Allocate zeroed private estimator buffers for one thread.
+ *
+ * The pointers of the thread copy that refer to the shared js, nubars and
+ * event_counters are replaced by freshly allocated buffers of the same
+ * size. The j_blue and virtual spectrum increments go to logs of their own,
+ * so the thread needs no copy of these (shells x lines) and spectrum sized
+ * arrays. Everything else stays shared.
+ */
+static tardis_error_t
+storage_init_thread_estimators (storage_model_t * thread_storage,
+				storage_model_t * storage)
+{
+  memcpy ((void *) thread_storage, (void *) storage,
+	  sizeof (storage_model_t));
+  thread_storage->js =
+    (double *) calloc (storage->no_of_shells, sizeof (double));
+  thread_storage->nubars =
+    (double *) calloc (storage->no_of_shells, sizeof (double));
+  thread_storage->j_blue_log = estimator_log_alloc ();
+  thread_storage->spectrum_virt_nu_log = estimator_log_alloc ();
+  if (storage->event_counters != NULL)
+    {
+      thread_storage->event_counters =
+	(int64_t *) calloc (storage->no_of_shells * TARDIS_NO_OF_COUNTERS,
+			    sizeof (int64_t));
+    }
+  if (thread_storage->js == NULL || thread_storage->nubars == NULL ||
+      thread_storage->j_blue_log == NULL ||
+      thread_storage->j_blue_log->allocation_failed ||
+      thread_storage->spectrum_virt_nu_log == NULL ||
+      thread_storage->spectrum_virt_nu_log->allocation_failed ||
+      (thread_storage->event_counters == NULL &&
+       storage->event_counters != NULL))
+    {
+      return TARDIS_ERROR_ALLOCATION_FAILED;
+    }
+  return TARDIS_ERROR_OK;
+}
+
+static void
+storage_free_thread_estimators (storage_model_t * thread_storage)
+{
+  free (thread_storage->js);
+  free (thread_storage->nubars);
+  estimator_log_free (thread_storage->j_blue_log);
+  estimator_log_free (thread_storage->spectrum_virt_nu_log);
+  if (thread_storage->event_counters != NULL)
+    {
+      free (thread_storage->event_counters);
+    }
+}
+
+/** Add a buffer to the target and reset the buffer to zero. */
+static void
+flush_estimator_buffer (double *target, double *source, int64_t size)
+{
+  int64_t i;
+  for (i = 0; i < size; i++)
+    {
+      target[i] += source[i];
+      source[i] = 0.0;
+    }
+}
+
+/** Add a buffer to a single precision target and reset the buffer to zero.
+ * The sum is rounded once per transport. */
+static void
+flush_estimator_buffer_single (float *target, double *source, int64_t size)
+{
+  int64_t i;
+  for (i = 0; i < size; i++)
+    {
+      target[i] = (float) (target[i] + source[i]);
+      source[i] = 0.0;
+    }
+}
+
+/** Move the private estimators of a thread into the shared ones.
+ *
+ * The j_blue increments are added to j_blues, the double precision
+ * estimators of storage or the buffer that collects them for single
+ * precision estimators. j_blue_partial_sums and spectrum_partial_sums are
+ * zeroed scratch arrays of the size of j_blues and spectrum_virt_nu.
+ */
+static void
+storage_flush_thread_estimators (storage_model_t * storage,
+				 storage_model_t * thread_storage,
+				 double *j_blues, double *j_blue_partial_sums,
+				 double *spectrum_partial_sums)
+{
+  int64_t i;
+  flush_estimator_buffer (storage->js, thread_storage->js,
+			  storage->no_of_shells);
+  flush_estimator_buffer (storage->nubars, thread_storage->nubars,
+			  storage->no_of_shells);
+  estimator_log_flush (thread_storage->j_blue_log, j_blues,
+		       j_blue_partial_sums);
+  estimator_log_flush (thread_storage->spectrum_virt_nu_log,
+		       storage->spectrum_virt_nu, spectrum_partial_sums);
+  if (storage->event_counters != NULL)
+    {
+      for (i = 0; i < storage->no_of_shells * TARDIS_NO_OF_COUNTERS; i++)
+	{
+	  storage->event_counters[i] += thread_storage->event_counters[i];
+	  thread_storage->event_counters[i] = 0;
+	}
+    }
+}
+
+static void
+montecarlo_transport_packet (storage_model_t * storage,
+			     int64_t packet_index,
+			     int64_t virtual_packet_flag,
+			     montecarlo_real_packet_loop_t real_packet_loop,
+			     philox_state_t * rng_state)
+{
+  rpacket_t packet;
+  int64_t reabsorbed;
+  storage->current_packet_id = packet_index;
+  rpacket_init (&packet, storage, packet_index, virtual_packet_flag,
+		rng_state);
+  trace_packet_event (&packet, storage, TARDIS_PACKET_EVENT_START, -1);
+  if (virtual_packet_flag > 0)
+    {
+      // This is a run for which we want the virtual packet spectrum.
+      // So first thing we need to do is spawn virtual packets to track
+      // the input packet.
+      montecarlo_one_packet (storage, &packet, -1, rng_state);
+    }
+  // Now we can do the propagation of the real packet.
+  if (real_packet_loop != NULL)
+    {
+      reabsorbed = real_packet_loop (storage, &packet, rng_state);
+    }
+  else
+    {
+      reabsorbed = montecarlo_one_packet (storage, &packet, 0, rng_state);
+    }
+  trace_packet_event (&packet, storage, reabsorbed == 1 ?
+		      TARDIS_PACKET_EVENT_REABSORBED :
+		      TARDIS_PACKET_EVENT_ESCAPED, -1);
+  storage->output_nus[packet_index] = rpacket_get_nu (&packet);
+  storage->output_energies[packet_index] = reabsorbed == 1 ?
+    -rpacket_get_energy (&packet) : rpacket_get_energy (&packet);
+}
+
+/** Copy the packet in a slot of a batch into an rpacket_t. */
+static void
+packet_batch_load (packet_batch_t * batch, int64_t slot, rpacket_t * packet)
+{
+  packet->nu = batch->nu[slot];
+  packet->mu = batch->mu[slot];
+  packet->energy = batch->energy[slot];
+  packet->r = batch->r[slot];
+  packet->tau_event = batch->tau_event[slot];
+  packet->nu_line = batch->nu_line[slot];
+  packet->current_shell_id = batch->current_shell_id[slot];
+  packet->next_line_id = batch->next_line_id[slot];
+  packet->last_line = batch->last_line[slot];
+  packet->close_line = batch->close_line[slot];
+  packet->recently_crossed_boundary = batch->recently_crossed_boundary[slot];
+  packet->virtual_packet_flag = batch->virtual_packet_flag[slot];
+  packet->virtual_packet = 0;
+  packet->d_line = batch->d_line[slot];
+  packet->d_electron = batch->d_electron[slot];
+  packet->d_boundary = batch->d_boundary[slot];
+  packet->next_shell_id = batch->next_shell_id[slot];
+  packet->status = batch->status[slot];
+}
+
+/** Copy an rpacket_t into a slot of a batch. */
+static void
+packet_batch_store (packet_batch_t * batch, int64_t slot, rpacket_t * packet)
+{
+  batch->nu[slot] = packet->nu;
+  batch->mu[slot] = packet->mu;
+  batch->energy[slot] = packet->energy;
+  batch->r[slot] = packet->r;
+  batch->tau_event[slot] = packet->tau_event;
+  batch->nu_line[slot] = packet->nu_line;
+  batch->current_shell_id[slot] = packet->current_shell_id;
+  batch->next_line_id[slot] = packet->next_line_id;
+  batch->last_line[slot] = packet->last_line;
+  batch->close_line[slot] = packet->close_line;
+  batch->recently_crossed_boundary[slot] = packet->recently_crossed_boundary;
+  batch->virtual_packet_flag[slot] = packet->virtual_packet_flag;
+  batch->d_line[slot] = packet->d_line;
+  batch->d_electron[slot] = packet->d_electron;
+  batch->d_boundary[slot] = packet->d_boundary;
+  batch->next_shell_id[slot] = packet->next_shell_id;
+  batch->status[slot] = packet->status;
+}
+
+/** Move the packet in slot source to slot target. */
+static void
+packet_batch_move (packet_batch_t * batch, int64_t source, int64_t target)
+{
+  rpacket_t packet;
+  packet_batch_load (batch, source, &packet);
+  packet_batch_store (batch, target, &packet);
+  batch->distance[target] = batch->distance[source];
+  batch->packet_index[target] = batch->packet_index[source];
+  batch->rng_state[target] = batch->rng_state[source];
+}
+
+/** Initialize a packet in a slot of a batch.
+ *
+ * Does the same as montecarlo_transport_packet and the prologue of
+ * montecarlo_one_packet_loop for a real packet.
+ */
+static void
+packet_batch_start_packet (storage_model_t * storage, packet_batch_t * batch,
+			   int64_t slot, int64_t packet_index,
+			   int64_t virtual_packet_flag, unsigned long seed,
+			   int64_t iteration)
+{
+  rpacket_t packet;
+  philox_state_t *rng_state = &batch->rng_state[slot];
+  philox_seed (rng_state, seed, (uint32_t) iteration,
+	       (uint64_t) (storage->first_packet_id + packet_index));
+  storage->current_packet_id = packet_index;
+  rpacket_init (&packet, storage, packet_index, virtual_packet_flag,
+		rng_state);
+  trace_packet_event (&packet, storage, TARDIS_PACKET_EVENT_START, -1);
+  if (virtual_packet_flag > 0)
+    {
+      montecarlo_one_packet (storage, &packet, -1, rng_state);
+    }
+  rpacket_set_tau_event (&packet, 0.0);
+  rpacket_set_nu_line (&packet, 0.0);
+  rpacket_set_virtual_packet (&packet, 0);
+  rpacket_set_status (&packet, TARDIS_PACKET_STATUS_IN_PROCESS);
+  rpacket_reset_tau_event (&packet, rng_state);
+  packet_batch_store (batch, slot, &packet);
+  batch->packet_index[slot] = packet_index;
+}
+
+/** Compute the distances to the next events of all packets of a batch.
+ *
+ * Every loop runs over the contiguous arrays of the batch and evaluates the
+ * same expressions as compute_distance2boundary, compute_distance2line and
+ * compute_distance2electron, so the distances are bitwise identical to the
+ * ones of the packet-by-packet kernel.
+ */
+static void
+packet_batch_compute_distances (storage_model_t * storage,
+				packet_batch_t * batch)
+{
+  int64_t i;
+  int64_t no_of_packets = batch->no_of_active_packets;
+  double inverse_t_exp = storage->inverse_time_explosion;
+  double t_exp = storage->time_explosion;
+  rpacket_t packet;
+  if (storage->next_active_line_ids != NULL)
+    {
+      for (i = 0; i < no_of_packets; i++)
+	{
+	  packet_batch_load (batch, i, &packet);
+	  montecarlo_skip_pruned_lines (&packet, storage);
+	  packet_batch_store (batch, i, &packet);
+	}
+    }
+  for (i = 0; i < no_of_packets; i++)
+    {
+      if (!batch->last_line[i])
+	{
+	  batch->nu_line[i] = storage->line_list_nu[batch->next_line_id[i]];
+	}
+    }
+  for (i = 0; i < no_of_packets; i++)
+    {
+      double r = batch->r[i];
+      double mu = batch->mu[i];
+      double r_outer = storage->r_outer[batch->current_shell_id[i]];
+      double r_inner = storage->r_inner[batch->current_shell_id[i]];
+      double d_outer =
+	sqrt (r_outer * r_outer + ((mu * mu - 1.0) * r * r)) - (r * mu);
+      double check = r_inner * r_inner + (r * r * (mu * mu - 1.0));
+      double d_inner =
+	(batch->recently_crossed_boundary[i] != 1 && check >= 0.0
+	 && mu < 0.0) ? -r * mu - sqrt (check) : MISS_DISTANCE;
+      if (!batch->close_line[i])
+	{
+	  batch->d_boundary[i] = d_inner < d_outer ? d_inner : d_outer;
+	  batch->next_shell_id[i] = d_inner < d_outer ? -1 : 1;
+	}
+    }
+  for (i = 0; i < no_of_packets; i++)
+    {
+      double doppler_factor =
+	1.0 - batch->mu[i] * batch->r[i] * inverse_t_exp * INVERSE_C;
+      double comov_nu = batch->nu[i] * doppler_factor;
+      if (batch->close_line[i])
+	{
+	  batch->d_line[i] = 0.0;
+	}
+      else if (batch->last_line[i])
+	{
+	  batch->d_line[i] = MISS_DISTANCE;
+	}
+      else if (comov_nu < batch->nu_line[i])
+	{
+	  // Let the scalar version report the error.
+	  packet_batch_load (batch, i, &packet);
+	  compute_distance2line (&packet, storage, &batch->d_line[i]);
+	  batch->d_line[i] = MISS_DISTANCE;
+	}
+      else
+	{
+	  batch->d_line[i] =
+	    ((comov_nu - batch->nu_line[i]) / batch->nu[i]) * C * t_exp;
+	}
+    }
+  for (i = 0; i < no_of_packets; i++)
+    {
+      double inverse_ne =
+	storage->inverse_electron_densities[batch->current_shell_id[i]] *
+	storage->inverse_sigma_thomson;
+      if (!batch->close_line[i])
+	{
+	  batch->d_electron[i] = batch->tau_event[i] * inverse_ne;
+	}
+      batch->close_line[i] = false;
+    }
+}
+
+/** Sort the packets of a batch into lists by the type of their next event. */
+static void
+packet_batch_classify_events (packet_batch_t * batch,
+			      int64_t * no_of_line_events,
+			      int64_t * no_of_boundary_events,
+			      int64_t * no_of_electron_events)
+{
+  int64_t i;
+  *no_of_line_events = 0;
+  *no_of_boundary_events = 0;
+  *no_of_electron_events = 0;
+  for (i = 0; i < batch->no_of_active_packets; i++)
+    {
+      if (batch->d_line[i] <= batch->d_boundary[i] &&
+	  batch->d_line[i] <= batch->d_electron[i])
+	{
+	  batch->distance[i] = batch->d_line[i];
+	  batch->line_events[(*no_of_line_events)++] = i;
+	}
+      else if (batch->d_boundary[i] <= batch->d_electron[i])
+	{
+	  batch->distance[i] = batch->d_boundary[i];
+	  batch->boundary_events[(*no_of_boundary_events)++] = i;
+	}
+      else
+	{
+	  batch->distance[i] = batch->d_electron[i];
+	  batch->electron_events[(*no_of_electron_events)++] = i;
+	}
+    }
+}
+
+/** Run the handler of one event type for the listed packets of a batch. */
+static void
+packet_batch_handle_events (storage_model_t * storage,
+			    packet_batch_t * batch, int64_t * slots,
+			    int64_t no_of_slots,
+			    montecarlo_event_handler_t handler)
+{
+  int64_t i;
+  rpacket_t packet;
+  for (i = 0; i < no_of_slots; i++)
+    {
+      int64_t slot = slots[i];
+      packet_batch_load (batch, slot, &packet);
+      storage->current_packet_id = batch->packet_index[slot];
+      handler (&packet, storage, batch->distance[slot],
+	       &batch->rng_state[slot]);
+      packet_batch_store (batch, slot, &packet);
+    }
+}
+
+/** Find and handle the next event of every packet of a batch. */
+static void
+packet_batch_handle_packet_events (storage_model_t * storage,
+				   packet_batch_t * batch)
+{
+  int64_t slot;
+  rpacket_t packet;
+  for (slot = 0; slot < batch->no_of_active_packets; slot++)
+    {
+      packet_batch_load (batch, slot, &packet);
+      storage->current_packet_id = batch->packet_index[slot];
+      montecarlo_packet_event (&packet, storage, &batch->rng_state[slot]);
+      packet_batch_store (batch, slot, &packet);
+    }
+}
+
+/** Write the output of the finished packets and compact the batch. */
+static void
+packet_batch_finish_packets (storage_model_t * storage,
+			     packet_batch_t * batch)
+{
+  int64_t i = 0;
+  rpacket_t packet;
+  while (i < batch->no_of_active_packets)
+    {
+      if (batch->status[i] == TARDIS_PACKET_STATUS_IN_PROCESS)
+	{
+	  i++;
+	  continue;
+	}
+      if (storage->packet_trace != NULL)
+	{
+	  packet_batch_load (batch, i, &packet);
+	  storage->current_packet_id = batch->packet_index[i];
+	  trace_packet_event (&packet, storage,
+			      batch->status[i] ==
+			      TARDIS_PACKET_STATUS_REABSORBED ?
+			      TARDIS_PACKET_EVENT_REABSORBED :
+			      TARDIS_PACKET_EVENT_ESCAPED, -1);
+	}
+      storage->output_nus[batch->packet_index[i]] = batch->nu[i];
+      storage->output_energies[batch->packet_index[i]] =
+	batch->status[i] == TARDIS_PACKET_STATUS_REABSORBED ?
+	-batch->energy[i] : batch->energy[i];
+      batch->no_of_active_packets--;
+      if (i < batch->no_of_active_packets)
+	{
+	  packet_batch_move (batch, batch->no_of_active_packets, i);
+	}
+    }
+}
+
+/** Transport a chunk of packets with the event-based kernel.
+ *
+ * Up to TARDIS_EVENT_BATCH_SIZE packets are in process at a time. Every
+ * sweep computes the distances of all of them, handles their events grouped
+ * by type and replaces the finished packets with new ones from the chunk.
+ * Every packet uses its own random stream, so its fate does not depend on
+ * the other packets of the batch.
+ */
+static void
+montecarlo_event_transport_chunk (storage_model_t * storage,
+				  packet_batch_t * batch,
+				  int64_t chunk_start, int64_t chunk_end,
+				  int64_t virtual_packet_flag,
+				  unsigned long seed, int64_t iteration)
+{
+  int64_t packet_index = chunk_start;
+  int64_t no_of_line_events;
+  int64_t no_of_boundary_events;
+  int64_t no_of_electron_events;
+  batch->no_of_active_packets = 0;
+  while (packet_index < chunk_end || batch->no_of_active_packets > 0)
+    {
+      while (batch->no_of_active_packets < TARDIS_EVENT_BATCH_SIZE &&
+	     packet_index < chunk_end)
+	{
+	  packet_batch_start_packet (storage, batch,
+				     batch->no_of_active_packets,
+				     packet_index, virtual_packet_flag, seed,
+				     iteration);
+	  batch->no_of_active_packets++;
+	  packet_index++;
+	}
+      if (storage->cumulative_line_tau_sobolevs != NULL &&
+	  storage->cumulative_tau_real_packets)
+	{
+	  // Every packet searches its own event in the cumulative tables.
+	  packet_batch_handle_packet_events (storage, batch);
+	  packet_batch_finish_packets (storage, batch);
+	  continue;
+	}
+      packet_batch_compute_distances (storage, batch);
+      packet_batch_classify_events (batch, &no_of_line_events,
+				    &no_of_boundary_events,
+				    &no_of_electron_events);
+      packet_batch_handle_events (storage, batch, batch->line_events,
+				  no_of_line_events,
+				  &montecarlo_line_scatter);
+      packet_batch_handle_events (storage, batch, batch->boundary_events,
+				  no_of_boundary_events,
+				  &move_packet_across_shell_boundary);
+      packet_batch_handle_events (storage, batch, batch->electron_events,
+				  no_of_electron_events,
+				  &montecarlo_thomson_scatter);
+      packet_batch_finish_packets (storage, batch);
+    }
+}
+
+/** Wall clock time in seconds. */
+static double
+get_wall_time (void)
+{
+  struct timespec now;
+  clock_gettime (CLOCK_MONOTONIC, &now);
+  return now.tv_sec + 1e-9 * now.tv_nsec;
+}
+
 tardis_error_t
-rpacket_init (rpacket_t * packet, storage_model_t * storage, int packet_index,
-	      int virtual_packet_flag)
+montecarlo_main_loop (storage_model_t * storage, int64_t virtual_packet_flag,
+		      int nthreads, unsigned long seed, int64_t iteration,
+		      montecarlo_progress_callback_t progress_callback,
+		      double progress_interval, void *progress_data)
+{
+  int64_t chunk_index;
+  int64_t no_of_chunks;
+  double start_time = get_wall_time ();
+  double last_progress_time = start_time;
+  int thread_id;
+  tardis_error_t ret_val = TARDIS_ERROR_OK;
+  storage_model_t *thread_storages;
+  packet_batch_t *batches = NULL;
+  double *j_blues = storage->line_lists_j_blues;
+  double *j_blue_partial_sums = NULL;
+  double *spectrum_partial_sums = NULL;
+  montecarlo_real_packet_loop_t real_packet_loop =
+    get_real_packet_loop (storage, virtual_packet_flag);
+#ifndef WITHOPENMP
+  nthreads = 1;
+#endif
+  if (nthreads < 1)
+    {
+      nthreads = 1;
+    }
+  no_of_chunks = (storage->no_of_packets + TARDIS_PACKET_CHUNK_SIZE - 1) /
+    TARDIS_PACKET_CHUNK_SIZE;
+  thread_storages =
+    (storage_model_t *) calloc (nthreads, sizeof (storage_model_t));
+  if (thread_storages == NULL)
+    {
+      return TARDIS_ERROR_ALLOCATION_FAILED;
+    }
+  if (storage->transport_kernel == TARDIS_TRANSPORT_KERNEL_EVENT)
+    {
+      batches = (packet_batch_t *) calloc (nthreads, sizeof (packet_batch_t));
+      if (batches == NULL)
+	{
+	  free (thread_storages);
+	  return TARDIS_ERROR_ALLOCATION_FAILED;
+	}
+    }
+  // Single precision j_blues are summed in double precision and rounded
+  // once at the end.
+  if (storage->line_lists_j_blues_single != NULL)
+    {
+      j_blues = (double *) calloc (storage->no_of_shells *
+				   storage->line_lists_j_blues_nd,
+				   sizeof (double));
+      if (j_blues == NULL && storage->line_lists_j_blues_nd > 0)
+	{
+	  free (thread_storages);
+	  free (batches);
+	  return TARDIS_ERROR_ALLOCATION_FAILED;
+	}
+    }
+  // Scratch space to sum the logged increments of a chunk per entry, only
+  // used while flushing, which happens in one thread at a time.
+  j_blue_partial_sums =
+    (double *) calloc (storage->no_of_shells * storage->line_lists_j_blues_nd,
+		       sizeof (double));
+  spectrum_partial_sums =
+    (double *) calloc (storage->spectrum_virt_nu_size, sizeof (double));
+  if ((j_blue_partial_sums == NULL && storage->line_lists_j_blues_nd > 0) ||
+      (spectrum_partial_sums == NULL && storage->spectrum_virt_nu_size > 0))
+    {
+      ret_val = TARDIS_ERROR_ALLOCATION_FAILED;
+      nthreads = 0;
+      goto cleanup;
+    }
+  // Every thread (also in a serial run) accumulates one chunk of packets at
+  // a time into private buffers and logs, which are then added to the
+  // shared estimators in chunk order.
+  for (thread_id = 0; thread_id < nthreads; thread_id++)
+    {
+      if (storage_init_thread_estimators (&thread_storages[thread_id],
+					  storage) != TARDIS_ERROR_OK)
+	{
+	  ret_val = TARDIS_ERROR_ALLOCATION_FAILED;
+	  nthreads = thread_id + 1;
+	  goto cleanup;
+	}
+    }
+#ifdef WITHOPENMP
+#pragma omp parallel num_threads(nthreads) private(chunk_index)
+#endif
+  {
+    philox_state_t rng_state;
+    storage_model_t *thread_storage;
+    int64_t packet_index;
+    int64_t chunk_end;
+    int thread_num;
+#ifdef WITHOPENMP
+    thread_num = omp_get_thread_num ();
+#else
+    thread_num = 0;
+#endif
+    thread_storage = &thread_storages[thread_num];
+#ifdef WITHOPENMP
+#pragma omp for ordered schedule(static, 1)
+#endif
+    for (chunk_index = 0; chunk_index < no_of_chunks; chunk_index++)
+      {
+	chunk_end = (chunk_index + 1) * TARDIS_PACKET_CHUNK_SIZE;
+	if (chunk_end > storage->no_of_packets)
+	  {
+	    chunk_end = storage->no_of_packets;
+	  }
+	if (batches != NULL)
+	  {
+	    montecarlo_event_transport_chunk (thread_storage,
+					      &batches[thread_num],
+					      chunk_index *
+					      TARDIS_PACKET_CHUNK_SIZE,
+					      chunk_end, virtual_packet_flag,
+					      seed, iteration);
+	  }
+	else
+	  {
+	    for (packet_index = chunk_index * TARDIS_PACKET_CHUNK_SIZE;
+		 packet_index < chunk_end; packet_index++)
+	      {
+		// The random stream of a packet only depends on the seed, the
+		// iteration and the packet index, not on the executing thread.
+		philox_seed (&rng_state, seed, (uint32_t) iteration,
+			     (uint64_t) (storage->first_packet_id +
+					 packet_index));
+		montecarlo_transport_packet (thread_storage, packet_index,
+					     virtual_packet_flag,
+					     real_packet_loop, &rng_state);
+	      }
+	  }
+#ifdef WITHOPENMP
+#pragma omp ordered
+#endif
+	{
+	  storage_flush_thread_estimators (storage, thread_storage, j_blues,
+					   j_blue_partial_sums,
+					   spectrum_partial_sums);
+	  if (progress_callback != NULL &&
+	      get_wall_time () - last_progress_time >= progress_interval)
+	    {
+	      last_progress_time = get_wall_time ();
+	      progress_callback (chunk_end,
+				 chunk_end / (last_progress_time - start_time),
+				 progress_data);
+	    }
+	}
+      }
+  }
+  for (thread_id = 0; thread_id < nthreads; thread_id++)
+    {
+      if (thread_storages[thread_id].j_blue_log->allocation_failed ||
+	  thread_storages[thread_id].spectrum_virt_nu_log->allocation_failed)
+	{
+	  ret_val = TARDIS_ERROR_ALLOCATION_FAILED;
+	}
+    }
+  if (storage->line_lists_j_blues_single != NULL)
+    {
+      flush_estimator_buffer_single (storage->line_lists_j_blues_single,
+				     j_blues,
+				     storage->no_of_shells *
+				     storage->line_lists_j_blues_nd);
+    }
+cleanup:
+  for (thread_id = 0; thread_id < nthreads; thread_id++)
+    {
+      storage_free_thread_estimators (&thread_storages[thread_id]);
+    }
+  if (storage->line_lists_j_blues_single != NULL)
+    {
+      free (j_blues);
+    }
+  free (j_blue_partial_sums);
+  free (spectrum_partial_sums);
+  free (thread_storages);
+  free (batches);
+  return ret_val;
+}
+
+/** Invert the tabulated cumulative distribution of the packet source.
+ *
+ * @param storage storage model data
+ * @param xi uniform random number in [0, 1)
+ *
+ * @return frequency, interpolated linearly within the table interval that
+ * contains xi
+ */
+static double
+sample_packet_source_nu (const storage_model_t * storage, double xi)
+{
+  const double *cdf = storage->packet_source_cdf;
+  const double *nus = storage->packet_source_nus;
+  int64_t imin = 0;
+  int64_t imax = storage->packet_source_size - 1;
+  int64_t i;
+  // cdf[imin] <= xi < cdf[imax], the table starts at 0 and ends at 1
+  while (imax - imin > 1)
+    {
+      i = (imin + imax) / 2;
+      if (cdf[i] <= xi)
+	{
+	  imin = i;
+	}
+      else
+	{
+	  imax = i;
+	}
+    }
+  return nus[imin] + (xi - cdf[imin]) / (cdf[imax] - cdf[imin]) *
+    (nus[imax] - nus[imin]);
+}
+
+tardis_error_t
+rpacket_init (rpacket_t * packet, storage_model_t * storage,
+	      int64_t packet_index, int virtual_packet_flag,
+	      philox_state_t * rng_state)
 {
-  double nu_line;
   double current_r;
   double current_mu;
   double current_nu;
   double comov_current_nu;
   double current_energy;
   int64_t current_line_id;
-  int current_shell_id;
+  int64_t current_shell_id;
   bool last_line;
-  bool close_line;
   int recently_crossed_boundary;
   tardis_error_t ret_val = TARDIS_ERROR_OK;
-  current_nu = storage->packet_nus[packet_index];
-  current_energy = storage->packet_energies[packet_index];
-  current_mu = storage->packet_mus[packet_index];
+  if (storage->packet_nus != NULL)
+    {
+      current_nu = storage->packet_nus[packet_index];
+      current_energy = storage->packet_energies[packet_index];
+      current_mu = storage->packet_mus[packet_index];
+    }
+  else
+    {
+      current_nu =
+	sample_packet_source_nu (storage, philox_double (rng_state));
+      current_mu = sqrt (philox_double (rng_state));
+      current_energy = storage->packet_energy;
+    }
   comov_current_nu = current_nu;
   current_shell_id = 0;
   current_r = storage->r_inner[0];
@@ -697,7 +2202,7 @@ rpacket_init (rpacket_t * packet, storage_model_t * storage, int packet_index,
 		       storage->inverse_time_explosion * INVERSE_C));
   if ((ret_val =
        line_search (storage->line_list_nu, comov_current_nu,
-		    storage->no_of_lines,
+		    storage->no_of_lines, &storage->line_index,
 		    &current_line_id)) != TARDIS_ERROR_OK)
     {
       return ret_val;
@@ -793,7 +2298,7 @@ rpacket_set_nu_line (rpacket_t * packet, double nu_line)
   packet->nu_line = nu_line;
 }
 
-INLINE unsigned int
+INLINE int64_t
 rpacket_get_current_shell_id (rpacket_t * packet)
 {
   return packet->current_shell_id;
@@ -801,19 +2306,19 @@ rpacket_get_current_shell_id (rpacket_t * packet)
 
 INLINE void
 rpacket_set_current_shell_id (rpacket_t * packet,
-			      unsigned int current_shell_id)
+			      int64_t current_shell_id)
 {
   packet->current_shell_id = current_shell_id;
 }
 
-INLINE unsigned int
+INLINE int64_t
 rpacket_get_next_line_id (rpacket_t * packet)
 {
   return packet->next_line_id;
 }
 
 INLINE void
-rpacket_set_next_line_id (rpacket_t * packet, unsigned int next_line_id)
+rpacket_set_next_line_id (rpacket_t * packet, int64_t next_line_id)
 {
   packet->next_line_id = next_line_id;
 }
@@ -942,7 +2447,7 @@ rpacket_set_status (rpacket_t * packet, rpacket_status_t status)
 /* Other accessor methods. */
 
 INLINE void
-rpacket_reset_tau_event (rpacket_t * packet)
+rpacket_reset_tau_event (rpacket_t * packet, philox_state_t * rng_state)
 {
-  rpacket_set_tau_event (packet, -log (rk_double (&mt_state)));
+  rpacket_set_tau_event (packet, -log (philox_double (rng_state)));
 }
@@ -4,10 +4,19 @@
 #include <stdio.h>
 #include <stdbool.h>
 #include <stdint.h>
+#include <inttypes.h>
 #include <string.h>
 #include <stdlib.h>
 #include <math.h>
-#include "randomkit/randomkit.h"
+#include <time.h>
+#include "philox.h"
+
+#ifdef WITHOPENMP
+#include <omp.h>
+#define TARDIS_WITH_OPENMP 1
+#else
+#define TARDIS_WITH_OPENMP 0
+#endif
 
 #ifdef __clang__
 #define INLINE extern inline
@@ -15,17 +24,75 @@
 #define INLINE inline
 #endif
 
+#ifdef __GNUC__
+#define TARDIS_ALWAYS_INLINE inline __attribute__ ((always_inline))
+#else
+#define TARDIS_ALWAYS_INLINE inline
+#endif
+
 #define MISS_DISTANCE 1e99
 #define C 29979245800.0
 #define INVERSE_C 3.33564095198152e-11
+#define TARDIS_PACKET_CHUNK_SIZE 2048
+#define TARDIS_EVENT_BATCH_SIZE 256
 
 typedef enum
 {
   TARDIS_ERROR_OK = 0,
   TARDIS_ERROR_BOUNDS_ERROR = 1,
-  TARDIS_ERROR_COMOV_NU_LESS_THAN_NU_LINE = 2
+  TARDIS_ERROR_COMOV_NU_LESS_THAN_NU_LINE = 2,
+  TARDIS_ERROR_ALLOCATION_FAILED = 3
 } tardis_error_t;
 
+typedef enum
+{
+  TARDIS_TRANSPORT_KERNEL_PACKET = 0,
+  TARDIS_TRANSPORT_KERNEL_EVENT = 1
+} transport_kernel_t;
+
+/** Events counted per shell if storage_model_t.event_counters is set. */
+typedef enum
+{
+  TARDIS_COUNTER_LINE_INTERACTIONS = 0,
+  TARDIS_COUNTER_ELECTRON_SCATTERS = 1,
+  TARDIS_COUNTER_BOUNDARY_CROSSINGS = 2,
+  TARDIS_COUNTER_MACRO_ATOM_JUMPS = 3,
+  TARDIS_COUNTER_VIRTUAL_PACKETS = 4,
+  TARDIS_COUNTER_LINE_STEPS = 5,
+  TARDIS_NO_OF_COUNTERS = 6
+} event_counter_t;
+
+/** Event types of the packet trace. */
+typedef enum
+{
+  TARDIS_PACKET_EVENT_START = 0,
+  TARDIS_PACKET_EVENT_BOUNDARY = 1,
+  TARDIS_PACKET_EVENT_ELECTRON = 2,
+  TARDIS_PACKET_EVENT_LINE = 3,
+  TARDIS_PACKET_EVENT_ESCAPED = 4,
+  TARDIS_PACKET_EVENT_REABSORBED = 5
+} packet_event_t;
+
+/**
+ * @brief A packet trace record, the state of a real packet when an event
+ * happens (before the event changes it).
+ *
+ * All fields are 8 bytes wide, so the record has no padding and matches
+ * PACKET_TRACE_DTYPE of tardis.montecarlo.packet_trace.
+ */
+typedef struct PacketTraceRecord
+{
+  int64_t packet_id;
+  int64_t iteration;
+  int64_t event_type;
+  int64_t shell_id;
+  double r;
+  double mu;
+  double nu;
+  /** Line of a line interaction, -1 for the other events. */
+  int64_t line_id;
+} packet_trace_record_t;
+
 typedef enum
 {
   TARDIS_PACKET_STATUS_IN_PROCESS = 0,
@@ -77,11 +144,90 @@ typedef struct RPacket
   rpacket_status_t status; /**< Packet status (in process, emitted or reabsorbed). */
 } rpacket_t;
 
+/**
+ * @brief A batch of real packets in structure-of-arrays layout.
+ *
+ * Used by the event-based transport kernel. Slot i of every array belongs to
+ * the same packet; the packets in process occupy the slots 0 to
+ * no_of_active_packets - 1.
+ */
+typedef struct PacketBatch
+{
+  double nu[TARDIS_EVENT_BATCH_SIZE];
+  double mu[TARDIS_EVENT_BATCH_SIZE];
+  double energy[TARDIS_EVENT_BATCH_SIZE];
+  double r[TARDIS_EVENT_BATCH_SIZE];
+  double tau_event[TARDIS_EVENT_BATCH_SIZE];
+  double nu_line[TARDIS_EVENT_BATCH_SIZE];
+  double d_line[TARDIS_EVENT_BATCH_SIZE];
+  double d_electron[TARDIS_EVENT_BATCH_SIZE];
+  double d_boundary[TARDIS_EVENT_BATCH_SIZE];
+  double distance[TARDIS_EVENT_BATCH_SIZE]; /**< Distance to the next event. */
+  int64_t current_shell_id[TARDIS_EVENT_BATCH_SIZE];
+  int64_t next_line_id[TARDIS_EVENT_BATCH_SIZE];
+  int64_t last_line[TARDIS_EVENT_BATCH_SIZE];
+  int64_t close_line[TARDIS_EVENT_BATCH_SIZE];
+  int64_t recently_crossed_boundary[TARDIS_EVENT_BATCH_SIZE];
+  int64_t next_shell_id[TARDIS_EVENT_BATCH_SIZE];
+  int64_t virtual_packet_flag[TARDIS_EVENT_BATCH_SIZE];
+  rpacket_status_t status[TARDIS_EVENT_BATCH_SIZE];
+  int64_t packet_index[TARDIS_EVENT_BATCH_SIZE]; /**< Index in storage. */
+  philox_state_t rng_state[TARDIS_EVENT_BATCH_SIZE];
+  /** Slots of the packets with a line, boundary and electron event. */
+  int64_t line_events[TARDIS_EVENT_BATCH_SIZE];
+  int64_t boundary_events[TARDIS_EVENT_BATCH_SIZE];
+  int64_t electron_events[TARDIS_EVENT_BATCH_SIZE];
+  int64_t no_of_active_packets;
+} packet_batch_t;
+
+/**
+ * @brief Bucket index of the line list in log frequency.
+ *
+ * The range of ln(nu) of the line list is split into no_of_buckets buckets
+ * of equal width. The lines in bucket b (counted from the blue end) are the
+ * lines bucket_starts[b] to bucket_starts[b + 1] - 1, so a frequency lookup
+ * only has to search the few lines of one bucket.
+ */
+typedef struct LineIndex
+{
+  double log_nu_max; /**< ln of the largest line frequency. */
+  double inverse_bucket_width; /**< Buckets per unit of ln(nu). */
+  int64_t no_of_buckets;
+  int64_t *bucket_starts; /**< no_of_buckets + 1 line indices. */
+} line_index_t;
+
+/**
+ * @brief Increments of a shared estimator array recorded by one thread.
+ *
+ * The increments of a chunk of packets are added to the estimator array in
+ * chunk order, so only the entries the packets touched are visited and the
+ * sums do not depend on the number of threads.
+ */
+typedef struct EstimatorLog
+{
+  int64_t *indices;
+  double *values;
+  int64_t size;
+  int64_t capacity;
+  /** Set if the log could not grow, increments are lost from then on. */
+  int64_t allocation_failed;
+} estimator_log_t;
+
 typedef struct StorageModel
 {
   double *packet_nus;
   double *packet_mus;
   double *packet_energies;
+  /**
+   * @brief Cumulative distribution of the packet frequencies (from 0 to 1)
+   * tabulated at packet_source_nus. If packet_nus is NULL, rpacket_init
+   * generates the packets from it instead of reading the packet arrays.
+   */
+  double *packet_source_cdf;
+  double *packet_source_nus;
+  int64_t packet_source_size;
+  /** Energy of every generated packet. */
+  double packet_energy;
   double *output_nus;
   double *output_energies;
   int64_t *last_line_interaction_in_id;
@@ -99,14 +245,58 @@ typedef struct StorageModel
   double *inverse_electron_densities;
   double *line_list_nu;
   double *line_lists_tau_sobolevs;
+  /** Single precision tau_sobolevs, used instead if not NULL. */
+  float *line_lists_tau_sobolevs_single;
   int64_t line_lists_tau_sobolevs_nd;
+  /**
+   * @brief Cumulative sums of the tau_sobolevs of every shell along the line
+   * list (shells x (no_of_lines + 1), starting with 0), or NULL to step
+   * through the lines one by one. Virtual packets use them whenever they are
+   * present.
+   */
+  double *cumulative_line_tau_sobolevs;
+  /** Real packets also search their events in the cumulative tables. */
+  int64_t cumulative_tau_real_packets;
+  /**
+   * @brief First line at or after a line that is optically thick in a shell
+   * (shells x (no_of_lines + 1)), or NULL if no lines are pruned.
+   */
+  int64_t *next_active_line_ids;
   double *line_lists_j_blues;
+  /**
+   * @brief Single precision j_blue estimators, used instead if not NULL.
+   * The packets always add to a double precision buffer, which is added to
+   * them once per transport.
+   */
+  float *line_lists_j_blues_single;
+  /** Number of lines with a j_blue estimator (columns of the j_blues). */
   int64_t line_lists_j_blues_nd;
+  /**
+   * @brief Column of the j_blue estimator of every line, -1 for lines
+   * without an estimator, or NULL if every line has one.
+   */
+  int64_t *j_blue_line_ids;
+  /**
+   * @brief Sorted ids of the lines with a j_blue estimator
+   * (line_lists_j_blues_nd of them), or NULL if every line has one.
+   */
+  int64_t *j_blue_lines;
   int64_t no_of_lines;
+  line_index_t line_index;
   int64_t line_interaction_id;
-  double *transition_probabilities;
+  /**
+   * @brief Cumulative transition probabilities within every block of
+   * transitions (shells x transitions).
+   */
+  double *cumulative_transition_probabilities;
+  /** Single precision cumulative transition probabilities, used instead if not NULL. */
+  float *cumulative_transition_probabilities_single;
   int64_t transition_probabilities_nd;
   int64_t *line2macro_level_upper;
+  /**
+   * @brief First transition of every macro atom level, followed by the
+   * number of transitions.
+   */
   int64_t *macro_block_references;
   int64_t *transition_type;
   int64_t *destination_level_id;
@@ -117,16 +307,59 @@ typedef struct StorageModel
   double spectrum_delta_nu;
   double spectrum_end_nu;
   double *spectrum_virt_nu;
+  int64_t spectrum_virt_nu_size;
   double sigma_thomson;
   double inverse_sigma_thomson;
   double inner_boundary_albedo;
+  /**
+   * @brief Virtual packets whose optical depth exceeds this value play
+   * Russian roulette once (0 disables it).
+   */
+  double virtual_packet_roulette_tau;
+  /** Survival probability of the Russian roulette of virtual packets. */
+  double virtual_packet_roulette_survival;
   int64_t reflective_inner_boundary;
+  /**
+   * @brief Event counts of the real packets (shells x TARDIS_NO_OF_COUNTERS),
+   * or NULL to not count the events.
+   */
+  int64_t *event_counters;
+  /**
+   * @brief Ring buffer of packet trace records, or NULL to not trace the
+   * packets.
+   */
+  packet_trace_record_t *packet_trace;
+  int64_t packet_trace_size;
+  /** Only the packets whose id is a multiple of the stride are traced. */
+  int64_t packet_trace_stride;
+  /** Number of records written so far, shared by all threads. */
+  int64_t *packet_trace_position;
+  int64_t packet_trace_iteration;
+  /**
+   * @brief Logs of the j_blue estimator and virtual packet spectrum
+   * increments, or NULL to add them to line_lists_j_blues and
+   * spectrum_virt_nu directly.
+   */
+  estimator_log_t *j_blue_log;
+  estimator_log_t *spectrum_virt_nu_log;
   int64_t current_packet_id;
+  int64_t first_packet_id;
+  transport_kernel_t transport_kernel;
 } storage_model_t;
 
+/** Callback reporting the progress of the packet transport.
+ *
+ * Called with the number of transported packets, the number of packets per
+ * second since the start of the transport and the user data pointer.
+ */
+typedef void (*montecarlo_progress_callback_t) (int64_t packets_done,
+						double packets_per_second,
+						void *data);
+
 typedef void (*montecarlo_event_handler_t) (rpacket_t * packet,
 					    storage_model_t * storage,
-					    double distance);
+					    double distance,
+					    philox_state_t * rng_state);
 
 /** Look for a place to insert a value in an inversely sorted float array.
  *
@@ -153,16 +386,44 @@ inline tardis_error_t reverse_binary_search (double *x, double x_insert,
 inline tardis_error_t binary_search (double *x, double x_insert, int64_t imin,
 				     int64_t imax, int64_t * result);
 
+/** Set up the bucket index of a line list.
+ *
+ * @param index line index to set up
+ * @param nu inversely sorted array of line frequencies
+ * @param number_of_lines number of lines in the line list
+ * @param no_of_buckets number of buckets
+ * @param bucket_starts array of no_of_buckets + 1 elements, filled if
+ * fill_buckets is true and otherwise assumed to be filled by an earlier call
+ * with the same line list
+ * @param fill_buckets whether to fill bucket_starts
+ */
+void line_index_init (line_index_t * index, double *nu,
+		      int64_t number_of_lines, int64_t no_of_buckets,
+		      int64_t * bucket_starts, bool fill_buckets);
+
+/** Bucket of a frequency in a line index.
+ *
+ * @param index line index
+ * @param nu frequency
+ *
+ * @return bucket number, non-increasing with nu
+ */
+inline int64_t line_index_bucket (line_index_t * index, double nu);
+
 /** Insert a value in to an array of line frequencies
  *
  * @param nu array of line frequencies
  * @param nu_insert value of nu key
  * @param number_of_lines number of lines in the line list
+ * @param index bucket index of the line list
  *
- * @return index of the next line ot the red. If the key value is redder than the reddest line returns number_of_lines.
+ * @return index of the next line ot the red (the first line with a frequency
+ * below nu_insert). If the key value is redder than the reddest line returns
+ * number_of_lines.
  */
 inline tardis_error_t line_search (double *nu, double nu_insert,
-				   int64_t number_of_lines, int64_t * result);
+				   int64_t number_of_lines,
+				   line_index_t * index, int64_t * result);
 
 /** Calculate the distance to shell boundary.
  *
@@ -195,7 +456,19 @@ extern inline tardis_error_t compute_distance2line (rpacket_t * packet,
 inline double compute_distance2electron (rpacket_t * packet,
 					 storage_model_t * storage);
 
-inline int64_t macro_atom (rpacket_t * packet, storage_model_t * storage);
+/** Follow the jumps of a macro atom activated by a line absorption.
+ *
+ * Every jump picks a transition of the active level by a binary search of
+ * the cumulative transition probabilities.
+ *
+ * @param packet rpacket structure with packet information
+ * @param storage storage model data
+ * @param rng_state random number stream of the packet
+ *
+ * @return id of the emission line
+ */
+inline int64_t macro_atom (rpacket_t * packet, storage_model_t * storage,
+			   philox_state_t * rng_state);
 
 inline double move_packet (rpacket_t * packet, storage_model_t * storage,
 			   double distance);
@@ -204,12 +477,26 @@ inline void increment_j_blue_estimator (rpacket_t * packet,
 					storage_model_t * storage,
 					double d_line, int64_t j_blue_idx);
 
+/** Append an increment to an estimator log.
+ *
+ * The capacity of the log is doubled when it is full; if that fails,
+ * allocation_failed is set and the increment is dropped.
+ *
+ * @param log estimator log of a thread
+ * @param index index into the estimator array
+ * @param value increment
+ */
+void estimator_log_append (estimator_log_t * log, int64_t index,
+			   double value);
+
 int64_t montecarlo_one_packet (storage_model_t * storage, rpacket_t * packet,
-			       int64_t virtual_mode);
+			       int64_t virtual_mode,
+			       philox_state_t * rng_state);
 
 int64_t montecarlo_one_packet_loop (storage_model_t * storage,
 				    rpacket_t * packet,
-				    int64_t virtual_packet);
+				    int64_t virtual_packet,
+				    philox_state_t * rng_state);
 
 inline double rpacket_get_nu (rpacket_t * packet);
 
@@ -235,15 +522,15 @@ inline double rpacket_get_nu_line (rpacket_t * packet);
 
 inline void rpacket_set_nu_line (rpacket_t * packet, double nu_line);
 
-inline unsigned int rpacket_get_current_shell_id (rpacket_t * packet);
+inline int64_t rpacket_get_current_shell_id (rpacket_t * packet);
 
 inline void rpacket_set_current_shell_id (rpacket_t * packet,
-					  unsigned int current_shell_id);
+					  int64_t current_shell_id);
 
-inline unsigned int rpacket_get_next_line_id (rpacket_t * packet);
+inline int64_t rpacket_get_next_line_id (rpacket_t * packet);
 
 inline void rpacket_set_next_line_id (rpacket_t * packet,
-				      unsigned int next_line_id);
+				      int64_t next_line_id);
 
 inline bool rpacket_get_last_line (rpacket_t * packet);
 
@@ -289,11 +576,69 @@ inline rpacket_status_t rpacket_get_status (rpacket_t * packet);
 
 inline void rpacket_set_status (rpacket_t * packet, rpacket_status_t status);
 
-inline void rpacket_reset_tau_event (rpacket_t * packet);
+inline void rpacket_reset_tau_event (rpacket_t * packet,
+				     philox_state_t * rng_state);
 
+/** Initialize a real packet at the inner boundary.
+ *
+ * The comoving frequency, direction and energy of the packet are read from
+ * the packet arrays of the storage model or, if storage->packet_nus is NULL,
+ * generated from the first two numbers of the random stream of the packet:
+ * the frequency by inverting the tabulated cumulative distribution of the
+ * packet source, mu as the square root of a uniform number.
+ *
+ * @param packet packet to initialize
+ * @param storage storage model data
+ * @param packet_index index of the packet within the storage model
+ * @param virtual_packet_flag number of virtual packets spawned per
+ * interaction
+ * @param rng_state random stream of the packet
+ */
 tardis_error_t rpacket_init (rpacket_t * packet, storage_model_t * storage,
-			     int packet_index, int virtual_packet_flag);
+			     int64_t packet_index, int virtual_packet_flag,
+			     philox_state_t * rng_state);
 
-void initialize_random_kit (unsigned long seed);
+/** Transport all packets of the storage model.
+ *
+ * The packets are split into chunks of TARDIS_PACKET_CHUNK_SIZE, which are
+ * distributed over nthreads OpenMP threads (if TARDIS was compiled with
+ * OpenMP, otherwise a single thread is used). Every packet draws its random
+ * numbers from its own Philox stream keyed by (seed, iteration, packet
+ * index), where the packet index is counted from storage->first_packet_id
+ * so that a subset of the packets of an iteration can be transported
+ * separately. The js, nubars and event counters of a chunk are collected in
+ * private buffers, the j_blue and virtual spectrum increments in logs
+ * (estimator_log_t). After a chunk, the sum of its increments to every entry
+ * is added to the estimators in storage in chunk order, so the result is
+ * bitwise identical for any number of threads and equals adding the
+ * estimators of the chunks transported separately into zeroed arrays.
+ *
+ * With storage->transport_kernel == TARDIS_TRANSPORT_KERNEL_EVENT the real
+ * packets of a chunk are transported in batches (packet_batch_t): every
+ * sweep computes the distances of all packets in process and then handles
+ * the packets grouped by event type. The fate of every packet is the same
+ * as with the default kernel that transports one packet after the other.
+ *
+ * @param storage storage model data
+ * @param virtual_packet_flag number of virtual packets spawned per interaction
+ * @param nthreads number of threads
+ * @param seed seed of the random number generator
+ * @param iteration index of the current iteration
+ * @param progress_callback called at most every progress_interval seconds
+ * after a chunk of packets is finished, may be NULL
+ * @param progress_interval minimum time between two progress reports (s)
+ * @param progress_data passed to progress_callback
+ *
+ * @return TARDIS_ERROR_ALLOCATION_FAILED if the thread buffers or logs could
+ * not be allocated, TARDIS_ERROR_OK otherwise
+ */
+tardis_error_t montecarlo_main_loop (storage_model_t * storage,
+				     int64_t virtual_packet_flag,
+				     int nthreads, unsigned long seed,
+				     int64_t iteration,
+				     montecarlo_progress_callback_t
+				     progress_callback,
+				     double progress_interval,
+				     void *progress_data);
 
 #endif // TARDIS_CMONTECARLO_H
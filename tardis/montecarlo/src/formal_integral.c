@@ -0,0 +1,137 @@
+#include <math.h>
+#ifdef WITHOPENMP
+#include <omp.h>
+#endif
+#include "formal_integral.h"
+
+#define SPEED_OF_LIGHT 29979245800.0
+
+/** Index of the first line of a line list sorted from blue to red that is
+ * redder than nu. */
+static int64_t
+first_line_redder_than (const double *line_list_nu, int64_t no_of_lines,
+			double nu)
+{
+  int64_t imin = 0;
+  int64_t imax = no_of_lines;
+  int64_t imid;
+  while (imin < imax)
+    {
+      imid = imin + (imax - imin) / 2;
+      if (line_list_nu[imid] < nu)
+	{
+	  imax = imid;
+	}
+      else
+	{
+	  imin = imid + 1;
+	}
+    }
+  return imin;
+}
+
+/** Shell whose outer radius is the first one not below r. */
+static int64_t
+find_shell (const double *r_outer, int64_t no_of_shells, double r)
+{
+  int64_t imin = 0;
+  int64_t imax = no_of_shells - 1;
+  int64_t imid;
+  while (imin < imax)
+    {
+      imid = imin + (imax - imin) / 2;
+      if (r_outer[imid] < r)
+	{
+	  imin = imid + 1;
+	}
+      else
+	{
+	  imax = imid;
+	}
+    }
+  return imin;
+}
+
+/** Emergent intensity of one ray.
+ *
+ * In homologous expansion the comoving frequency at the position z along
+ * the ray (towards the observer) is nu (1 - z / (c t)), so the ray comes
+ * into resonance with the lines in the order of the line list, each at
+ * z = c t (1 - nu_line / nu).
+ */
+static double
+integrate_ray (double nu, double p, const double *r_inner,
+	       const double *r_outer, int64_t no_of_shells,
+	       double time_explosion, const double *line_list_nu,
+	       int64_t no_of_lines, const double *exp_tau_sobolevs,
+	       const double *attenuated_source_functions,
+	       double inner_intensity)
+{
+  double ct = SPEED_OF_LIGHT * time_explosion;
+  double r_max = r_outer[no_of_shells - 1];
+  double z_start, z_end, z, r, nu_end, intensity;
+  int64_t line_id, shell_id, idx;
+  if (p >= r_max)
+    {
+      return 0.0;
+    }
+  z_end = sqrt (r_max * r_max - p * p);
+  if (p < r_inner[0])
+    {
+      z_start = sqrt (r_inner[0] * r_inner[0] - p * p);
+      intensity = inner_intensity;
+    }
+  else
+    {
+      z_start = -z_end;
+      intensity = 0.0;
+    }
+  nu_end = nu * (1.0 - z_end / ct);
+  for (line_id = first_line_redder_than (line_list_nu, no_of_lines,
+					 nu * (1.0 - z_start / ct));
+       line_id < no_of_lines && line_list_nu[line_id] >= nu_end; line_id++)
+    {
+      z = ct * (1.0 - line_list_nu[line_id] / nu);
+      r = sqrt (p * p + z * z);
+      if (r < r_inner[0])
+	{
+	  continue;
+	}
+      shell_id = find_shell (r_outer, no_of_shells, r);
+      idx = shell_id * no_of_lines + line_id;
+      intensity = intensity * exp_tau_sobolevs[idx] +
+	attenuated_source_functions[idx];
+    }
+  return intensity;
+}
+
+void
+formal_integral (const double *nus, int64_t no_of_nus,
+		 const double *impact_parameters,
+		 int64_t no_of_impact_parameters,
+		 const double *r_inner, const double *r_outer,
+		 int64_t no_of_shells, double time_explosion,
+		 const double *line_list_nu, int64_t no_of_lines,
+		 const double *exp_tau_sobolevs,
+		 const double *attenuated_source_functions,
+		 const double *inner_intensities, double *intensities,
+		 int nthreads)
+{
+  int64_t i;
+#ifdef WITHOPENMP
+#pragma omp parallel for num_threads(nthreads) schedule(dynamic, 16)
+#else
+  (void) nthreads;
+#endif
+  for (i = 0; i < no_of_nus * no_of_impact_parameters; i++)
+    {
+      int64_t nu_id = i / no_of_impact_parameters;
+      intensities[i] =
+	integrate_ray (nus[nu_id],
+		       impact_parameters[i % no_of_impact_parameters],
+		       r_inner, r_outer, no_of_shells, time_explosion,
+		       line_list_nu, no_of_lines, exp_tau_sobolevs,
+		       attenuated_source_functions,
+		       inner_intensities[nu_id]);
+    }
+}
@@ -0,0 +1,44 @@
+#ifndef TARDIS_FORMAL_INTEGRAL_H
+#define TARDIS_FORMAL_INTEGRAL_H
+
+#include <stdint.h>
+
+/** Integrate the emergent intensity along rays through the ejecta.
+ *
+ * A ray with impact parameter p runs parallel to the line of sight at the
+ * observer frequency nu. Rays that hit the photosphere (p < r_inner[0])
+ * start there with the intensity of the photosphere, the others start at
+ * the back of the ejecta with zero intensity. Every line the ray comes into
+ * resonance with attenuates the intensity and adds its source function in
+ * the Sobolev approximation, I = I exp(-tau) + (1 - exp(-tau)) S. Electron
+ * scattering is neglected.
+ *
+ * @param nus observer frame frequencies
+ * @param no_of_nus number of frequencies
+ * @param impact_parameters impact parameters of the rays
+ * @param no_of_impact_parameters number of impact parameters
+ * @param r_inner inner radii of the shells
+ * @param r_outer outer radii of the shells
+ * @param no_of_shells number of shells
+ * @param time_explosion time since the explosion
+ * @param line_list_nu line frequencies sorted from blue to red
+ * @param no_of_lines number of lines
+ * @param exp_tau_sobolevs exp(-tau_sobolev) (shells x lines)
+ * @param attenuated_source_functions (1 - exp(-tau_sobolev)) S (shells x
+ * lines)
+ * @param inner_intensities intensity of the photosphere at every frequency
+ * @param intensities emergent intensities (frequencies x impact parameters)
+ * @param nthreads number of OpenMP threads
+ */
+void formal_integral (const double *nus, int64_t no_of_nus,
+		      const double *impact_parameters,
+		      int64_t no_of_impact_parameters,
+		      const double *r_inner, const double *r_outer,
+		      int64_t no_of_shells, double time_explosion,
+		      const double *line_list_nu, int64_t no_of_lines,
+		      const double *exp_tau_sobolevs,
+		      const double *attenuated_source_functions,
+		      const double *inner_intensities, double *intensities,
+		      int nthreads);
+
+#endif // TARDIS_FORMAL_INTEGRAL_H
@@ -0,0 +1,74 @@
+#include "philox.h"
+
+#define PHILOX_M4x32_0 ((uint32_t) 0xD2511F53)
+#define PHILOX_M4x32_1 ((uint32_t) 0xCD9E8D57)
+#define PHILOX_W32_0 ((uint32_t) 0x9E3779B9)
+#define PHILOX_W32_1 ((uint32_t) 0xBB67AE85)
+#define PHILOX_ROUNDS 10
+
+static inline void
+philox_round (uint32_t * counter, const uint32_t * key)
+{
+  uint64_t product0 = (uint64_t) PHILOX_M4x32_0 * counter[0];
+  uint64_t product1 = (uint64_t) PHILOX_M4x32_1 * counter[2];
+  uint32_t hi0 = (uint32_t) (product0 >> 32), lo0 = (uint32_t) product0;
+  uint32_t hi1 = (uint32_t) (product1 >> 32), lo1 = (uint32_t) product1;
+  counter[0] = hi1 ^ counter[1] ^ key[0];
+  counter[1] = lo1;
+  counter[2] = hi0 ^ counter[3] ^ key[1];
+  counter[3] = lo0;
+}
+
+void
+philox4x32_10 (const uint32_t * counter, const uint32_t * key,
+	       uint32_t * result)
+{
+  int i;
+  uint32_t round_key[2] = { key[0], key[1] };
+  result[0] = counter[0];
+  result[1] = counter[1];
+  result[2] = counter[2];
+  result[3] = counter[3];
+  for (i = 0; i < PHILOX_ROUNDS; i++)
+    {
+      if (i > 0)
+	{
+	  round_key[0] += PHILOX_W32_0;
+	  round_key[1] += PHILOX_W32_1;
+	}
+      philox_round (result, round_key);
+    }
+}
+
+void
+philox_seed (philox_state_t * state, uint64_t seed, uint32_t stream_id,
+	     uint64_t substream_id)
+{
+  state->key[0] = (uint32_t) seed;
+  state->key[1] = (uint32_t) (seed >> 32);
+  state->counter[0] = 0;
+  state->counter[1] = stream_id;
+  state->counter[2] = (uint32_t) substream_id;
+  state->counter[3] = (uint32_t) (substream_id >> 32);
+  state->block_position = 4;
+}
+
+uint32_t
+philox_uint32 (philox_state_t * state)
+{
+  if (state->block_position == 4)
+    {
+      philox4x32_10 (state->counter, state->key, state->block);
+      state->counter[0]++;
+      state->block_position = 0;
+    }
+  return state->block[state->block_position++];
+}
+
+double
+philox_double (philox_state_t * state)
+{
+  /* Same construction as rk_double: 27 + 26 bits. */
+  uint32_t a = philox_uint32 (state) >> 5, b = philox_uint32 (state) >> 6;
+  return (a * 67108864.0 + b) / 9007199254740992.0;
+}
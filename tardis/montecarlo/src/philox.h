@@ -0,0 +1,48 @@
+#ifndef TARDIS_PHILOX_H
+#define TARDIS_PHILOX_H
+
+#include <stdint.h>
+
+/**
+ * @brief State of a Philox4x32-10 counter-based random number stream.
+ *
+ * Philox (Salmon et al. 2011, "Parallel random numbers: as easy as 1, 2, 3")
+ * turns a 128 bit counter and a 64 bit key into 128 random bits. A stream
+ * is identified by the key and the upper 96 bits of the counter. Streams
+ * do not share any state and every number of a stream can be recomputed
+ * without generating the ones before it.
+ */
+typedef struct PhiloxState
+{
+  uint32_t key[2]; /**< Key, the seed of the stream. */
+  uint32_t counter[4]; /**< counter[0] is the block number within the stream. */
+  uint32_t block[4]; /**< Random bits of the current block. */
+  int64_t block_position; /**< Number of words of block already used. */
+} philox_state_t;
+
+/** Initialize a stream.
+ *
+ * @param state stream state
+ * @param seed key of the stream
+ * @param stream_id first stream identifier (e.g. the iteration)
+ * @param substream_id second stream identifier (e.g. the packet index)
+ */
+void philox_seed (philox_state_t * state, uint64_t seed, uint32_t stream_id,
+		  uint64_t substream_id);
+
+/** Compute one block of the Philox4x32-10 function.
+ *
+ * @param counter input counter
+ * @param key input key
+ * @param result 128 output bits
+ */
+void philox4x32_10 (const uint32_t * counter, const uint32_t * key,
+		    uint32_t * result);
+
+/** Get the next 32 random bits of a stream. */
+uint32_t philox_uint32 (philox_state_t * state);
+
+/** Get the next random double in [0, 1) with 53 bit resolution. */
+double philox_double (philox_state_t * state);
+
+#endif // TARDIS_PHILOX_H
@@ -5,10 +5,23 @@ import numpy as np
 from astropy import units
 
 import logging
-from util import intensity_black_body
+from util import h_cgs, k_B_cgs
+from tardis.montecarlo import montecarlo
 
 logger = logging.getLogger(__name__)
 
+PACKET_SAMPLING_METHODS = ('random', 'sobol')
+
+# Normalized partial sums of sum_l l^-4 = pi^4 / 90, the weights of the terms of the Planck function
+PLANCK_SERIES = np.cumsum(np.arange(1, 1001, dtype=np.float64) ** -4) * 90 / np.pi ** 4
+PLANCK_SERIES[-1] = 1.0
+
+# Upper end of the tabulated Planck distribution in x = h nu / (k T), the rest of the distribution is below 1e-17
+PLANCK_X_MAX = 50.0
+
+# Below this fraction of the blackbody in the frequency range the tabulated distribution replaces rejection
+MIN_PLANCK_ACCEPTANCE = 0.1
+
 class SimplePacketSource:
     """Initializing photon source
         Parameters
@@ -19,10 +32,20 @@ class SimplePacketSource:
 
         nu_end : float
             highest_frequency
+
+        sampling : str
+            'random' draws the frequencies and directions from np.random, 'sobol' from a randomly shifted
+            two-dimensional Sobol sequence, which covers the blackbody more evenly (lower noise of the estimators
+            for the same number of packets)
+
+        generate_in_kernel : bool
+            if True, `create_packets` only tabulates the blackbody (`packet_source_table`) and the transport kernel
+            generates the random packets from it, the packet arrays are None
     """
 
     @classmethod
-    def from_wavelength(cls, wavelength_start, wavelength_end,  seed=250819801106, blackbody_sampling=int(1e6)):
+    def from_wavelength(cls, wavelength_start, wavelength_end,  seed=250819801106, blackbody_sampling=int(1e6),
+                        sampling='random', generate_in_kernel=False):
         """Initializing from wavelength
 
         Parameters
@@ -37,12 +60,22 @@ class SimplePacketSource:
         nu_start = wavelength_end.to('Hz', units.spectral()).value
         nu_end = wavelength_start.to('Hz', units.spectral()).value
 
-        return cls(nu_start, nu_end, seed=seed, blackbody_sampling=blackbody_sampling)
+        return cls(nu_start, nu_end, seed=seed, blackbody_sampling=blackbody_sampling, sampling=sampling,
+                   generate_in_kernel=generate_in_kernel)
 
-    def __init__(self, nu_start, nu_end, seed=250819801106, blackbody_sampling=int(1e6)):
+    def __init__(self, nu_start, nu_end, seed=250819801106, blackbody_sampling=int(1e6), sampling='random',
+                 generate_in_kernel=False):
+        if sampling not in PACKET_SAMPLING_METHODS:
+            raise ValueError('Unknown packet sampling %r (allowed: %s)' % (sampling, ', '.join(PACKET_SAMPLING_METHODS)))
+        if generate_in_kernel and sampling != 'random':
+            raise ValueError('Packets generated in the transport kernel can only be sampled randomly')
         self.nu_start = nu_start
         self.nu_end = nu_end
         self.blackbody_sampling = blackbody_sampling
+        self.sampling = sampling
+        self.generate_in_kernel = generate_in_kernel
+        self.planck_cdf = None
+        self.packet_source_table = None
         np.random.seed(seed)
 
 
@@ -64,11 +97,24 @@ class SimplePacketSource:
             np.random.seed(seed)
 
         number_of_packets = int(number_of_packets)
-
-
-        self.packet_nus = self.random_blackbody_nu(t_rad, number_of_packets)
-
-        self.packet_mus = np.sqrt(np.random.random(size=number_of_packets))
+        self.no_of_packets = number_of_packets
+        self.packet_energy = 1.0 / number_of_packets
+
+        if self.generate_in_kernel:
+            logger.info('Tabulating the blackbody for %d packets generated in the transport for t_inner=%.2f',
+                        number_of_packets, t_rad)
+            self.packet_source_table = self.get_packet_source_table(t_rad)
+            self.packet_nus = self.packet_mus = self.packet_energies = None
+            return
+        if self.sampling == 'sobol':
+            logger.info('Calculating %d quasi-random packets for t_inner=%.2f', number_of_packets, t_rad)
+            # a new random shift every iteration, drawn from the seeded np.random state
+            uniform_deviates = montecarlo.sobol_sequence(number_of_packets, 2, np.random.randint(0, 2 ** 31 - 1))
+            self.packet_nus = self.blackbody_nu(t_rad, uniform_deviates[:, 0])
+            self.packet_mus = np.sqrt(uniform_deviates[:, 1])
+        else:
+            self.packet_nus = self.random_blackbody_nu(t_rad, number_of_packets)
+            self.packet_mus = np.sqrt(np.random.random(size=number_of_packets))
         self.packet_energies = np.ones(number_of_packets) / number_of_packets
 
 
@@ -76,6 +122,10 @@ class SimplePacketSource:
         """
         Creating the random nus for the energy packets
 
+        x = h nu / (k T) is sampled exactly from the Planck function (Bjorkman & Wood 2001, ApJ 554, 615), packets
+        outside nu_start to nu_end are drawn again. If less than `MIN_PLANCK_ACCEPTANCE` of the blackbody falls into
+        the frequency range, the frequencies are drawn from the tabulated distribution instead.
+
         Parameters
         ----------
 
@@ -86,11 +136,103 @@ class SimplePacketSource:
             the number of packets
         """
         logger.info('Calculating %d packets for t_inner=%.2f', number_of_packets, T)
-        nu = np.linspace(self.nu_start, self.nu_end, num=self.blackbody_sampling)
-        intensity = intensity_black_body(nu, T)
-        cum_blackbody = np.cumsum(intensity)
-        norm_cum_blackbody = cum_blackbody / cum_blackbody.max()
-        return nu[norm_cum_blackbody.searchsorted(np.random.random(number_of_packets))] + \
-               np.random.random(size=number_of_packets) * (nu[1] - nu[0])
+        x_start, x_end = self.nu_start * h_cgs / (k_B_cgs * T), self.nu_end * h_cgs / (k_B_cgs * T)
+        x, planck_cdf = self.get_planck_cdf()
+        cdf_start, cdf_end = np.interp([x_start, x_end], x, planck_cdf)
+        if cdf_end - cdf_start < MIN_PLANCK_ACCEPTANCE:
+            return self.blackbody_nu(T, np.random.random(number_of_packets))
+
+        packet_xs = np.empty(number_of_packets)
+        rejected = np.arange(number_of_packets)
+        while rejected.size > 0:
+            packet_xs[rejected] = sample_planck_x(rejected.size)
+            rejected = rejected[(packet_xs[rejected] < x_start) | (packet_xs[rejected] > x_end)]
+        return packet_xs * k_B_cgs * T / h_cgs
+
+    def get_planck_cdf(self):
+        """
+        Normalized cumulative distribution of the Planck function in x = h nu / (k T)
 
+        The table does not depend on the temperature, it is computed with `blackbody_sampling` points on the first
+        call and kept.
+
+        Returns
+        -------
+
+        x, planck_cdf : `numpy.ndarray`
+        """
+        if self.planck_cdf is None:
+            x = np.linspace(0.0, PLANCK_X_MAX, num=self.blackbody_sampling)
+            planck = np.zeros_like(x)
+            planck[1:] = x[1:] ** 3 / np.expm1(x[1:])
+            planck_cdf = np.hstack(([0.0], np.cumsum(0.5 * (planck[1:] + planck[:-1]) * np.diff(x))))
+            self.planck_cdf = x, planck_cdf / planck_cdf[-1]
+        return self.planck_cdf
+
+    def blackbody_nu(self, T, uniform_deviates):
+        """
+        Map uniform deviates to blackbody frequencies by inverting the cumulative distribution
+
+        The cached distribution in x is truncated to nu_start to nu_end and inverted by linear interpolation, so
+        neighbouring deviates stay neighbouring frequencies and a low-discrepancy sequence keeps its stratification.
+
+        Parameters
+        ----------
+
+        T : `float`
+            temperature of the blackbody
 
+        uniform_deviates : `numpy.ndarray`
+            numbers in [0, 1)
+        """
+        x, planck_cdf = self.get_planck_cdf()
+        x_start, x_end = self.nu_start * h_cgs / (k_B_cgs * T), self.nu_end * h_cgs / (k_B_cgs * T)
+        cdf_start, cdf_end = np.interp([x_start, x_end], x, planck_cdf)
+        packet_xs = np.interp(cdf_start + uniform_deviates * (cdf_end - cdf_start), planck_cdf, x)
+        return packet_xs * k_B_cgs * T / h_cgs
+
+
+    def get_packet_source_table(self, T):
+        """
+        Cumulative distribution of the blackbody frequencies between nu_start and nu_end
+
+        The cached distribution in x is cut to the frequency range and normalized, the transport kernel inverts it
+        by linear interpolation as `blackbody_nu` does.
+
+        Parameters
+        ----------
+
+        T : `float`
+            temperature of the blackbody
+
+        Returns
+        -------
+
+        packet_source_cdf, packet_source_nus : `numpy.ndarray`
+            cumulative distribution from 0 to 1 and the frequencies it is tabulated at
+        """
+        x, planck_cdf = self.get_planck_cdf()
+        x_start, x_end = self.nu_start * h_cgs / (k_B_cgs * T), self.nu_end * h_cgs / (k_B_cgs * T)
+        table_xs = np.hstack(([x_start], x[(x > x_start) & (x < x_end)], [x_end]))
+        table_cdf = np.interp(table_xs, x, planck_cdf)
+        table_cdf = (table_cdf - table_cdf[0]) / (table_cdf[-1] - table_cdf[0])
+        return table_cdf, table_xs * k_B_cgs * T / h_cgs
+
+
+def sample_planck_x(size):
+    """
+    Draw x = h nu / (k T) from the Planck function x^3 / (exp(x) - 1)
+
+    The Planck function is the sum over l of x^3 exp(-l x), a Gamma distribution of shape 4 and rate l with the
+    weight l^-4. The series picks l, the product of four uniform deviates then gives x = -ln(prod) / l.
+
+    Parameters
+    ----------
+
+    size : `int`
+    """
+    ls = PLANCK_SERIES.searchsorted(np.random.random(size)) + 1
+    uniform_product = np.random.random(size)
+    for i in range(3):
+        uniform_product *= np.random.random(size)
+    return -np.log(uniform_product) / ls
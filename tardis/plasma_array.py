@@ -85,6 +85,10 @@ class BasePlasmaArray(object):
     saha_treatment : `str`, optional
         Describes what Saha treatment to use for ionization calculations. The options are `lte` or `nebular`
 
+    single_precision_storage : `bool`, optional
+        store the tau_sobolevs and the transition probabilities as float32 (the default is `False`). They are
+        still calculated in double precision.
+
     Returns
     -------
 
@@ -141,7 +145,7 @@ class BasePlasmaArray(object):
 
 
     def __init__(self, number_densities, atom_data, time_explosion, delta_treatment=None, nlte_config=None,
-                 ionization_mode='lte', excitation_mode='lte'):
+                 ionization_mode='lte', excitation_mode='lte', single_precision_storage=False):
         self.number_densities = number_densities
         self.atom_data = atom_data
         self.time_explosion = time_explosion
@@ -156,6 +160,8 @@ class BasePlasmaArray(object):
 
         self.excitation_mode = excitation_mode
 
+        self.storage_dtype = np.float32 if single_precision_storage else np.float64
+
         if ionization_mode == 'lte':
             self.calculate_saha = self.calculate_saha_lte
         elif ionization_mode == 'nebular':
@@ -535,9 +541,9 @@ class BasePlasmaArray(object):
         """
 
         if not hasattr(self, 'beta_sobolevs'):
-            self.beta_sobolevs = np.zeros_like(self.tau_sobolevs.values)
+            self.beta_sobolevs = np.zeros(self.tau_sobolevs.shape, order='F')
 
-        macro_atom.calculate_beta_sobolev(self.tau_sobolevs.values.ravel(order='F'),
+        macro_atom.calculate_beta_sobolev(self.tau_sobolevs.values.astype(np.float64).ravel(order='F'),
                                           self.beta_sobolevs.ravel(order='F'))
         self.beta_sobolevs_precalculated = True
 
@@ -646,7 +652,8 @@ class BasePlasmaArray(object):
 
         tau_sobolevs = sobolev_coefficient * f_lu[np.newaxis].T * wavelength[np.newaxis].T * self.time_explosion * \
                        n_lower * self.stimulated_emission_factor
-        return pd.DataFrame(tau_sobolevs, index=self.atom_data.lines.index, columns=np.arange(len(self.t_rads)))
+        return pd.DataFrame(tau_sobolevs.astype(self.storage_dtype), index=self.atom_data.lines.index,
+                            columns=np.arange(len(self.t_rads)))
 
 
 
@@ -654,14 +661,18 @@ class BasePlasmaArray(object):
     def calculate_transition_probabilities(self):
         """
             Updating the Macro Atom computations
+
+            The cumulative probabilities within every block of transitions, which
+            the montecarlo kernel searches, are stored in
+            `cumulative_transition_probabilities`.
         """
 
         macro_atom_data = self.atom_data.macro_atom_data
         if not hasattr(self, 'beta_sobolevs'):
-            self.beta_sobolevs = np.zeros_like(self.tau_sobolevs.values)
+            self.beta_sobolevs = np.zeros(self.tau_sobolevs.shape, order='F')
 
         if not self.beta_sobolevs_precalculated:
-            macro_atom.calculate_beta_sobolev(self.tau_sobolevs.values.ravel(order='F'),
+            macro_atom.calculate_beta_sobolev(self.tau_sobolevs.values.astype(np.float64).ravel(order='F'),
                                           self.beta_sobolevs.ravel(order='F'))
 
         transition_probabilities = (macro_atom_data.transition_probability.values[np.newaxis].T *
@@ -676,7 +687,9 @@ class BasePlasmaArray(object):
         block_references = np.hstack((self.atom_data.macro_atom_references.block_references,
                                       len(macro_atom_data)))
         macro_atom.normalize_transition_probabilities(transition_probabilities, block_references)
-        return pd.DataFrame(transition_probabilities, index=macro_atom_data.transition_line_id,
+        self.cumulative_transition_probabilities = macro_atom.calculate_cumulative_transition_probabilities(
+            transition_probabilities, block_references).astype(self.storage_dtype, order='F')
+        return pd.DataFrame(transition_probabilities.astype(self.storage_dtype), index=macro_atom_data.transition_line_id,
                      columns=self.tau_sobolevs.columns)
 
 
@@ -3,11 +3,46 @@ import time
 from pandas import HDFStore
 import os
 
+from tardis.montecarlo.distributed import TransportCoordinator
+from tardis.montecarlo.packet_trace import PacketTrace
+from tardis.montecarlo.process_pool import TransportPool
+
 # Adding logging support
 logger = logging.getLogger(__name__)
 
 
 def run_radial1d(radial1d_model, history_fname=None):
+    montecarlo_config = radial1d_model.tardis_config.montecarlo
+    if montecarlo_config.packet_trace_file:
+        if montecarlo_config.backend != 'threads':
+            logger.warning('Packets are only traced by the threads backend, not by the %s backend',
+                           montecarlo_config.backend)
+        radial1d_model.packet_trace = PacketTrace(montecarlo_config.packet_trace_size,
+                                                  montecarlo_config.packet_trace_stride,
+                                                  path=montecarlo_config.packet_trace_file)
+    try:
+        if montecarlo_config.backend == 'distributed':
+            radial1d_model.transport_coordinator = TransportCoordinator.from_config(montecarlo_config)
+            try:
+                run_radial1d_iterations(radial1d_model, history_fname)
+            finally:
+                radial1d_model.transport_coordinator.close()
+                radial1d_model.transport_coordinator = None
+        elif montecarlo_config.backend == 'processes':
+            radial1d_model.transport_pool = TransportPool(montecarlo_config.no_of_processes)
+            try:
+                run_radial1d_iterations(radial1d_model, history_fname)
+            finally:
+                radial1d_model.transport_pool.close()
+                radial1d_model.transport_pool = None
+        else:
+            run_radial1d_iterations(radial1d_model, history_fname)
+    finally:
+        if radial1d_model.packet_trace is not None:
+            radial1d_model.packet_trace.flush()
+
+
+def run_radial1d_iterations(radial1d_model, history_fname=None):
     if history_fname:
         if os.path.exists(history_fname):
             logger.warn('History file %s exists - it will be overwritten', history_fname)
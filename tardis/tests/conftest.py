@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from tardis import macro_atom
+
+
+@pytest.fixture
+def transport_inputs():
+    no_of_shells = 3
+    line_list_nu = np.linspace(2e15, 5e14, 40)
+    v_inner = np.linspace(1.1e9, 1.9e9, no_of_shells)
+    v_outer = v_inner + 0.4e9 * np.ones(no_of_shells)
+    time_explosion = 13 * 86400.
+    arrays = dict(r_inner=v_inner * time_explosion,
+                  r_outer=v_outer * time_explosion,
+                  v_inner=v_inner,
+                  electron_densities=np.array([1e9, 5e8, 2e8]),
+                  line_list_nu=line_list_nu,
+                  line_lists_tau_sobolevs=np.ascontiguousarray(
+                      np.random.RandomState(1).uniform(0, 2, (no_of_shells, line_list_nu.size))))
+    parameters = dict(time_explosion=time_explosion, line_interaction_id=0,
+                      spectrum_start_nu=1e14, spectrum_end_nu=3e15, spectrum_delta_nu=29e12,
+                      spectrum_virt_nu_size=100, sigma_thomson=6.652486e-25,
+                      reflective_inner_boundary=False, inner_boundary_albedo=0.0,
+                      seed=23111963, iteration=0, transport_kernel='packet',
+                      cumulative_line_tau=False, virtual_packet_roulette_tau=0.0,
+                      virtual_packet_roulette_survival=0.1, count_events=False)
+    random_state = np.random.RandomState(2)
+    no_of_packets = 501
+    packet_nus = random_state.uniform(6e14, 1.9e15, no_of_packets)
+    packet_mus = np.sqrt(random_state.uniform(0, 1, no_of_packets))
+    packet_energies = np.ones(no_of_packets) / no_of_packets
+    return arrays, parameters, packet_nus, packet_mus, packet_energies
+
+
+@pytest.fixture
+def chunked_transport_inputs(transport_inputs):
+    # more than two chunks of packets of the transport kernel
+    arrays, parameters = transport_inputs[:2]
+    random_state = np.random.RandomState(3)
+    no_of_packets = 5000
+    packet_nus = random_state.uniform(6e14, 1.9e15, no_of_packets)
+    packet_mus = np.sqrt(random_state.uniform(0, 1, no_of_packets))
+    packet_energies = np.ones(no_of_packets) / no_of_packets
+    return arrays, parameters, packet_nus, packet_mus, packet_energies
+
+
+@pytest.fixture
+def macro_atom_transport_inputs(transport_inputs):
+    arrays, parameters = transport_inputs[:2]
+    no_of_shells, no_of_lines = arrays['line_lists_tau_sobolevs'].shape
+    no_of_levels = 10
+    transitions_per_level = 5
+    random_state = np.random.RandomState(5)
+    no_of_transitions = no_of_levels * transitions_per_level
+    # the first three transitions of every level emit a line, the others jump to another level
+    transition_type = np.tile([-1, -1, -1, 0, 1], no_of_levels).astype(np.int64)
+    transition_line_id = random_state.randint(0, no_of_lines, no_of_transitions).astype(np.int64)
+    destination_level_id = random_state.randint(0, no_of_levels, no_of_transitions).astype(np.int64)
+    transition_probabilities = random_state.uniform(0, 1, (no_of_transitions, no_of_shells))
+    block_references = np.arange(0, no_of_transitions + 1, transitions_per_level).astype(np.int64)
+    transition_probabilities /= np.repeat(np.add.reduceat(transition_probabilities, block_references[:-1]),
+                                          transitions_per_level, axis=0)
+    cumulative_transition_probabilities = macro_atom.calculate_cumulative_transition_probabilities(
+        transition_probabilities, block_references)
+    arrays.update(cumulative_transition_probabilities=np.ascontiguousarray(cumulative_transition_probabilities.T),
+                  line2macro_level_upper=np.arange(no_of_lines, dtype=np.int64) % no_of_levels,
+                  macro_block_references=block_references,
+                  transition_type=transition_type,
+                  destination_level_id=destination_level_id,
+                  transition_line_id=transition_line_id)
+    parameters['line_interaction_id'] = 2
+    return transport_inputs
@@ -0,0 +1,47 @@
+import numpy.testing as npt
+import pytest
+
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.distributed import (LocalTransportCluster, TransportCoordinator,
+                                           parse_address)
+
+
+def test_parse_address():
+    assert parse_address('node01:5555') == ('node01', 5555)
+    assert parse_address(('localhost', 5555)) == ('localhost', 5555)
+
+
+@pytest.fixture
+def coordinator(request):
+    local_cluster = LocalTransportCluster(2)
+    coordinator = TransportCoordinator(local_cluster.addresses, local_cluster.authkey,
+                                       local_cluster=local_cluster)
+    request.addfinalizer(coordinator.close)
+    return coordinator
+
+
+def test_local_cluster_matches_single_process(chunked_transport_inputs, coordinator):
+    arrays, parameters, packet_nus, packet_mus, packet_energies = chunked_transport_inputs
+    parameters['count_events'] = True
+    single_process = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2)
+    # two iterations to check that the workers keep serving the connection
+    for i in range(2):
+        coordinator.send_plasma(arrays, parameters)
+        distributed = coordinator.transport(packet_nus, packet_mus, packet_energies, virtual_packet_flag=2)
+
+        # every packet has its own random number stream and the estimators are added in the same chunks
+        for name in montecarlo.TransportResult._fields:
+            npt.assert_array_equal(getattr(distributed, name), getattr(single_process, name))
+
+
+def test_transport_needs_plasma(chunked_transport_inputs, coordinator):
+    with pytest.raises(ValueError):
+        coordinator.transport(*chunked_transport_inputs[2:])
+
+
+def test_worker_error_is_raised(chunked_transport_inputs, coordinator):
+    arrays, parameters = chunked_transport_inputs[:2]
+    del arrays['r_outer']
+    coordinator.send_plasma(arrays, parameters)
+    with pytest.raises(RuntimeError):
+        coordinator.transport(*chunked_transport_inputs[2:])
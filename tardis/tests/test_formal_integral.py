@@ -0,0 +1,80 @@
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+from astropy import units as u
+
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.formal_integral import (get_impact_parameters, integrate_luminosity_density,
+                                               calculate_line_source_functions)
+from tardis.util import intensity_black_body
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@pytest.fixture
+def source_function_model():
+    """A stand-in for a model with 2 shells, 4 lines and j_blue estimators of lines 1 and 3."""
+    plasma_config = Namespace(line_interaction_type='scatter')
+    return Namespace(tardis_config=Namespace(plasma=plasma_config),
+                     t_rads=u.Quantity([10000., 8000.], 'K'), ws=np.array([0.5, 0.25]),
+                     atom_data=Namespace(lines=pd.DataFrame({'nu': [2e15, 1.5e15, 1e15, 5e14]})),
+                     j_blue_estimator_lines=np.array([1, 3]),
+                     j_blue_estimators=np.array([[1., 2.], [3., 0.]]),
+                     j_blues_norm_factor=u.Quantity([2., 4.], '1/(cm^2 s Hz sr)'))
+
+
+def test_impact_parameters():
+    impact_parameters, widths = get_impact_parameters(1.0, 3.0, 10)
+    npt.assert_allclose(widths.sum(), 3.0)
+    assert (impact_parameters < 1.0).sum() == 5
+    # the midpoint rule is exact for the linear integrand of a constant intensity
+    npt.assert_allclose((impact_parameters * widths)[impact_parameters < 1.0].sum(), 0.5)
+
+
+def test_photosphere_without_lines(transport_inputs):
+    arrays, parameters = transport_inputs[:2]
+    nus = np.linspace(5e14, 2e15, 20)
+    inner_intensities = np.linspace(1.0, 2.0, 20)
+    no_of_shells, no_of_lines = arrays['line_lists_tau_sobolevs'].shape
+    luminosity_density = integrate_luminosity_density(nus, arrays['r_inner'], arrays['r_outer'],
+                                                      parameters['time_explosion'], arrays['line_list_nu'],
+                                                      np.zeros((no_of_shells, no_of_lines)),
+                                                      np.ones((no_of_shells, no_of_lines)), inner_intensities)
+    npt.assert_allclose(luminosity_density, 4 * np.pi ** 2 * arrays['r_inner'][0] ** 2 * inner_intensities)
+
+
+def test_optically_thick_line():
+    time_explosion = 10 * 86400.
+    ct = 29979245800.0 * time_explosion
+    r_inner = np.array([1.0, 1.5]) * 1e9 * time_explosion
+    r_outer = np.array([1.5, 2.0]) * 1e9 * time_explosion
+    line_list_nu = np.array([1e15])
+    # optically thick line with a different source function in every shell
+    exp_tau_sobolevs = np.zeros((2, 1))
+    source_functions = np.array([[5.0], [7.0]])
+    impact_parameters = np.array([0.0, 0.5, 1.8]) * 1e9 * time_explosion
+    # resonance at z = 1.2 and 1.7 (in front of the photosphere) and -0.5 (behind it) times 1e9 cm/s t
+    nus = line_list_nu[0] / (1 - np.array([1.2, 1.7, -0.5]) * 1e9 * time_explosion / ct)
+    intensities = montecarlo.formal_integral(nus, impact_parameters, r_inner, r_outer, time_explosion,
+                                             line_list_nu, exp_tau_sobolevs, source_functions, np.ones(3))
+    npt.assert_allclose(intensities, [[5.0, 5.0, 0.0], [7.0, 7.0, 0.0], [1.0, 1.0, 7.0]])
+
+
+def test_line_source_functions(source_function_model):
+    source_functions = calculate_line_source_functions(source_function_model)
+    npt.assert_allclose(source_functions[:, [1, 3]], [[2., 4.], [12., 0.]])
+    # lines without an estimator get the dilute blackbody source function
+    nus = np.array([2e15, 1e15])
+    npt.assert_allclose(source_functions[:, [0, 2]], [0.5 * intensity_black_body(nus, 10000.),
+                                                      0.25 * intensity_black_body(nus, 8000.)])
+
+
+@pytest.mark.parametrize('line_interaction_type', ['downbranch', 'macroatom'])
+def test_line_source_functions_need_scatter(source_function_model, line_interaction_type):
+    source_function_model.tardis_config.plasma.line_interaction_type = line_interaction_type
+    with pytest.raises(ValueError):
+        calculate_line_source_functions(source_function_model)
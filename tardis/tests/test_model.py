@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from tardis.model import next_no_of_packets
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@pytest.fixture
+def convergence_section():
+    return Namespace(packet_growth_factor=2.0, packet_growth_threshold=1.0)
+
+
+@pytest.fixture
+def estimator_noise():
+    return np.array([0.01, 0.01, 0.01]), np.array([0.01, 0.01, 0.01])
+
+
+def test_packets_grow_when_noise_dominates(convergence_section, estimator_noise):
+    # t_rad noise is sqrt(2) %, w noise sqrt(33) %
+    convergence = np.array([0.005, 0.01, 0.012]), np.array([0.01, 0.05, 0.02])
+    assert next_no_of_packets(300, 1000, convergence_section, *(convergence + estimator_noise)) == 600
+    # growth stops at montecarlo.no_of_packets
+    assert next_no_of_packets(600, 1000, convergence_section, *(convergence + estimator_noise)) == 1000
+    assert next_no_of_packets(1000, 1000, convergence_section, *(convergence + estimator_noise)) == 1000
+
+
+def test_packets_stay_while_radiation_field_changes(convergence_section, estimator_noise):
+    convergence = np.array([0.05, 0.1, 0.2]), np.array([0.01, 0.05, 0.02])
+    assert next_no_of_packets(300, 1000, convergence_section, *(convergence + estimator_noise)) == 300
+    convergence = np.array([0.005, 0.01, 0.012]), np.array([0.3, 0.5, 0.2])
+    assert next_no_of_packets(300, 1000, convergence_section, *(convergence + estimator_noise)) == 300
@@ -1,5 +1,8 @@
 import numpy as np
-from tardis import montecarlo
+import numpy.testing as npt
+from tardis import macro_atom
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.packet_trace import PacketTrace, PACKET_EVENT_NAMES
 import pytest
 
 test_line_list = np.array([10, 9, 8, 7, 6, 5, 5, 4, 3, 2, 1]).astype(np.float64)
@@ -56,3 +59,444 @@ test_line_list = np.array([10, 9, 8, 7, 6, 5, 5, 4, 3, 2, 1]).astype(np.float64)
 # def test_compute_distance2electron():
 #     assert montecarlo.compute_distance2electron_wrapper(0.0, 0.0, 2.0, 2.0) == 4.0
 
+
+
+@pytest.mark.parametrize(("insert_value", "expected_insert_position"), [
+    (10.5, 0),
+    (9.5, 1),
+    (5.5, 5),
+    (5.0, 7),
+    (4.5, 7),
+    (1.5, 10),
+    (1.0, 11),
+    (0.5, 11)])
+def test_find_next_line_ids(insert_value, expected_insert_position):
+    next_line_ids = montecarlo.find_next_line_ids(test_line_list, np.array([insert_value]))
+    assert next_line_ids[0] == expected_insert_position
+
+
+def test_line_bucket_index_matches_full_search():
+    random_state = np.random.RandomState(3)
+    line_list_nu = np.sort(np.round(random_state.lognormal(35, 0.5, 1000), -12))[::-1].copy()
+    nus = np.concatenate((random_state.uniform(line_list_nu.min(), line_list_nu.max(), 10000), line_list_nu))
+    line_bucket_starts = montecarlo.get_line_bucket_starts(line_list_nu)
+    assert line_bucket_starts[0] == 0
+    assert line_bucket_starts[-1] == line_list_nu.size
+    npt.assert_array_equal(montecarlo.find_next_line_ids(line_list_nu, nus, line_bucket_starts),
+                           line_list_nu.size - np.searchsorted(line_list_nu[::-1], nus, side='left'))
+
+
+def test_transport_progress_callback(transport_inputs):
+    progress = []
+    montecarlo.transport_packets(*transport_inputs, progress_callback=lambda *args: progress.append(args),
+                                 progress_interval=0.0)
+    packets_done, packets_per_second = progress[-1]
+    assert packets_done == len(transport_inputs[2])
+    assert packets_per_second > 0
+
+
+@pytest.mark.parametrize('nthreads', [2, 3])
+def test_threaded_transport_is_exact(chunked_transport_inputs, nthreads):
+    chunked_transport_inputs[1]['count_events'] = True
+    serial = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2, nthreads=1)
+    threaded = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2, nthreads=nthreads)
+    for name in montecarlo.TransportResult._fields:
+        npt.assert_array_equal(getattr(threaded, name), getattr(serial, name))
+
+
+@pytest.mark.parametrize('transport_kernel', ['packet', 'event'])
+def test_transport_split_by_first_packet_id(chunked_transport_inputs, transport_kernel):
+    arrays, parameters, packet_nus, packet_mus, packet_energies = chunked_transport_inputs
+    parameters['transport_kernel'] = transport_kernel
+    expected = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2)
+    split = montecarlo.PACKET_CHUNK_SIZE
+    first = montecarlo.transport_packets(arrays, parameters, packet_nus[:split], packet_mus[:split],
+                                         packet_energies[:split], virtual_packet_flag=2)
+    # the second call covers two chunks and adds to the j_blues and the spectrum of the first
+    second = montecarlo.transport_packets(arrays, parameters, packet_nus[split:], packet_mus[split:],
+                                          packet_energies[split:], first_packet_id=split, virtual_packet_flag=2,
+                                          j_blues=first.j_blues, spectrum_virt_nu=first.spectrum_virt_nu)
+
+    for name in ['output_nus', 'output_energies', 'last_line_interaction_in_id', 'last_line_interaction_out_id',
+                 'last_interaction_type', 'last_line_interaction_shell_id']:
+        npt.assert_array_equal(np.concatenate((getattr(first, name), getattr(second, name))),
+                               getattr(expected, name))
+    # the estimators of every chunk are added in chunk order either way
+    npt.assert_array_equal(second.j_blues, expected.j_blues)
+    npt.assert_array_equal(second.spectrum_virt_nu, expected.spectrum_virt_nu)
+    npt.assert_allclose(first.js + second.js, expected.js, rtol=1e-12)
+    npt.assert_allclose(first.nubars + second.nubars, expected.nubars, rtol=1e-12)
+
+
+def test_accumulate_transport_chunks(transport_inputs):
+    arrays, parameters, packet_nus, packet_mus, packet_energies = transport_inputs
+    expected = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=2)
+    j_blues = np.zeros_like(expected[4])
+    spectrum_virt_nu = np.zeros_like(expected[5])
+
+    def transport_chunk(packets):
+        result = montecarlo.transport_packets(arrays, parameters, packet_nus[packets], packet_mus[packets],
+                                              packet_energies[packets], first_packet_id=packets.start,
+                                              virtual_packet_flag=2, j_blues=j_blues,
+                                              spectrum_virt_nu=spectrum_virt_nu)
+        return result[:4] + result[6:]
+
+    frequency_bins = np.linspace(1e14, 3e15, 101)
+    partial_results = list(montecarlo.accumulate_transport_chunks(transport_chunk, len(packet_nus), 100, 3,
+                                                                  frequency_bins))
+    assert [chunk['packets_done'] for chunk in partial_results] == [100, 200, 300, 400, 500, 501]
+    partial_result = partial_results[-1]
+
+    # every packet has its own random stream, only the estimators are summed in a different order
+    for i, name in [(0, 'output_nus'), (1, 'output_energies'), (6, 'last_line_interaction_in_id'),
+                    (7, 'last_line_interaction_out_id'), (8, 'last_interaction_type'),
+                    (9, 'last_line_interaction_shell_id')]:
+        npt.assert_array_equal(partial_result[name], expected[i])
+    npt.assert_allclose(partial_result['js'], expected[2], rtol=1e-12)
+    npt.assert_allclose(partial_result['nubars'], expected[3], rtol=1e-12)
+    npt.assert_allclose(j_blues, expected[4], rtol=1e-12)
+    npt.assert_allclose(spectrum_virt_nu, expected[5], rtol=1e-12)
+    emitted = expected[1] >= 0
+    npt.assert_allclose(partial_result['emitted_spectrum'],
+                        np.histogram(expected[0][emitted], weights=expected[1][emitted], bins=frequency_bins)[0])
+    npt.assert_allclose(partial_result['reabsorbed_spectrum'],
+                        -np.histogram(expected[0][~emitted], weights=expected[1][~emitted],
+                                      bins=frequency_bins)[0])
+    assert np.all(np.isfinite(partial_result['j_estimator_relative_noise']))
+
+
+def test_stop_at_noise_target():
+    def partial_results():
+        for packets_done, noise in [(100, [np.inf, np.inf]), (200, [0.05, 0.2]), (300, [0.05, 0.08]),
+                                    (400, [0.01, 0.01])]:
+            yield dict(packets_done=packets_done, j_estimator_relative_noise=np.array(noise))
+
+    chunks = partial_results()
+    assert montecarlo.stop_at_noise_target(chunks, 0.1)['packets_done'] == 300
+    # the remaining chunks are not transported
+    assert next(chunks)['packets_done'] == 400
+    assert montecarlo.stop_at_noise_target(partial_results(), 0.001)['packets_done'] == 400
+
+
+def test_scale_partial_result():
+    partial_result = dict(packets_done=200, output_nus=np.array([1e15, 2e15]), output_energies=np.array([1., -2.]),
+                          js=np.array([3.]), nubars=np.array([4.]), last_line_interaction_in_id=np.array([1, -1]),
+                          last_line_interaction_out_id=np.array([2, -1]), last_interaction_type=np.array([2, 1]),
+                          last_line_interaction_shell_id=np.array([0, -1]))
+    energy_scale, result = montecarlo.scale_partial_result(partial_result, 500)
+    assert energy_scale == 2.5
+    npt.assert_array_equal(result[0], partial_result['output_nus'])
+    npt.assert_allclose(result[1], [2.5, -5.])
+    npt.assert_allclose(result[2], [7.5])
+    npt.assert_allclose(result[3], [10.])
+    for array, name in zip(result[4:], ['last_line_interaction_in_id', 'last_line_interaction_out_id',
+                                        'last_interaction_type', 'last_line_interaction_shell_id']):
+        npt.assert_array_equal(array, partial_result[name])
+
+
+def test_batch_means_relative_noise():
+    npt.assert_array_equal(montecarlo.batch_means_relative_noise(np.array([1.0, 2.0]), np.array([1.0, 4.0]), 1),
+                           [np.inf, np.inf])
+    # batches 1, 2 and 3: variance 1, so the standard error of the sum is sqrt(3)
+    totals = np.array([6.0, 0.0])
+    squared_batch_sums = np.array([14.0, 0.0])
+    npt.assert_allclose(montecarlo.batch_means_relative_noise(totals, squared_batch_sums, 3),
+                        [np.sqrt(3) / 6, np.inf])
+
+
+@pytest.mark.parametrize('virtual_packet_flag', [0, 2])
+def test_event_kernel_matches_packet_kernel(transport_inputs, virtual_packet_flag):
+    packet_kernel = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=virtual_packet_flag)
+    transport_inputs[1]['transport_kernel'] = 'event'
+    event_kernel = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=virtual_packet_flag)
+
+    # every packet has its own random number stream and the same fate in both kernels
+    for packet_array, event_array in zip(packet_kernel[:2] + packet_kernel[6:], event_kernel[:2] + event_kernel[6:]):
+        npt.assert_array_equal(event_array, packet_array)
+    # the estimators are only summed in a different order
+    for packet_array, event_array in zip(packet_kernel[2:6], event_kernel[2:6]):
+        npt.assert_allclose(event_array, packet_array, rtol=1e-12)
+
+
+@pytest.mark.parametrize('transport_kernel', ['packet', 'event'])
+def test_event_counters(macro_atom_transport_inputs, transport_kernel):
+    parameters = macro_atom_transport_inputs[1]
+    parameters['transport_kernel'] = transport_kernel
+    uncounted = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+    assert uncounted.event_counters is None
+    parameters['count_events'] = True
+    counted = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+    threaded = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2, nthreads=2)
+
+    # counting does not change the transport
+    for uncounted_array, counted_array in zip(uncounted[:-1], counted[:-1]):
+        npt.assert_array_equal(counted_array, uncounted_array)
+    npt.assert_array_equal(threaded.event_counters, counted.event_counters)
+    event_counters = dict(zip(montecarlo.EVENT_COUNTER_NAMES, counted.event_counters.sum(axis=0)))
+    # every packet leaves through a boundary
+    assert event_counters['boundary_crossings'] >= len(macro_atom_transport_inputs[2])
+    assert 0 < event_counters['line_interactions'] <= event_counters['line_steps']
+    assert event_counters['macro_atom_jumps'] >= 0
+    assert event_counters['virtual_packets'] % 2 == 0
+
+
+def test_cumulative_transition_probabilities():
+    transition_probabilities = np.array([[0.2, 0.5], [0.8, 0.5], [1.0, 0.0], [0.0, 1.0]])
+    block_references = np.array([0, 2, 4], dtype=np.int64)
+    npt.assert_allclose(macro_atom.calculate_cumulative_transition_probabilities(transition_probabilities,
+                                                                                 block_references),
+                        [[0.2, 0.5], [1.0, 1.0], [1.0, 0.0], [1.0, 1.0]])
+
+
+def test_macro_atom_emits_from_emission_transitions(macro_atom_transport_inputs):
+    arrays = macro_atom_transport_inputs[0]
+    result = montecarlo.transport_packets(*macro_atom_transport_inputs)
+    last_line_interaction_in_id, last_line_interaction_out_id = result[6:8]
+    interacted = last_line_interaction_in_id >= 0
+    assert interacted.any()
+    emission_line_ids = arrays['transition_line_id'][arrays['transition_type'] == -1]
+    assert np.in1d(last_line_interaction_out_id[interacted], emission_line_ids).all()
+
+
+@pytest.mark.parametrize('virtual_packet_flag', [0, 2])
+@pytest.mark.parametrize('reflective_inner_boundary', [False, True])
+def test_specialized_kernels_match_event_handlers(macro_atom_transport_inputs, virtual_packet_flag,
+                                                  reflective_inner_boundary):
+    parameters = macro_atom_transport_inputs[1]
+    parameters.update(reflective_inner_boundary=reflective_inner_boundary, inner_boundary_albedo=0.5)
+    # the packet kernel runs the real packets through the loop specialized for these settings, the event kernel
+    # through the generic event handlers
+    specialized = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=virtual_packet_flag)
+    parameters['transport_kernel'] = 'event'
+    generic = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=virtual_packet_flag)
+
+    for specialized_array, generic_array in zip(specialized[:2] + specialized[6:], generic[:2] + generic[6:]):
+        npt.assert_array_equal(generic_array, specialized_array)
+    for specialized_array, generic_array in zip(specialized[2:6], generic[2:6]):
+        npt.assert_allclose(generic_array, specialized_array, rtol=1e-12)
+
+def test_cumulative_line_tau_matches_line_stepping(transport_inputs):
+    stepping = montecarlo.transport_packets(*transport_inputs)
+    transport_inputs[1]['cumulative_line_tau'] = True
+    cumulative = montecarlo.transport_packets(*transport_inputs)
+
+    # tau_event is reduced by a difference of cumulative sums instead of line by line, which only changes the rounding
+    for stepping_array, cumulative_array in zip(stepping[:6], cumulative[:6]):
+        npt.assert_allclose(cumulative_array, stepping_array, rtol=1e-12)
+    for stepping_array, cumulative_array in zip(stepping[6:], cumulative[6:]):
+        npt.assert_array_equal(cumulative_array, stepping_array)
+
+
+def test_virtual_packets_with_cumulative_line_tau(transport_inputs):
+    arrays = transport_inputs[0]
+    stepping = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=3)
+    arrays['cumulative_line_tau_sobolevs'] = montecarlo.get_cumulative_line_tau_sobolevs(
+        arrays['line_lists_tau_sobolevs'])
+    cumulative = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=3)
+
+    # the real packets still step through the lines
+    for stepping_array, cumulative_array in zip(stepping[:5] + stepping[6:], cumulative[:5] + cumulative[6:]):
+        npt.assert_array_equal(cumulative_array, stepping_array)
+    npt.assert_allclose(cumulative[5], stepping[5], rtol=1e-10)
+
+
+def test_virtual_packet_roulette_is_unbiased(transport_inputs):
+    parameters = transport_inputs[1]
+
+    def mean_virtual_luminosity():
+        # the roulette changes the random numbers of the real packets as well, so compare the mean of several runs
+        luminosities = []
+        for seed in range(20):
+            parameters['seed'] = seed
+            luminosities.append(montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=10)[5].sum())
+        return np.mean(luminosities)
+
+    virtual_luminosity = mean_virtual_luminosity()
+    parameters.update(virtual_packet_roulette_tau=0.5, virtual_packet_roulette_survival=0.3)
+    npt.assert_allclose(mean_virtual_luminosity(), virtual_luminosity, rtol=0.05)
+
+    parameters['virtual_packet_roulette_survival'] = 0.0
+    with pytest.raises(ValueError):
+        montecarlo.transport_packets(*transport_inputs)
+
+
+def test_prune_thin_lines():
+    tau_sobolevs = np.array([[0.1, 2., 0.2, 0.3, 5., 0.4],
+                             [3., 0.1, 0.1, 0.1, 0.1, 0.1]])
+    merged_tau_sobolevs, next_active_line_ids, pruned_tau_sobolevs = montecarlo.prune_thin_lines(tau_sobolevs, 1.)
+
+    npt.assert_allclose(merged_tau_sobolevs, [[0., 2.1, 0., 0., 5.5, 0.],
+                                              [3., 0., 0., 0., 0., 0.]])
+    npt.assert_array_equal(next_active_line_ids, [[1, 1, 4, 4, 4, 6, 6],
+                                                  [0, 6, 6, 6, 6, 6, 6]])
+    npt.assert_allclose(pruned_tau_sobolevs, [1., 0.5])
+
+    # kept lines stay active even if they are thin
+    merged_tau_sobolevs, next_active_line_ids, pruned_tau_sobolevs = montecarlo.prune_thin_lines(
+        tau_sobolevs, 1., kept_lines=np.array([2]))
+    npt.assert_allclose(merged_tau_sobolevs, [[0., 2.1, 0.2, 0., 5.3, 0.],
+                                              [3., 0., 0.2, 0., 0., 0.]])
+    npt.assert_array_equal(next_active_line_ids, [[1, 1, 2, 4, 4, 6, 6],
+                                                  [0, 2, 2, 6, 6, 6, 6]])
+    npt.assert_allclose(pruned_tau_sobolevs, [0.8, 0.4])
+
+
+def test_unpruned_lines_match_full_line_list(transport_inputs):
+    arrays = transport_inputs[0]
+    full_line_list = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=2)
+    # with a threshold of 0 no line is pruned
+    arrays['line_lists_tau_sobolevs'], arrays['next_active_line_ids'], pruned_tau_sobolevs = \
+        montecarlo.prune_thin_lines(arrays['line_lists_tau_sobolevs'], 0.)
+    assert (pruned_tau_sobolevs == 0).all()
+    pruned = montecarlo.transport_packets(*transport_inputs, virtual_packet_flag=2)
+
+    for full_line_list_array, pruned_array in zip(full_line_list, pruned):
+        npt.assert_array_equal(pruned_array, full_line_list_array)
+
+
+@pytest.mark.parametrize('transport_kernel', ['packet', 'event'])
+def test_pruned_lines_are_skipped(transport_inputs, transport_kernel):
+    arrays, parameters = transport_inputs[:2]
+    parameters['transport_kernel'] = transport_kernel
+    arrays['line_lists_tau_sobolevs'], arrays['next_active_line_ids'] = montecarlo.prune_thin_lines(
+        arrays['line_lists_tau_sobolevs'], 1.)[:2]
+    j_blues, last_line_interaction_in_id = montecarlo.transport_packets(*transport_inputs)[4:7:2]
+
+    pruned = arrays['line_lists_tau_sobolevs'] == 0
+    assert pruned.any()
+    assert (j_blues[pruned] == 0).all()
+    assert (j_blues[~pruned] > 0).any()
+    interacted = last_line_interaction_in_id >= 0
+    assert interacted.any()
+    assert not pruned.any(axis=0)[last_line_interaction_in_id[interacted]].all()
+
+
+def test_single_precision_storage(macro_atom_transport_inputs):
+    arrays = macro_atom_transport_inputs[0]
+    double_precision = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+    for name in ['line_lists_tau_sobolevs', 'cumulative_transition_probabilities']:
+        arrays[name] = arrays[name].astype(np.float32)
+    single_precision = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+
+    assert single_precision[4].dtype == np.float32
+    # rounding the tau_sobolevs and probabilities changes the fate of few packets
+    changed_packets = (single_precision[8] != double_precision[8]).mean()
+    assert changed_packets < 0.05
+    npt.assert_allclose(single_precision[0].sum(), double_precision[0].sum(), rtol=0.05)
+    npt.assert_allclose(single_precision[4].sum(), double_precision[4].sum(), rtol=0.05)
+
+    with pytest.raises(ValueError):
+        montecarlo.transport_packets(*macro_atom_transport_inputs, j_blues=np.zeros(single_precision[4].shape,
+                                                                                      dtype=np.float16))
+
+
+@pytest.mark.parametrize('cumulative_line_tau', [False, True])
+def test_selected_j_blue_estimators(transport_inputs, cumulative_line_tau):
+    arrays, parameters = transport_inputs[:2]
+    parameters['cumulative_line_tau'] = cumulative_line_tau
+    all_lines = montecarlo.transport_packets(*transport_inputs)
+    j_blue_estimator_lines = np.array([3, 10, 11, 25], dtype=np.int64)
+    arrays['j_blue_line_ids'] = montecarlo.get_j_blue_line_ids(j_blue_estimator_lines, arrays['line_list_nu'].size)
+    selected_lines = montecarlo.transport_packets(*transport_inputs)
+
+    assert selected_lines[4].shape == (3, 4)
+    npt.assert_allclose(selected_lines[4], all_lines[4][:, j_blue_estimator_lines])
+    for i in [0, 1, 2, 3, 6, 7, 8, 9]:
+        npt.assert_array_equal(selected_lines[i], all_lines[i])
+
+    arrays['j_blue_line_ids'] = montecarlo.get_j_blue_line_ids(np.array([], dtype=np.int64),
+                                                               arrays['line_list_nu'].size)
+    no_lines = montecarlo.transport_packets(*transport_inputs, nthreads=2)
+    assert no_lines[4].shape == (3, 0)
+    npt.assert_array_equal(no_lines[0], all_lines[0])
+
+
+def test_cumulative_line_tau_sobolevs_in_buffer(transport_inputs):
+    tau_sobolevs = transport_inputs[0]['line_lists_tau_sobolevs']
+    buffer = np.empty((tau_sobolevs.shape[0], tau_sobolevs.shape[1] + 1))
+    cumulative_line_tau_sobolevs = montecarlo.get_cumulative_line_tau_sobolevs(tau_sobolevs, out=buffer)
+
+    assert cumulative_line_tau_sobolevs is buffer
+    npt.assert_array_equal(buffer[:, 0], 0)
+    npt.assert_allclose(buffer[:, -1], tau_sobolevs.sum(axis=1))
+    npt.assert_array_equal(buffer, montecarlo.get_cumulative_line_tau_sobolevs(tau_sobolevs))
+
+
+def test_array_level_transport(macro_atom_transport_inputs):
+    arrays, parameters, packet_nus, packet_mus, packet_energies = macro_atom_transport_inputs
+    spectrum_frequency = np.linspace(1e14, 3e15, 101)
+    parameters.update(spectrum_virt_nu_size=101, spectrum_delta_nu=spectrum_frequency[1] - spectrum_frequency[0])
+    arrays['v_inner'] = arrays['r_inner'] / parameters['time_explosion']
+    expected = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+    macro_atom_tables = dict((name, arrays[name]) for name in
+                             ['cumulative_transition_probabilities', 'line2macro_level_upper',
+                              'macro_block_references', 'transition_type', 'destination_level_id',
+                              'transition_line_id'])
+    result = montecarlo.transport(packet_nus, packet_mus, packet_energies, arrays['r_inner'], arrays['r_outer'],
+                                  parameters['time_explosion'], arrays['electron_densities'],
+                                  arrays['line_list_nu'], arrays['line_lists_tau_sobolevs'],
+                                  macro_atom_tables=macro_atom_tables,
+                                  spectrum_frequency=spectrum_frequency, virtual_packet_flag=2,
+                                  line_interaction_type='macroatom', seed=parameters['seed'])
+
+    assert isinstance(result, montecarlo.TransportResult)
+    for name in montecarlo.TransportResult._fields:
+        if getattr(expected, name) is None:
+            assert getattr(result, name) is None
+        else:
+            npt.assert_allclose(getattr(result, name), getattr(expected, name), rtol=1e-12)
+
+    # block references of the atomic data without the total number of transitions
+    macro_atom_tables['macro_block_references'] = arrays['macro_block_references'][:-1]
+    result = montecarlo.transport(packet_nus, packet_mus, packet_energies, arrays['r_inner'], arrays['r_outer'],
+                                  parameters['time_explosion'], arrays['electron_densities'],
+                                  arrays['line_list_nu'], arrays['line_lists_tau_sobolevs'],
+                                  macro_atom_tables=macro_atom_tables,
+                                  spectrum_frequency=spectrum_frequency, virtual_packet_flag=2,
+                                  line_interaction_type='macroatom', seed=parameters['seed'])
+    npt.assert_allclose(result.j_blues, expected.j_blues, rtol=1e-12)
+
+    with pytest.raises(TypeError):
+        montecarlo.transport(packet_nus, packet_mus, packet_energies, arrays['r_inner'], arrays['r_outer'],
+                             parameters['time_explosion'], arrays['electron_densities'], arrays['line_list_nu'],
+                             arrays['line_lists_tau_sobolevs'], no_of_packets=10)
+
+
+@pytest.mark.parametrize('transport_kernel', ['packet', 'event'])
+def test_packets_generated_in_kernel(transport_inputs, transport_kernel):
+    arrays, parameters = transport_inputs[:2]
+    parameters['transport_kernel'] = transport_kernel
+    parameters['packet_energy'] = 1.0 / 501
+    with pytest.raises(ValueError):
+        montecarlo.transport_packets(arrays, parameters, None, None, None, no_of_packets=501)
+    # comoving frequencies uniform between 6e14 and 1.9e15 Hz, half of them below 1e15 Hz
+    arrays['packet_source_cdf'] = np.array([0.0, 0.5, 1.0])
+    arrays['packet_source_nus'] = np.array([6e14, 1e15, 1.9e15])
+    packet_trace = PacketTrace(100000)
+    generated = montecarlo.transport_packets(arrays, parameters, None, None, None, no_of_packets=501,
+                                             packet_trace=packet_trace)
+    threaded = montecarlo.transport_packets(arrays, parameters, None, None, None, no_of_packets=501, nthreads=2)
+    first_part = montecarlo.transport_packets(arrays, parameters, None, None, None, no_of_packets=200)
+    second_part = montecarlo.transport_packets(arrays, parameters, None, None, None, no_of_packets=301,
+                                               first_packet_id=200)
+
+    # a packet only depends on its random stream
+    for generated_array, threaded_array in zip(generated[:-1], threaded[:-1]):
+        npt.assert_array_equal(threaded_array, generated_array)
+    npt.assert_array_equal(np.hstack((first_part.output_nus, second_part.output_nus)), generated.output_nus)
+    records = packet_trace.read()
+    start = records[records['event_type'] == PACKET_EVENT_NAMES.index('start')]
+    assert len(start) == 501
+    comoving_nus = start['nu'] * (1 - start['mu'] * start['r'] / (parameters['time_explosion'] * 29979245800.0))
+    assert np.all((comoving_nus > 6e14 * (1 - 1e-12)) & (comoving_nus < 1.9e15 * (1 + 1e-12)))
+    assert 0.4 < (comoving_nus < 1e15).mean() < 0.6
+    # mu = sqrt(u) has a mean of 2/3
+    assert abs(start['mu'].mean() - 2.0 / 3.0) < 0.05
+
+
+def test_macro_block_references():
+    npt.assert_array_equal(montecarlo.get_macro_block_references([0, 2, 5], 7), [0, 2, 5, 7])
+    npt.assert_array_equal(montecarlo.get_macro_block_references([0, 2, 5, 7], 7), [0, 2, 5, 7])
+    with pytest.raises(ValueError):
+        montecarlo.get_macro_block_references([0, 2, 9], 7)
+
@@ -0,0 +1,79 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from tardis.montecarlo import montecarlo
+from tardis.packet_source import SimplePacketSource, sample_planck_x
+
+
+def test_sobol_sequence():
+    points = montecarlo.sobol_sequence(4096, 2, 1963)
+    assert points.shape == (4096, 2)
+    assert np.all((points >= 0.0) & (points < 1.0))
+    # the first 4096 points put 64 points into every 1/64 interval of the first coordinate
+    npt.assert_array_equal(np.bincount((points[:, 0] * 64).astype(int), minlength=64), 64)
+    npt.assert_array_equal(montecarlo.sobol_sequence(4096, 2, 1963), points)
+    assert not np.any(montecarlo.sobol_sequence(4096, 2, 1964) == points)
+    with pytest.raises(ValueError):
+        montecarlo.sobol_sequence(10, 0, 1963)
+
+
+def test_sample_planck_x():
+    np.random.seed(1963)
+    xs = sample_planck_x(100000)
+    # <x> = 4 zeta(5) / zeta(4) = 3.832 and its standard deviation is 2.03
+    npt.assert_allclose(xs.mean(), 24 * 1.0369277551 * 15 / np.pi ** 4, rtol=1e-2)
+    npt.assert_allclose(xs.std(), 2.03, rtol=2e-2)
+
+
+def test_random_blackbody_nu():
+    packet_source = SimplePacketSource(1e14, 1e16, seed=1963, blackbody_sampling=10000)
+    nus = packet_source.random_blackbody_nu(10000.0, 100000)
+    assert np.all((nus >= 1e14) & (nus <= 1e16))
+    # the exact sampler and the tabulated distribution agree
+    tabulated_nus = packet_source.blackbody_nu(10000.0, (np.arange(100000) + 0.5) / 100000)
+    npt.assert_allclose(nus.mean(), tabulated_nus.mean(), rtol=1e-2)
+    # far in the Wien tail rejection would take forever, the tabulated distribution takes over
+    nus = packet_source.random_blackbody_nu(500.0, 1000)
+    assert np.all((nus >= 1e14) & (nus <= 1e16))
+
+
+def test_blackbody_nu():
+    packet_source = SimplePacketSource(1e14, 1e16, blackbody_sampling=10000)
+    nus = packet_source.blackbody_nu(10000.0, np.linspace(0.0, 1.0, 101))
+    npt.assert_allclose(nus[[0, -1]], [1e14, 1e16])
+    assert np.all(np.diff(nus) > 0)
+
+
+def test_sobol_packets():
+    random_source = SimplePacketSource(1e14, 1e16, seed=1963, blackbody_sampling=10000)
+    random_source.create_packets(100000, 10000.0)
+    sobol_source = SimplePacketSource(1e14, 1e16, seed=1963, blackbody_sampling=10000, sampling='sobol')
+    sobol_source.create_packets(4096, 10000.0)
+
+    assert np.all((sobol_source.packet_nus >= 1e14) & (sobol_source.packet_nus <= 1e16))
+    npt.assert_allclose(sobol_source.packet_energies.sum(), 1.0)
+    # the mean of mu = sqrt(u) is 2/3, far more accurate than for random packets of the same number
+    npt.assert_allclose(sobol_source.packet_mus.mean(), 2.0 / 3.0, rtol=1e-3)
+    npt.assert_allclose(sobol_source.packet_nus.mean(), random_source.packet_nus.mean(), rtol=1e-2)
+    with pytest.raises(ValueError):
+        SimplePacketSource(1e14, 1e16, sampling='halton')
+
+
+def test_packet_source_table():
+    packet_source = SimplePacketSource(1e14, 1e16, blackbody_sampling=10000, generate_in_kernel=True)
+    packet_source.create_packets(1000, 10000.0)
+    assert packet_source.packet_nus is None
+    assert packet_source.no_of_packets == 1000
+    npt.assert_allclose(packet_source.packet_energy, 1e-3)
+
+    packet_source_cdf, packet_source_nus = packet_source.packet_source_table
+    assert packet_source_cdf[0] == 0.0 and packet_source_cdf[-1] == 1.0
+    npt.assert_allclose(packet_source_nus[[0, -1]], [1e14, 1e16])
+    # the kernel inverts the table as blackbody_nu does
+    uniform_deviates = np.linspace(0.0, 0.999, 50)
+    npt.assert_allclose(np.interp(uniform_deviates, packet_source_cdf, packet_source_nus),
+                        packet_source.blackbody_nu(10000.0, uniform_deviates), rtol=1e-8)
+    with pytest.raises(ValueError):
+        SimplePacketSource(1e14, 1e16, sampling='sobol', generate_in_kernel=True)
+
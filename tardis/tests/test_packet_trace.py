@@ -0,0 +1,73 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.packet_trace import (PacketTrace, PACKET_EVENT_NAMES, read_packet_trace,
+                                            order_records)
+
+
+def test_order_records():
+    records = np.arange(5)
+    npt.assert_array_equal(order_records(records, 3), [0, 1, 2])
+    # after 7 writes the ring buffer holds writes 2 to 6, the oldest at index 2
+    npt.assert_array_equal(order_records(records, 7), [2, 3, 4, 0, 1])
+
+
+def test_packet_trace_file(tmpdir):
+    path = str(tmpdir.join('packets.trace'))
+    packet_trace = PacketTrace(4, stride=10, path=path)
+    packet_trace.records['packet_id'] = [40, 50, 20, 30]
+    packet_trace.header[0] = 6
+    packet_trace.flush()
+
+    npt.assert_array_equal(read_packet_trace(path)['packet_id'], [20, 30, 40, 50])
+    npt.assert_array_equal(packet_trace.read(), read_packet_trace(path))
+    with pytest.raises(ValueError):
+        PacketTrace(4, stride=0)
+
+
+def test_packet_trace_of_transport(macro_atom_transport_inputs):
+    arrays, parameters, packet_nus = macro_atom_transport_inputs[:3]
+    parameters['count_events'] = True
+    untraced = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2)
+    packet_trace = PacketTrace(100000)
+    traced = montecarlo.transport_packets(*macro_atom_transport_inputs, virtual_packet_flag=2,
+                                          packet_trace=packet_trace)
+
+    # tracing does not change the transport
+    for untraced_array, traced_array in zip(untraced, traced):
+        npt.assert_array_equal(traced_array, untraced_array)
+    records = packet_trace.read()
+    event_types = dict((name, records['event_type'] == i) for i, name in enumerate(PACKET_EVENT_NAMES))
+    event_counters = dict(zip(montecarlo.EVENT_COUNTER_NAMES, traced.event_counters.sum(axis=0)))
+    assert event_types['start'].sum() == len(packet_nus)
+    assert (event_types['escaped'] | event_types['reabsorbed']).sum() == len(packet_nus)
+    assert event_types['line'].sum() == event_counters['line_interactions']
+    assert event_types['electron'].sum() == event_counters['electron_scatters']
+    assert event_types['boundary'].sum() == event_counters['boundary_crossings']
+    assert np.all(records['line_id'][event_types['line']] >= 0)
+    assert np.all(records['line_id'][~event_types['line']] == -1)
+    # escaped packets leave with their output frequency
+    escaped = records[event_types['escaped']]
+    npt.assert_array_equal(escaped['nu'], traced.output_nus[escaped['packet_id']])
+
+
+@pytest.mark.parametrize('transport_kernel', ['packet', 'event'])
+def test_packet_trace_stride(transport_inputs, transport_kernel):
+    parameters, packet_nus = transport_inputs[1:3]
+    parameters['transport_kernel'] = transport_kernel
+    serial_trace = PacketTrace(100000, stride=3)
+    montecarlo.transport_packets(*transport_inputs, packet_trace=serial_trace)
+    threaded_trace = PacketTrace(100000, stride=3)
+    montecarlo.transport_packets(*transport_inputs, nthreads=2, packet_trace=threaded_trace)
+
+    serial_records = serial_trace.read()
+    assert np.all(serial_records['packet_id'] % 3 == 0)
+    assert (serial_records['event_type'] == 0).sum() == (len(packet_nus) + 2) // 3
+    # the events of a packet are recorded in order, only packets of different threads interleave
+    serial_records = serial_records[np.argsort(serial_records['packet_id'], kind='mergesort')]
+    threaded_records = threaded_trace.read()
+    threaded_records = threaded_records[np.argsort(threaded_records['packet_id'], kind='mergesort')]
+    npt.assert_array_equal(threaded_records, serial_records)
+    assert serial_records['event_type'][0] == PACKET_EVENT_NAMES.index('start')
@@ -0,0 +1,60 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from tardis.montecarlo import montecarlo
+from tardis.montecarlo.process_pool import (TransportPool, get_batch_boundaries, transport_packets_in_pool,
+                                            to_shared_array, from_shared_array)
+
+
+def test_shared_array_roundtrip():
+    array = np.arange(12, dtype=np.int64).reshape(3, 4)
+    npt.assert_array_equal(from_shared_array(to_shared_array(array)), array)
+
+
+def test_batch_boundaries_are_whole_chunks():
+    chunk_size = montecarlo.PACKET_CHUNK_SIZE
+    npt.assert_array_equal(get_batch_boundaries(5 * chunk_size + 7, 3),
+                           [0, 2 * chunk_size, 4 * chunk_size, 5 * chunk_size + 7])
+    npt.assert_array_equal(get_batch_boundaries(100, 4), [0, 100])
+
+
+@pytest.mark.parametrize('no_of_processes', [2, 3])
+def test_process_pool_matches_single_process(chunked_transport_inputs, no_of_processes):
+    chunked_transport_inputs[1]['count_events'] = True
+    single_process = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2)
+    pool = transport_packets_in_pool(*chunked_transport_inputs, virtual_packet_flag=2,
+                                     no_of_processes=no_of_processes)
+
+    # every packet has its own random number stream and the estimators are added in the same chunks
+    for name in montecarlo.TransportResult._fields:
+        npt.assert_array_equal(getattr(pool, name), getattr(single_process, name))
+
+
+def test_transport_pool_is_kept_across_transports(chunked_transport_inputs):
+    arrays, parameters, packet_nus, packet_mus, packet_energies = chunked_transport_inputs
+    j_blues = np.zeros((len(arrays['r_inner']), len(arrays['line_list_nu'])))
+    single_process = montecarlo.transport_packets(*chunked_transport_inputs, virtual_packet_flag=2,
+                                                  j_blues=j_blues.copy())
+    split = montecarlo.PACKET_CHUNK_SIZE
+
+    transport_pool = TransportPool(2)
+    try:
+        # two iterations with the same inputs
+        for i in range(2):
+            transport_pool.send_plasma(arrays, parameters)
+            pool_j_blues = j_blues.copy()
+            first = transport_pool.transport(packet_nus[:split], packet_mus[:split], packet_energies[:split],
+                                             virtual_packet_flag=2, j_blues=pool_j_blues)
+            workers = transport_pool.pool
+            second = transport_pool.transport(packet_nus[split:], packet_mus[split:], packet_energies[split:],
+                                              first_packet_id=split, virtual_packet_flag=2, j_blues=pool_j_blues,
+                                              spectrum_virt_nu=first.spectrum_virt_nu)
+            assert transport_pool.pool is workers
+
+            npt.assert_array_equal(np.concatenate((first.output_energies, second.output_energies)),
+                                   single_process.output_energies)
+            npt.assert_array_equal(pool_j_blues, single_process.j_blues)
+            npt.assert_array_equal(second.spectrum_virt_nu, single_process.spectrum_virt_nu)
+    finally:
+        transport_pool.close()